@@ -35,9 +35,19 @@ return {
             -- type = "grub",
             timeout = 10,
             include = { "memtest86+" },
+            -- uki = true,
         },
     },
 
+    tuning = {
+        sysctl = { ["vm.swappiness"] = 10 },
+        io_scheduler = { nvme = "none", ssd = "mq-deadline", hdd = "bfq" },
+    },
+
+    memory = {
+        zram = { size = "ram / 2", compression = "zstd" },
+    },
+
     hardware = {
         pipewire = {
             enable = true,
@@ -6,8 +6,9 @@ for detecting hardware-specific packages and managing Arch-specific tools.
 """
 
 from kod.common import exec_chroot, exec
+from kod.esp import BootArtifactStore
 import json
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 
 def prepare_for_installation() -> None:
@@ -63,6 +64,10 @@ def get_base_packages(conf: Any) -> Dict[str, Any]:
         ],
     }
 
+    # Unified kernel images are built with ukify
+    if conf.boot and conf.boot.loader and conf.boot.loader.uki:
+        packages["base"] += ["systemd-ukify"]
+
     # TODO: remove this package dependency
     packages["base"] += ["arch-install-scripts"]
     return packages
@@ -87,6 +92,39 @@ def install_essentials_pkgs(base_pkgs: Dict, mount_point: str):
     exec(f"pacstrap -K {mount_point} {' '.join([base_pkgs['kernel']] + base_pkgs['base'])}")
 
 
+# Arch
+def resolve_base_versions(base_pkgs: Dict) -> str:
+    """
+    Resolve the versions of the base packages and their dependencies.
+
+    The packages are resolved against the sync database, without installing them.
+
+    Args:
+        base_pkgs (Dict): A dictionary containing the packages to install,
+                          with 'kernel' and 'base' keys.
+
+    Returns:
+        str: One "name version" line per package, sorted, or an empty string if
+            the packages cannot be resolved.
+    """
+    packages = " ".join([base_pkgs["kernel"]] + base_pkgs["base"])
+    resolved = exec(f"pacman -Sp --print-format '%n %v' {packages}", get_output=True)
+    return "\n".join(sorted(line for line in resolved.splitlines() if line.strip()))
+
+
+# Arch
+def finalize_base_layer(mount_point: str):
+    """
+    Create the files of a restored base layer that are unique to each installation.
+
+    Args:
+        mount_point (str): The mount point of the root filesystem.
+    """
+    exec_chroot("pacman-key --init", mount_point=mount_point)
+    exec_chroot("pacman-key --populate archlinux", mount_point=mount_point)
+    exec_chroot("systemd-machine-id-setup", mount_point=mount_point)
+
+
 # Arch
 def get_kernel_file(mount_point: str, package: str = "linux"):
     """
@@ -112,7 +150,7 @@ def get_kernel_file(mount_point: str, package: str = "linux"):
 def setup_linux(kernel_package):
     kernel_file, kver = get_kernel_file(mount_point="/mnt", package=kernel_package)
     input(f"In setup_linux {kver=}")
-    exec_chroot(f"cp {kernel_file} /boot/vmlinuz-{kver}")
+    BootArtifactStore.load("/mnt/boot").add_file(f"/mnt{kernel_file}", f"vmlinuz-{kver}")
     return kver
 
 
@@ -146,6 +184,31 @@ def get_list_of_dependencies(pkg: str):
     return pkgs_list
 
 
+# Arch
+def find_missing_packages(packages: List[str]) -> List[str]:
+    """
+    Find the packages that are not available in the sync database.
+
+    The package names are checked against the list of packages and groups of the
+    sync database, obtained with a single call each. Names that are not found are
+    checked individually, since they can be provided by another package.
+
+    Args:
+        packages (list): The package names to check.
+
+    Returns:
+        list: The package names that are not available.
+    """
+    available = set(exec("pacman -Slq", get_output=True).split())
+    if not available:
+        # The sync database is not available (or commands are not executed)
+        return []
+    groups = exec("pacman -Sg", get_output=True)
+    available |= {line.split()[0] for line in groups.splitlines() if line.strip()}
+    missing = [pkg for pkg in packages if pkg not in available]
+    return [pkg for pkg in missing if not exec(f"pacman -Sddp --print-format %n {pkg}", get_output=True).strip()]
+
+
 # Arch
 def proc_repos(conf, current_repos=None, update=False, mount_point="/mnt"):
     """
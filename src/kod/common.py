@@ -9,16 +9,20 @@ import os
 import shlex
 import subprocess
 import sys
+import threading
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
-from chorut import ChrootManager
-
 use_debug: bool = True
 use_verbose: bool = False
 problems: list[dict] = []
 
+# Commands can run in several threads (e.g. one per disk), so the failures are also
+# counted per thread: a command only fails because of its own return code
+_problems_lock = threading.Lock()
+_thread_state = threading.local()
+
 # Set up logging
 logger = logging.getLogger(__name__)
 
@@ -94,6 +98,18 @@ def set_verbose(val: bool = True) -> None:
     use_verbose = val
 
 
+def _add_problem(problem: dict) -> None:
+    """Record a failed command in the problems list and for the calling thread."""
+    with _problems_lock:
+        problems.append(problem)
+    _thread_state.failures = _thread_failures() + 1
+
+
+def _thread_failures() -> int:
+    """Return the number of commands that failed in the calling thread."""
+    return getattr(_thread_state, "failures", 0)
+
+
 def report_problems():
     for prob in problems:
         print("Problem:", prob)
@@ -142,7 +158,7 @@ def exec(
                 logger.error(f"Command failed: {cmd}")
                 logger.error(f"Return code: {result.returncode}")
                 logger.error(f"Stderr: {result.stderr}")
-                problems.append(
+                _add_problem(
                     {
                         "type": "command_execution",
                         "command": cmd,
@@ -162,7 +178,7 @@ def exec(
             if result.returncode != 0:
                 logger.error(f"Command failed: {cmd}")
                 logger.error(f"Return code: {result.returncode}")
-                problems.append({"type": "command_execution", "command": cmd, "return_code": result.returncode})
+                _add_problem({"type": "command_execution", "command": cmd, "return_code": result.returncode})
             return ""
 
     # except subprocess.TimeoutExpired:
@@ -214,6 +230,9 @@ def exec_chroot(cmd: str, mount_point: str = "/mnt", get_output: bool = False, *
     # chroot_cmd = f"arch-chroot {safe_mount_point} {cmd}"
 
     # return exec(chroot_cmd, get_output=get_output, **kwargs)
+    # Imported here to keep the CLI startup fast for commands that do not use chroot
+    from chorut import ChrootManager
+
     with ChrootManager(mount_point) as chroot:
         result = chroot.execute(cmd, capture_output=get_output)
         return result.stdout if get_output is not None else ""
@@ -237,12 +256,11 @@ def exec_critical(cmd: str, error_msg: str, **kwargs) -> str:
     Raises:
         RuntimeError: If command fails, wrapping the original exception
     """
-    initial_problem_count = len(problems)
+    initial_failures = _thread_failures()
     result = exec(cmd, **kwargs)
 
-    # Check if new problems were added (indicating command failure)
-    if len(problems) > initial_problem_count:
-        latest_problem = problems[-1]
+    # Check if the command failed, ignoring the failures of other threads
+    if _thread_failures() > initial_failures:
         print(f"Error: {error_msg}")
         raise RuntimeError(error_msg)
 
@@ -263,11 +281,11 @@ def exec_warn(cmd: str, warning_msg: str, **kwargs) -> Optional[str]:
     Returns:
         Command output on success, None on failure
     """
-    initial_problem_count = len(problems)
+    initial_failures = _thread_failures()
     result = exec(cmd, **kwargs)
 
-    # Check if new problems were added (indicating command failure)
-    if len(problems) > initial_problem_count:
+    # Check if the command failed, ignoring the failures of other threads
+    if _thread_failures() > initial_failures:
         print(f"Warning: {warning_msg}")
         return None
 
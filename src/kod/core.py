@@ -5,18 +5,40 @@ processing, package management, user configuration, and system setup. It serves
 as the central orchestrator for the installation and configuration process.
 """
 
-import glob
 import json
 import os
 import re
 from pathlib import Path
 from typing import List, Dict, Optional, Any, Tuple, Callable
 
-import lupa as lua
-
 from kod.arch import get_base_packages, get_kernel_file, get_list_of_dependencies
-from kod.common import exec, exec_chroot, exec_critical
-from kod.filesystem import FsEntry
+from kod.common import exec, exec_chroot, exec_critical, exec_warn
+from kod.esp import BootArtifactStore, generation_ukis
+from kod.filesystem import (
+    BOOT_LABEL,
+    DEFAULT_BTRFS_OPTIONS,
+    DEFAULT_STORE_PATHS,
+    HIERARCHY_SUBVOLUMES,
+    ROOT_LABEL,
+    FsEntry,
+)
+from kod.generations import GenerationIndex
+from kod.initramfs import build_initramfs, get_boot_modules
+from kod.mounts import Mount, apply_mounts, unmount_tree
+from kod.memory import (
+    RESUME_PARAMS_FILE,
+    SWAPFILE_PATH,
+    ZRAM_CONFIG_FILE,
+    active_swaps,
+    create_swapfile,
+    get_memory,
+    get_memory_packages,
+    render_zram_config,
+    resume_params,
+    swap_entries,
+)
+from kod.tuning import configure_tuning, get_kernel_params, write_generated_file
+from kod.uki import build_uki, generation_uki, uki_enabled, uki_requested
 
 # from kod.arch import kernel_update_rquired
 
@@ -37,6 +59,9 @@ RELEASE_TYPE="expeirimental"
 
 base_distribution: str = "arch"
 
+# Directories of the root filesystem kept in /kod/store and shared by every generation
+STORE_DIRS: List[str] = list(DEFAULT_STORE_PATHS)
+
 
 def set_base_distribution(base_dist: str) -> Any:
     """Set the base distribution and return the corresponding module.
@@ -103,6 +128,8 @@ def load_config(config_filename: Optional[str]) -> Any:
     Returns:
         The loaded configuration as a Lua table.
     """
+    # Imported here so that commands not reading the configuration do not pay for it
+    import lupa as lua
 
     luart = lua.LuaRuntime()
 
@@ -163,10 +190,7 @@ def generate_fstab(partiton_list: List, mount_point: str) -> None:
     print("Generating fstab")
     with open(f"{mount_point}/etc/fstab", "w") as f:
         for part in partiton_list:
-            if part.source[:5] == "/dev/":
-                uuid = exec(f"lsblk -o UUID {part.source} | tail -n 1", get_output=True)
-                if uuid:
-                    part.source = f"UUID={uuid.strip()}"
+            part.source = part.source_uuid()
             f.write(str(part) + "\n")
 
 
@@ -187,51 +211,10 @@ def configure_system(conf: Any, partition_list: List, mount_point: str) -> None:
     """
     generate_fstab(partition_list, mount_point)
 
-    # Locale
-    locale_conf = conf.locale
-    if locale_conf:
-        time_zone = locale_conf["timezone"]
-    else:
-        time_zone = "GMT"
-    exec_chroot(f"ln -sf /usr/share/zoneinfo/{time_zone} /etc/localtime")
-    exec_chroot("hwclock --systohc")
-
-    # Localization
-    locale_spec = locale_conf.locale
-    locale_default = locale_spec.default
-    locale_to_generate = locale_default + "\n"
-    if "extra_generate" in locale_spec and locale_spec.extra_generate:
-        locale_to_generate += "\n".join(list(locale_spec.extra_generate.values()))
-    with open(f"{mount_point}/etc/locale.gen", "w") as locale_file:
-        locale_file.write(locale_to_generate + "\n")
-    exec_chroot("locale-gen")
-
-    locale_name = locale_default.split()[0]
-    locale_extra = locale_name + "\n"
-    if "extra_settings" in locale_spec and locale_spec.extra_settings:
-        for k, v in locale_spec.extra_settings.items():
-            locale_extra += f"{k}={v}\n"
-    with open(f"{mount_point}/etc/locale.conf", "w") as locale_file:
-        locale_file.write(f"LANG={locale_extra}\n")
-
-    # Network
-    network_conf = conf.network
-
-    # hostname
-    hostname = network_conf["hostname"]
-    exec(f"echo '{hostname}' > {mount_point}/etc/hostname")
-    use_ipv4 = network_conf["ipv4"] if "ipv4" in network_conf else True
-    use_ipv6 = network_conf["ipv6"] if "ipv6" in network_conf else True
-    eth0_network = """[Match]
-Name=*
-[Network]
-"""
-    if use_ipv4:
-        eth0_network += "DHCP=ipv4\n"
-    if use_ipv6:
-        eth0_network += "DHCP=ipv6\n"
-    with open(f"{mount_point}/etc/systemd/network/10-eth0.network", "w") as f:
-        f.write(eth0_network)
+    configure_locale(conf, mount_point)
+    configure_network(conf, mount_point)
+    configure_tuning(conf, mount_point)
+    configure_memory(conf, mount_point)
 
     # hosts
     exec_chroot("echo '127.0.0.1 localhost' > /etc/hosts")
@@ -294,6 +277,125 @@ aliases=user_env
         f.write(venv_fstab)
 
 
+# Core
+def configure_locale(conf: Any, mount_point: str, use_chroot: bool = True) -> None:
+    """
+    Configure the timezone and the localization of the system.
+
+    Args:
+        conf (table): The configuration table.
+        mount_point (str): The mount point where the system will be configured.
+        use_chroot (bool, optional): If True, commands are executed in a chroot environment
+                                     based at `mount_point`. Defaults to True.
+    """
+    # Locale
+    locale_conf = conf.locale
+    if locale_conf:
+        time_zone = locale_conf["timezone"]
+    else:
+        time_zone = "GMT"
+    if use_chroot:
+        exec_chroot(f"ln -sf /usr/share/zoneinfo/{time_zone} /etc/localtime", mount_point=mount_point)
+        exec_chroot("hwclock --systohc", mount_point=mount_point)
+    else:
+        exec(f"ln -sf /usr/share/zoneinfo/{time_zone} /etc/localtime")
+        exec("hwclock --systohc")
+
+    # Localization
+    locale_spec = locale_conf.locale
+    locale_default = locale_spec.default
+    locale_to_generate = locale_default + "\n"
+    if "extra_generate" in locale_spec and locale_spec.extra_generate:
+        locale_to_generate += "\n".join(list(locale_spec.extra_generate.values()))
+    with open(f"{mount_point}/etc/locale.gen", "w") as locale_file:
+        locale_file.write(locale_to_generate + "\n")
+    if use_chroot:
+        exec_chroot("locale-gen", mount_point=mount_point)
+    else:
+        exec("locale-gen")
+
+    locale_name = locale_default.split()[0]
+    locale_extra = locale_name + "\n"
+    if "extra_settings" in locale_spec and locale_spec.extra_settings:
+        for k, v in locale_spec.extra_settings.items():
+            locale_extra += f"{k}={v}\n"
+    with open(f"{mount_point}/etc/locale.conf", "w") as locale_file:
+        locale_file.write(f"LANG={locale_extra}\n")
+
+
+# Core
+def configure_network(conf: Any, mount_point: str) -> None:
+    """
+    Configure the hostname and the default network settings of the system.
+
+    Args:
+        conf (table): The configuration table.
+        mount_point (str): The mount point where the system will be configured.
+    """
+    network_conf = conf.network
+
+    # hostname
+    hostname = network_conf["hostname"]
+    exec(f"echo '{hostname}' > {mount_point}/etc/hostname")
+    use_ipv4 = network_conf["ipv4"] if "ipv4" in network_conf else True
+    use_ipv6 = network_conf["ipv6"] if "ipv6" in network_conf else True
+    eth0_network = """[Match]
+Name=*
+[Network]
+"""
+    if use_ipv4:
+        eth0_network += "DHCP=ipv4\n"
+    if use_ipv6:
+        eth0_network += "DHCP=ipv6\n"
+    with open(f"{mount_point}/etc/systemd/network/10-eth0.network", "w") as f:
+        f.write(eth0_network)
+
+
+# Core
+def configure_memory(conf: Any, mount_point: str) -> List[str]:
+    """
+    Configure zram, the swapfile and the resume device of the system.
+
+    The swapfile entry of the fstab is updated, and the swapfile is created in the
+    swap subvolume, through the top of the root partition mounted at {mount_point}/kod.
+
+    Args:
+        conf (table): The configuration table.
+        mount_point (str): The mount point where the system will be configured.
+
+    Returns:
+        list: The resume kernel command line options.
+    """
+    memory = get_memory(conf)
+    root = mount_point.rstrip("/")
+    zram_changed = write_generated_file(Path(f"{root}/{ZRAM_CONFIG_FILE}"), render_zram_config(memory.get("zram")))
+
+    swapfile = memory.get("swapfile")
+    swapfile_path = None
+    if swapfile and swapfile.get("enable", True) is not False:
+        if swapfile.get("size"):
+            swapfile_path = create_swapfile(f"{root}/kod", str(swapfile["size"]))
+        else:
+            print("The swapfile has no size, it is not created")
+            swapfile = None
+
+    partition_list = swap_entries(load_fstab(root), swapfile)
+    generate_fstab(partition_list, root)
+
+    params = resume_params(memory.get("resume"), partition_list, swapfile_path)
+    write_generated_file(Path(f"{root}/{RESUME_PARAMS_FILE}"), " ".join(params) + "\n" if params else "")
+
+    if root == "":
+        # Configured in place, the changes are also applied to the running system
+        if zram_changed:
+            exec_warn("systemctl daemon-reload", "Failed to regenerate the zram device units")
+            if memory.get("zram"):
+                exec_warn("systemctl start systemd-zram-setup@zram0.service", "Failed to start the zram device")
+        if swapfile_path and SWAPFILE_PATH not in active_swaps():
+            exec_warn(f"swapon {SWAPFILE_PATH}", "Failed to enable the swapfile")
+    return params
+
+
 # Core
 def get_kernel_version(mount_point: str) -> str:
     """
@@ -317,7 +419,10 @@ def create_boot_entry(
     is_current: bool = False,
     mount_point: str = "/mnt",
     kver: Optional[str] = None,
-) -> None:
+    set_default: bool = True,
+    initrd: Optional[str] = None,
+    uki: bool = False,
+) -> str:
     """
     Create a systemd-boot loader entry for the specified generation.
 
@@ -329,6 +434,15 @@ def create_boot_entry(
         mount_point (str, optional): The mount point of the chroot environment to write the entry to.
         kver (str, optional): The kernel version to use in the entry. If not provided, the current kernel
             version will be determined using `uname -r` in the chroot environment.
+        set_default (bool, optional): If True, the entry becomes the default entry in loader.conf.
+            Defaults to True.
+        initrd (str, optional): File name of the initramfs image on the ESP, as returned by
+            `build_initramfs`. Defaults to initramfs-linux-{kver}.img.
+        uki (bool, optional): If True, a unified kernel image is built in EFI/Linux instead of
+            the loader entry, see `build_uki`. Defaults to False.
+
+    Returns:
+        str: The systemd-boot id of the entry (e.g. "kodos-3.conf").
     """
     subvol = f"generations/{generation}/rootfs"
     root_fs = [part for part in partition_list if part.destination in ["/"]][0]
@@ -339,6 +453,22 @@ def create_boot_entry(
 
     if not kver:
         kver = get_kernel_version(mount_point)
+    if not initrd:
+        initrd = f"initramfs-linux-{kver}.img"
+
+    entry_path = Path(f"{mount_point}/boot/loader/entries/{entry_name}.conf")
+    if uki:
+        image = build_uki(generation, kver, initrd, f"root={root_device} rw {options}", mount_point)
+        # The image replaces the loader entry of the generation. The kernel and the initramfs
+        # stay referenced, since they are the inputs of the next images built from them.
+        entry_path.unlink(missing_ok=True)
+        BootArtifactStore.load(f"{mount_point}/boot").reference(generation, [image, f"vmlinuz-{kver}", initrd])
+        if set_default:
+            set_default_boot_entry(os.path.basename(image), mount_point)
+        return os.path.basename(image)
+    store = BootArtifactStore.load(f"{mount_point}/boot")
+    for image in generation_ukis(f"{mount_point}/boot", generation):
+        store.remove(image)
 
     today = exec("date +'%Y-%m-%d %H:%M:%S'", get_output=True).strip()
     entry_conf = f"""
@@ -346,27 +476,54 @@ title KodOS
 sort-key kodos
 version Generation {generation} KodOS (build {today} - {kver})
 linux /vmlinuz-{kver}
-initrd /initramfs-linux-{kver}.img
+initrd /{initrd}
 options root={root_device} rw {options}
     """
     entries_path = Path(f"{mount_point}/boot/loader/entries/")
     if not entries_path.is_dir():
         entries_path.mkdir(parents=True, exist_ok=True)
-    with open(f"{mount_point}/boot/loader/entries/{entry_name}.conf", "w") as f:
+    with open(entry_path, "w") as f:
         f.write(entry_conf)
+    store.reference(generation, [f"vmlinuz-{kver}", initrd])
+
+    if set_default:
+        set_default_boot_entry(f"{entry_name}.conf", mount_point)
+    return f"{entry_name}.conf"
+
+
+# Core
+def set_default_boot_entry(entry: str, mount_point: str = "/mnt", next_boot_only: bool = False) -> None:
+    """
+    Make a systemd-boot loader entry the default one.
+
+    loader.conf is only written when it changes.
+
+    Args:
+        entry (str): Id of the entry: file name of the loader entry (e.g. "kodos-3.conf") or
+            of the unified kernel image.
+        mount_point (str, optional): The mount point where /boot is mounted. Defaults to "/mnt".
+        next_boot_only (bool, optional): If True, the entry is only used for the next boot,
+            through the systemd-boot one-shot EFI variable, and loader.conf is not changed.
+    """
+    if next_boot_only:
+        exec(f"bootctl set-oneshot {entry}")
+        return
 
-    # Update loader.conf
     loader_conf_systemd = f"""
-default {entry_name}.conf
+default {entry}
 timeout 10
 console-mode keep
 """
-    with open(f"{mount_point}/boot/loader/loader.conf", "w") as f:
+    loader_conf = Path(f"{mount_point}/boot/loader/loader.conf")
+    if loader_conf.is_file() and loader_conf.read_text() == loader_conf_systemd:
+        return
+    loader_conf.parent.mkdir(parents=True, exist_ok=True)
+    with open(loader_conf, "w") as f:
         f.write(loader_conf_systemd)
 
 
 # Core
-def setup_bootloader(conf: Any, partition_list: List, dist: Any) -> None:
+def setup_bootloader(conf: Any, partition_list: List, dist: Any, portable: bool = False) -> None:
     # bootloader
     """
     Set up the bootloader based on the configuration.
@@ -374,6 +531,11 @@ def setup_bootloader(conf: Any, partition_list: List, dist: Any) -> None:
     Args:
         conf (dict): The configuration dictionary.
         partition_list (list): A list of Partition objects to use for determining the root device.
+        dist (module): The distribution module.
+        portable (bool, optional): If True, the system is not installed on the disk it
+            boots from: /boot is not checked to be an ESP, the EFI variables are not
+            modified and the initramfs is not limited to the drivers of this machine.
+            Defaults to False.
     """
     boot_conf = conf.boot
     loader_conf = boot_conf["loader"]
@@ -398,11 +560,22 @@ def setup_bootloader(conf: Any, partition_list: List, dist: Any) -> None:
         #     exec_chroot(f"cp {kernel_file} /boot/vmlinuz-linux-{kver}")
         # else:
         #     kernel_file, kver = get_kernel_file(mount_point="/mnt", package=kernel_package)
-        exec_chroot("bootctl install")
+        if portable:
+            exec_chroot("env SYSTEMD_RELAX_ESP_CHECKS=1 bootctl install --esp-path=/boot --no-variables")
+        else:
+            exec_chroot("bootctl install")
         print("KVER:", kver)
         input(f"Before setting boot using dracut {kver}")
-        exec_chroot(f"dracut --kver {kver} --hostonly /boot/initramfs-linux-{kver}.img")
-        create_boot_entry(0, partition_list, mount_point="/mnt", kver=kver)
+        initrd = build_initramfs(kver, "/mnt", hostonly=not portable, modules=get_boot_modules(conf))
+        create_boot_entry(
+            0,
+            partition_list,
+            get_kernel_params("/mnt"),
+            mount_point="/mnt",
+            kver=kver,
+            initrd=initrd,
+            uki=uki_requested(conf),
+        )
 
     # Using Grub as bootloader
     if boot_type == "grub":
@@ -461,6 +634,9 @@ def get_packages_to_install(conf: Any) -> Tuple[Dict[str, List[str]], List[str]]
     # Font packages
     font_packages_to_install = proc_fonts(conf)
 
+    # Memory packages
+    memory_packages_to_install = get_memory_packages(conf)
+
     packages_to_install = base_packages.copy()
     packages_to_install["packages"] = list(
         set(
@@ -470,6 +646,7 @@ def get_packages_to_install(conf: Any) -> Tuple[Dict[str, List[str]], List[str]]
             + user_packages_to_install
             + system_packages_to_install
             + font_packages_to_install
+            + memory_packages_to_install
         )
     )
 
@@ -526,6 +703,47 @@ def change_subvol(partition_list: List, subvol: str, mount_points: List[str]) ->
     return partition_list
 
 
+# Core
+def set_hierarchy_options(partition_list: List, btrfs_options: Dict[str, str]) -> List:
+    """
+    Replace the mount options of the btrfs subvolumes of the hierarchy, keeping their subvolume.
+
+    Args:
+        partition_list (list): The list of FsEntry objects to modify.
+        btrfs_options (dict): Mount options by subvolume, as returned by `get_btrfs_options`.
+
+    Returns:
+        list: The modified partition list.
+    """
+    options = hierarchy_btrfs_options(btrfs_options)
+    subvolumes = {"/": "rootfs", "/kod": "kod", "/home": "home"}
+    for part in partition_list:
+        if part.fs_type != "btrfs" or part.destination not in subvolumes:
+            continue
+        subvol = [opt for opt in part.options.split(",") if opt.startswith("subvol=")]
+        part.options = ",".join([options[subvolumes[part.destination]]] + subvol)
+    return partition_list
+
+
+# Core
+def add_store_entries(partition_list: List, store_paths: Dict[str, Dict[str, bool]]) -> List:
+    """
+    Add the bind mount entries of the store paths that are missing from a partition list.
+
+    Args:
+        partition_list (list): The list of FsEntry objects to modify.
+        store_paths (dict): Store paths, as returned by `get_store_paths`.
+
+    Returns:
+        list: The modified partition list.
+    """
+    destinations = {part.destination for part in partition_list}
+    for path in store_paths:
+        if f"/{path}" not in destinations:
+            partition_list.append(FsEntry(f"/kod/store/{path}", f"/{path}", "none", "rw,bind"))
+    return partition_list
+
+
 # Core
 def set_ro_mount(mount_point: str) -> None:
     """
@@ -561,28 +779,6 @@ def change_ro_mount(root_path: str) -> None:
             f.write(line)
 
 
-# Core
-def get_max_generation() -> int:
-    """
-    Retrieve the highest numbered generation directory in /kod/generations.
-
-    If no generation directories exist, return 0.
-
-    Returns:
-        int: The highest numbered generation directory.
-    """
-    generations = glob.glob("/kod/generations/*")
-    generations = [p.split("/")[-1] for p in generations]
-    generations = [int(p) for p in generations if p != "current"]
-    print(f"{generations=}")
-    if generations:
-        generation = max(generations)
-    else:
-        generation = 0
-    print(f"{generation=}")
-    return generation
-
-
 # Core
 def load_repos() -> Optional[Dict[str, Any]]:
     """
@@ -1600,7 +1796,173 @@ def load_fstab(root_path: str = "") -> List[str]:
 
 
 # Core
-def create_filesystem_hierarchy(boot_part: Any, root_part: Any, partition_list: List, mount_point: str) -> List:
+def create_store_subvolume(top_path: str, path: str, attributes: Dict[str, bool]) -> bool:
+    """
+    Create the subvolume of a store path, unless it exists, and set its btrfs attributes.
+
+    Store paths are subvolumes so that snapshots of the filesystem do not include
+    them. The attributes only apply to the files created afterwards.
+
+    Args:
+        top_path (str): Path to the top of the btrfs filesystem.
+        path (str): Store path, relative to the root filesystem (e.g. var/log).
+        attributes (dict): Btrfs attributes, as returned by `get_store_paths`.
+
+    Returns:
+        bool: True if the subvolume was created.
+    """
+    store_path = f"{top_path}/store/{path}"
+    created = not Path(store_path).exists()
+    if created:
+        exec(f"mkdir -p {Path(store_path).parent}")
+        exec_critical(f"btrfs subvolume create {store_path}", f"Failed to create the store subvolume {path}")
+    if attributes.get("nodatacow"):
+        exec_warn(f"chattr +C {store_path}", f"Failed to disable copy-on-write for {path}")
+    elif attributes.get("compress") is False:
+        exec_warn(f"btrfs property set {store_path} compression none", f"Failed to disable compression for {path}")
+    return created
+
+
+# Core
+def create_generation_layout(
+    top_path: str, generation: int = 0, store_paths: Optional[Dict[str, Dict[str, bool]]] = None
+) -> None:
+    """
+    Create the KodOS layout at the top of a btrfs filesystem.
+
+    Creates the store, generations and current directories, the store and home
+    subvolumes and the root filesystem subvolume of the first generation. The
+    subvolumes that already exist are kept, so that a resumed installation can
+    run it again.
+
+    Args:
+        top_path (str): Path to the top of the btrfs filesystem, or to the directory
+            that takes its place for a directory installation.
+        generation (int, optional): The number of the first generation. Defaults to 0.
+        store_paths (dict, optional): Store paths and their attributes, as returned by
+            `get_store_paths`. Defaults to DEFAULT_STORE_PATHS.
+    """
+    for dir in ["store", "generations", "current"]:
+        exec(f"mkdir -p {top_path}/{dir}")
+
+    for path, attributes in (store_paths or DEFAULT_STORE_PATHS).items():
+        create_store_subvolume(top_path, path, attributes)
+
+    # Create home as subvolume if no /home is specified in the config
+    # (TODO: Add support for custom home)
+    if not Path(f"{top_path}/store/home").exists():
+        exec_critical(f"sudo btrfs subvolume create {top_path}/store/home", "Critical filesystem setup failed")
+
+    # First generation
+    exec_critical(f"mkdir -p {top_path}/generations/{generation}", f"Generation setup failed - directory creation")
+    if not Path(f"{top_path}/generations/{generation}/rootfs").exists():
+        exec_critical(
+            f"btrfs subvolume create {top_path}/generations/{generation}/rootfs",
+            f"Generation setup failed - subvolume creation",
+        )
+
+
+# Core
+def hierarchy_btrfs_options(btrfs_options: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Get the mount options of each btrfs subvolume of the hierarchy, with the defaults filled in.
+
+    Args:
+        btrfs_options (dict, optional): Mount options by subvolume, as returned by `get_btrfs_options`.
+
+    Returns:
+        dict: The mount options of the rootfs, kod and home subvolumes.
+    """
+    options = {subvol: DEFAULT_BTRFS_OPTIONS for subvol in HIERARCHY_SUBVOLUMES}
+    options.update(btrfs_options or {})
+    return options
+
+
+# Core
+def hierarchy_fstab_entries(
+    boot_part: str,
+    root_part: str,
+    generation: int,
+    btrfs_options: Optional[Dict[str, str]] = None,
+    store_paths: Optional[Dict[str, Dict[str, bool]]] = None,
+) -> List:
+    """
+    Get the fstab entries of the KodOS filesystem hierarchy.
+
+    Args:
+        boot_part (str): The boot partition, or its LABEL= specification.
+        root_part (str): The root partition, or its LABEL= specification.
+        generation (int): The generation mounted as root.
+        btrfs_options (dict, optional): Mount options by subvolume, as returned by `get_btrfs_options`.
+            Defaults to DEFAULT_BTRFS_OPTIONS for every subvolume.
+        store_paths (dict, optional): Store paths, as returned by `get_store_paths`.
+            Defaults to DEFAULT_STORE_PATHS.
+
+    Returns:
+        list: The FsEntry objects of the root, boot, kod, home and store mounts.
+    """
+    options = hierarchy_btrfs_options(btrfs_options)
+    boot_options = (
+        "rw,relatime,fmask=0022,dmask=0022,codepage=437,iocharset=ascii,shortname=mixed,utf8,errors=remount-ro"
+    )
+    partition_list = [
+        FsEntry(root_part, "/", "btrfs", f"{options['rootfs']},subvol=generations/{generation}/rootfs"),
+        FsEntry(boot_part, "/boot", "vfat", boot_options),
+        FsEntry(root_part, "/kod", "btrfs", options["kod"]),
+        FsEntry(root_part, "/home", "btrfs", f"{options['home']},subvol=store/home"),
+    ]
+    for dir in store_paths or DEFAULT_STORE_PATHS:
+        partition_list.append(FsEntry(f"/kod/store/{dir}", f"/{dir}", "none", "rw,bind"))
+    return partition_list
+
+
+# Core
+def hierarchy_mounts(
+    boot_part: str,
+    root_part: str,
+    generation: int,
+    mount_point: str,
+    store_path: str,
+    btrfs_options: Optional[Dict[str, str]] = None,
+    store_paths: Optional[Dict[str, Dict[str, bool]]] = None,
+) -> List:
+    """
+    Get the mounts of the KodOS filesystem hierarchy of a generation.
+
+    Args:
+        boot_part (str): The boot partition.
+        root_part (str): The root partition.
+        generation (int): The generation mounted as root.
+        mount_point (str): The mount point of the generation.
+        store_path (str): Path of the store directories bind mounted into the generation.
+        btrfs_options (dict, optional): Mount options by subvolume, as returned by `get_btrfs_options`.
+        store_paths (dict, optional): Store paths, as returned by `get_store_paths`.
+            Defaults to DEFAULT_STORE_PATHS.
+
+    Returns:
+        list: The Mount objects of the root, boot, kod, home and store mounts, parents first.
+    """
+    options = hierarchy_btrfs_options(btrfs_options)
+    mounts = [
+        Mount(root_part, mount_point, options=f"{options['rootfs']},subvol=generations/{generation}/rootfs"),
+        Mount(boot_part, f"{mount_point}/boot"),
+        Mount(root_part, f"{mount_point}/kod", options=options["kod"]),
+        Mount(root_part, f"{mount_point}/home", options=f"{options['home']},subvol=store/home"),
+    ]
+    for dir in store_paths or DEFAULT_STORE_PATHS:
+        mounts.append(Mount(f"{store_path}/{dir}", f"{mount_point}/{dir}", bind=True))
+    return mounts
+
+
+# Core
+def create_filesystem_hierarchy(
+    boot_part: Any,
+    root_part: Any,
+    partition_list: List,
+    mount_point: str,
+    btrfs_options: Optional[Dict[str, str]] = None,
+    store_paths: Optional[Dict[str, Dict[str, bool]]] = None,
+) -> List:
     """
     Create and configure a Btrfs filesystem hierarchy for KodOS.
 
@@ -1614,66 +1976,102 @@ def create_filesystem_hierarchy(boot_part: Any, root_part: Any, partition_list:
         root_part: The root partition to be used for creating subvolumes.
         partition_list: A list of Partition objects representing the filesystem hierarchy.
         mount_point: The mount point where the filesystem hierarchy will be created.
+        btrfs_options: Mount options by subvolume, as returned by `get_btrfs_options`.
+        store_paths: Store paths and their attributes, as returned by `get_store_paths`.
 
     Returns:
         list: An updated list of Partition objects reflecting the created filesystem hierarchy.
     """
     print("===================================")
     print("== Creating filesystem hierarchy ==")
+    # The layout is created at the top of the root partition. It was mounted by `create_partitions`,
+    # which a resumed installation skips, or the first generation may already be mounted over it.
+    apply_mounts([Mount(root_part, mount_point)])
+
     # Initial generation
     generation = 0
-    for dir in ["store", "generations", "current"]:
-        exec(f"mkdir -p {mount_point}/{dir}")
+    create_generation_layout(mount_point, generation, store_paths)
 
-    subdirs = ["root", "var/log", "var/tmp", "var/cache", "var/kod"]
-    for dir in subdirs:
-        exec(f"mkdir -p {mount_point}/store/{dir}")
+    # Mounting first generation, in place of the top of the root partition
+    store_path = f"{mount_point}/kod/store"
+    apply_mounts(
+        hierarchy_mounts(boot_part, root_part, generation, mount_point, store_path, btrfs_options, store_paths)
+    )
+    # Swap partitions are not part of the hierarchy and are kept as they are
+    swap_list = [part for part in partition_list if part.fs_type == "swap"]
+    partition_list = hierarchy_fstab_entries(boot_part, root_part, generation, btrfs_options, store_paths) + swap_list
 
-    # Create home as subvolume if no /home is specified in the config
-    # (TODO: Add support for custom home)
-    exec_critical(f"sudo btrfs subvolume create {mount_point}/store/home", "Critical filesystem setup failed")
+    # Write generation number
+    with open(f"{mount_point}/.generation", "w") as f:
+        f.write(str(generation))
 
-    # First generation
-    exec_critical(f"mkdir -p {mount_point}/generations/{generation}", f"Generation setup failed - directory creation")
-    exec_critical(
-        f"btrfs subvolume create {mount_point}/generations/{generation}/rootfs",
-        f"Generation setup failed - subvolume creation",
-    )
+    print("===================================")
 
-    # Mounting first generation
-    exec_critical(f"umount -R {mount_point}", f"Generation mount failed - unmount")
-    exec_critical(
-        f"mount -o subvol=generations/{generation}/rootfs {root_part} {mount_point}", f"Generation mount failed - mount"
-    )
-    partition_list = [
-        FsEntry(
-            root_part,
-            "/",
-            "btrfs",
-            f"rw,relatime,ssd,space_cache=v2,subvol=generations/{generation}/rootfs",
-        )
-    ]
+    return partition_list
 
-    for dir in subdirs + ["boot", "home", "kod"]:
-        exec(f"mkdir -p {mount_point}/{dir}")
 
-    exec(f"mount {boot_part} {mount_point}/boot")
-    boot_options = (
-        "rw,relatime,fmask=0022,dmask=0022,codepage=437,iocharset=ascii,shortname=mixed,utf8,errors=remount-ro"
-    )
-    partition_list.append(FsEntry(boot_part, "/boot", "vfat", boot_options))
+# Core
+def mount_filesystem_hierarchy(partition_list: List, mount_point: str) -> None:
+    """
+    Mount again a filesystem hierarchy created by `create_filesystem_hierarchy`.
 
-    exec(f"mount {root_part} {mount_point}/kod")
-    partition_list.append(FsEntry(root_part, "/kod", "btrfs", "rw,relatime,ssd,space_cache=v2"))
+    This is used to resume an installation after the hierarchy was created. Entries
+    that are already mounted are skipped, and bind mounts are resolved relative to
+    the mount point, since their sources are paths of the installed system.
 
-    btrfs_options = "rw,relatime,ssd,space_cache=v2"
+    Args:
+        partition_list (list): The list of FsEntry objects returned by `create_filesystem_hierarchy`.
+        mount_point (str): The mount point where the filesystem hierarchy is mounted.
+    """
+    mounts = []
+    for part in partition_list:
+        if part.fs_type == "swap":
+            continue
+        target = f"{mount_point}{part.destination}".rstrip("/") or "/"
+        if part.fs_type == "none":
+            mounts.append(Mount(f"{mount_point}{part.source}", target, bind=True))
+        else:
+            fs_type = "vfat" if part.fs_type == "esp" else part.fs_type
+            mounts.append(Mount(part.source, target, fs_type, part.options))
+    apply_mounts(mounts)
 
-    exec(f"mount -o subvol=store/home {root_part} {mount_point}/home")
-    partition_list.append(FsEntry(root_part, "/home", "btrfs", btrfs_options + ",subvol=store/home"))
 
-    for dir in subdirs:
-        exec(f"mount --bind {mount_point}/kod/store/{dir} {mount_point}/{dir}")
-        partition_list.append(FsEntry(f"/kod/store/{dir}", f"/{dir}", "none", "rw,bind"))
+# Core
+def create_directory_hierarchy(
+    target: str,
+    mount_point: str,
+    btrfs_options: Optional[Dict[str, str]] = None,
+    store_paths: Optional[Dict[str, Dict[str, bool]]] = None,
+) -> List:
+    """
+    Create the KodOS filesystem hierarchy in a directory of an existing btrfs filesystem.
+
+    The directory takes the place of the top of the root partition: it receives the
+    store, the generations and a boot directory that stands in for the ESP. The first
+    generation is then bind mounted at the mount point, so that the rest of the
+    installation runs as for a partitioned disk. The fstab refers to the partitions
+    by the KODOS_ROOT and KODOS_BOOT labels, which are given to the filesystems when
+    the tree is written to a disk or an image.
+
+    Args:
+        target (str): Directory or subvolume where KodOS is installed.
+        mount_point (str): The mount point where the first generation is mounted.
+        btrfs_options (dict, optional): Mount options by subvolume, as returned by `get_btrfs_options`.
+        store_paths (dict, optional): Store paths and their attributes, as returned by `get_store_paths`.
+
+    Returns:
+        list: The FsEntry objects of the fstab of the installed system.
+    """
+    print("===================================")
+    print(f"== Creating filesystem hierarchy in {target} ==")
+    generation = 0
+    create_generation_layout(target, generation, store_paths)
+    exec(f"mkdir -p {target}/boot")
+
+    mount_directory_hierarchy(target, mount_point, generation, store_paths)
+    partition_list = hierarchy_fstab_entries(
+        f"LABEL={BOOT_LABEL}", f"LABEL={ROOT_LABEL}", generation, btrfs_options, store_paths
+    )
 
     # Write generation number
     with open(f"{mount_point}/.generation", "w") as f:
@@ -1685,41 +2083,80 @@ def create_filesystem_hierarchy(boot_part: Any, root_part: Any, partition_list:
 
 
 # Core
-def create_next_generation(boot_part: str, root_part: str, generation: int) -> str:
+def mount_directory_hierarchy(
+    target: str, mount_point: str, generation: int = 0, store_paths: Optional[Dict[str, Dict[str, bool]]] = None
+) -> None:
+    """
+    Bind mount a hierarchy created by `create_directory_hierarchy` at the mount point.
+
+    Args:
+        target (str): Directory or subvolume where KodOS is installed.
+        mount_point (str): The mount point where the generation is mounted.
+        generation (int, optional): The generation to mount. Defaults to 0.
+        store_paths (dict, optional): Store paths, as returned by `get_store_paths`.
+            Defaults to DEFAULT_STORE_PATHS.
+    """
+    mounts = [
+        Mount(f"{target}/generations/{generation}/rootfs", mount_point, bind=True),
+        Mount(f"{target}/boot", f"{mount_point}/boot", bind=True),
+        Mount(target, f"{mount_point}/kod", bind=True),
+        Mount(f"{target}/store/home", f"{mount_point}/home", bind=True),
+    ]
+    for dir in store_paths or DEFAULT_STORE_PATHS:
+        mounts.append(Mount(f"{target}/store/{dir}", f"{mount_point}/{dir}", bind=True))
+    apply_mounts(mounts)
+
+
+# Core
+def create_next_generation(
+    boot_part: str,
+    root_part: str,
+    generation: int,
+    btrfs_options: Optional[Dict[str, str]] = None,
+    store_paths: Optional[Dict[str, Dict[str, bool]]] = None,
+) -> str:
     """
     Create the next generation of the KodOS installation.
 
     Mounts the generation at /.next_current and sets up the subvolumes and
-    mounts the partitions as specified in the fstab file.
+    mounts the partitions as specified in the fstab file. Mounts that are
+    already in place, from an interrupted rebuild, are kept.
 
     Args:
         boot_part (str): The device name of the boot partition
         root_part (str): The device name of the root partition
         generation (int): The generation number to create
+        btrfs_options (dict, optional): Mount options by subvolume, as returned by
+            `get_btrfs_options`. If not provided, the options of the running system are kept.
+        store_paths (dict, optional): Store paths and their attributes, as returned by
+            `get_store_paths`. Store paths that do not exist yet are created, with the
+            content the generation has at that path. If not provided, the store
+            paths of the running system are kept.
 
     Returns:
         str: The path to the mounted generation
     """
     next_current = Path("/kod/current/.next_current")
-    # Mounting generation
-    if next_current.is_mount():
-        print("Reboot is required to update generation")
-        os._exit(0)
-        exec(f"umount -R {next_current}")
-        exec(f"rm -rf {next_current}")
-
-    exec(f"mkdir -p {next_current}")
-
-    exec(f"mount -o subvol=generations/{generation}/rootfs {root_part} {next_current}")
-    exec(f"mount {boot_part} {next_current}/boot")
-    exec(f"mount {root_part} {next_current}/kod")
-    exec(f"mount -o subvol=store/home {root_part} {next_current}/home")
+    partition_list = load_fstab()
+    if store_paths:
+        for path, attributes in store_paths.items():
+            generation_path = f"/kod/generations/{generation}/rootfs/{path}"
+            if create_store_subvolume("/kod", path, attributes) and Path(generation_path).is_dir():
+                exec_critical(
+                    f"cp -a --reflink=auto {generation_path}/. /kod/store/{path}/",
+                    f"Failed to move {path} to the store",
+                )
+        add_store_entries(partition_list, store_paths)
+    else:
+        store_paths = {part.destination.lstrip("/"): {} for part in partition_list if part.fs_type == "none"}
 
-    subdirs = ["root", "var/log", "var/tmp", "var/cache", "var/kod"]
-    for dir in subdirs:
-        exec(f"mount --bind /kod/store/{dir} {next_current}/{dir}")
+    # Mounting generation
+    apply_mounts(
+        hierarchy_mounts(boot_part, root_part, generation, str(next_current), "/kod/store", btrfs_options, store_paths)
+    )
 
-    partition_list = load_fstab()
+    if btrfs_options:
+        set_hierarchy_options(partition_list, btrfs_options)
     change_subvol(partition_list, subvol=f"generations/{generation}", mount_points=["/"])
     generate_fstab(partition_list, str(next_current))
 
@@ -1791,6 +2228,104 @@ def proc_users(ctx: Any, conf: Any) -> None:
         enable_user_services(ctx, user, services_to_enable)
 
 
+# Core
+def rollback_generation(generation: int, next_boot_only: bool = False) -> bool:
+    """
+    Make an existing generation the one used at boot.
+
+    Only the fstab of the generation (if its root subvolume reference is wrong) and
+    the systemd-boot configuration are written. No package is installed and no
+    file of the generation is copied.
+
+    Args:
+        generation (int): The generation to boot.
+        next_boot_only (bool, optional): If True, the generation is only booted once,
+            at the next boot. Defaults to False.
+
+    Returns:
+        bool: True if the generation will be booted.
+    """
+    rootfs = f"/kod/generations/{generation}/rootfs"
+    if not Path(f"{rootfs}/etc/fstab").is_file():
+        print(f"Generation {generation} not found")
+        return False
+
+    partition_list = load_fstab(rootfs)
+    fstab = [str(part) for part in partition_list]
+    change_subvol(partition_list, subvol=f"generations/{generation}", mount_points=["/"])
+    if [str(part) for part in partition_list] != fstab:
+        generate_fstab(partition_list, rootfs)
+
+    image = generation_uki(generation)
+    entry = os.path.basename(image) if image else f"kodos-{generation}.conf"
+    if not image and not Path(f"/boot/loader/entries/{entry}").is_file():
+        info = GenerationIndex.load().get(generation)
+        if info is None or not info["kver"]:
+            print(f"Generation {generation} has no boot entry and its kernel version is unknown")
+            return False
+        entry = create_boot_entry(
+            generation,
+            partition_list,
+            get_kernel_params(rootfs),
+            mount_point="",
+            kver=info["kver"],
+            set_default=False,
+            initrd=info.get("initrd"),
+            uki=uki_enabled("/boot"),
+        )
+
+    set_default_boot_entry(entry, mount_point="", next_boot_only=next_boot_only)
+    return True
+
+
+# Core
+def rollback_rebuild(journal: Any) -> None:
+    """
+    Discard the changes made by a failed rebuild.
+
+    For a new generation, the partially built generation is unmounted and deleted.
+    For an in-place rebuild, the snapshot of the root filesystem taken before the
+    rebuild becomes the root filesystem of the current generation again, and the
+    modified root filesystem is kept at /kod/current/failed-rootfs until the next
+    reboot, since it is still mounted.
+
+    Args:
+        journal (StageJournal): The journal of the failed rebuild.
+    """
+    info = journal.output("generation")
+    if info is None:
+        print("The failed rebuild did not make any change")
+        journal.finish()
+        return
+    generation, current, new_generation = info["id"], info["current"], info["new_generation"]
+    if journal.completed("deploy"):
+        print(f"Generation {generation} was already deployed, nothing to roll back")
+        journal.finish()
+        return
+
+    print(f"==== Rolling back generation {generation} ====")
+    next_state_path = f"/kod/generations/{generation}"
+    if new_generation:
+        next_current = journal.output("snapshot") or "/kod/current/.next_current"
+        unmount_tree(next_current)
+        if Path(f"{next_state_path}/rootfs").exists():
+            exec(f"btrfs subvolume delete {next_state_path}/rootfs")
+    elif journal.completed("snapshot"):
+        # The running root was modified, restore the snapshot taken before the rebuild
+        exec(f"mv /kod/generations/{current}/rootfs /kod/current/failed-rootfs")
+        exec(f"mv /kod/current/old-rootfs /kod/generations/{current}/rootfs")
+        exec("rm -f /kod/current/installed_packages /kod/current/enabled_services")
+        print(f"Reboot to return to generation {current}, the modified root is kept at /kod/current/failed-rootfs")
+    elif Path("/kod/current/old-rootfs").exists():
+        exec("btrfs subvolume delete /kod/current/old-rootfs")
+        exec("rm -f /kod/current/installed_packages /kod/current/enabled_services")
+    exec(f"rm -rf {next_state_path}")
+    GenerationIndex.load().remove(generation)
+
+    journal.finish()
+    print(f"Rebuild of generation {generation} rolled back")
+
+
 # Core
 def get_generation(mount_point: str) -> int:
     """
@@ -1920,38 +2455,8 @@ def update_kernel_hook(kernel_package: str, mount_point: str) -> Callable[[], No
         kernel_file, kver = get_kernel_file(mount_point, package=kernel_package)
         print(f"{kver=}")
         input(f"Before update /boot/vmlinuz-{kver}")
-        print(f"cp {kernel_file} /boot/vmlinuz-{kver}")
-        exec_chroot(f"cp {kernel_file} /boot/vmlinuz-{kver}", mount_point=mount_point)
-
-    return hook
-
-
-# Core
-def update_initramfs_hook(kernel_package: str, mount_point: str) -> Callable[[], None]:
-    """
-    Create a hook function to update the initramfs for a specified package.
-
-    This function generates a hook that, when executed, generates an initramfs
-    file for the specified kernel package from the chroot environment at the
-    given mount point.
-
-    Args:
-        kernel_package (str): The name of the kernel package to update.
-        mount_point (str): The mount point of the chroot environment.
-
-    Returns:
-        function: A hook function that performs the initramfs update.
-    """
-
-    def hook() -> None:
-        print(f"Update initramfs ....{kernel_package}")
-        kernel_file, kver = get_kernel_file(mount_point, package=kernel_package)
-        print(f"{kver=}")
-        input(f"Before update initrm (hook) {kver=}")
-        exec_chroot(
-            f"dracut --kver {kver} --hostonly /boot/initramfs-linux-{kver}.img",
-            mount_point=mount_point,
-        )
+        root = "" if mount_point == "/" else mount_point
+        BootArtifactStore.load(f"{root}/boot").add_file(f"{root}{kernel_file}", f"vmlinuz-{kver}")
 
     return hook
 
@@ -1997,7 +2502,6 @@ def get_packages_updates(
         packages_to_install += [next_kernel]
         hooks_to_run += [
             update_kernel_hook(next_kernel, mount_point),
-            update_initramfs_hook(next_kernel, mount_point),
         ]
 
     remove_pkg = (set(current_packages["packages"]) - set(next_packages["packages"])) | set(remove_packages)
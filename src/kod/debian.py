@@ -8,7 +8,7 @@ of the Arch module but uses Debian/Ubuntu specific tools and package managers.
 import re
 from kod.common import exec_chroot, exec
 import json
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 
 def prepare_for_installation() -> None:
@@ -66,6 +66,9 @@ def get_base_packages(conf: Any) -> Dict[str, Any]:
             "git",
         ],
     }
+    # Unified kernel images are built with ukify
+    if conf.boot and conf.boot.loader and conf.boot.loader.uki:
+        packages["base"] += ["systemd-ukify"]
     # TODO: remove this package dependency
     # packages["base"] += ["arch-install-scripts"]
     return packages
@@ -97,6 +100,44 @@ def install_essentials_pkgs(base_pkgs: Dict, mount_point: str):
     )
 
 
+# Debian
+def resolve_base_versions(base_pkgs: Dict) -> str:
+    """
+    Resolve the versions of the base packages.
+
+    The versions are taken from the apt package cache of the running system.
+
+    Args:
+        base_pkgs (Dict): A dictionary containing the packages to install,
+                          with 'kernel' and 'base' keys.
+
+    Returns:
+        str: One "name version" line per package, sorted, or an empty string if
+            the packages cannot be resolved.
+    """
+    packages = " ".join([base_pkgs["kernel"]] + base_pkgs["base"])
+    output = exec(f"apt-cache show --no-all-versions {packages}", get_output=True)
+    resolved = []
+    name = None
+    for line in output.splitlines():
+        if line.startswith("Package:"):
+            name = line.split(":", 1)[1].strip()
+        elif line.startswith("Version:") and name:
+            resolved.append(f"{name} {line.split(':', 1)[1].strip()}")
+    return "\n".join(sorted(resolved))
+
+
+# Debian
+def finalize_base_layer(mount_point: str):
+    """
+    Create the files of a restored base layer that are unique to each installation.
+
+    Args:
+        mount_point (str): The mount point of the root filesystem.
+    """
+    exec_chroot("systemd-machine-id-setup", mount_point=mount_point)
+
+
 # Debian
 def get_kernel_file(mount_point: str, package: str = "linux"):
     """
@@ -152,6 +193,24 @@ def get_list_of_dependencies(pkg: str):
     return pkgs_list
 
 
+# Debian
+def find_missing_packages(packages: List[str]) -> List[str]:
+    """
+    Find the packages that are not available in the apt package cache.
+
+    Args:
+        packages (list): The package names to check.
+
+    Returns:
+        list: The package names that are not available.
+    """
+    available = set(exec("apt-cache pkgnames", get_output=True).split())
+    if not available:
+        # The package cache is not available (or commands are not executed)
+        return []
+    return [pkg for pkg in packages if pkg not in available]
+
+
 # Debian
 def proc_repos(conf, current_repos=None, update=False, mount_point="/mnt"):
     """
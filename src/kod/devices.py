@@ -0,0 +1,182 @@
+"""Block device probing for KodOS.
+
+The facts KodOS needs about block devices (UUID, filesystem type, rotational
+flag and size) are read in a single pass from /dev/disk/by-uuid, sysfs, the udev
+database and the mount table, instead of running a command for each device. The
+result is cached until `invalidate_block_devices` is called, which must be done
+after the partitions are created or formatted.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+BY_UUID_PATH: str = "/dev/disk/by-uuid"
+SYS_BLOCK_PATH: str = "/sys/class/block"
+UDEV_DATA_PATH: str = "/run/udev/data"
+MOUNTINFO_PATH: str = "/proc/self/mountinfo"
+
+_block_devices: Optional[Dict[str, "BlockDevice"]] = None
+
+_octal_escape = re.compile(r"\\([0-7]{3})")
+
+
+@dataclass
+class BlockDevice:
+    """Facts about a block device.
+
+    Attributes:
+        path: Device path (e.g. /dev/sda1).
+        uuid: Filesystem UUID, or None if the device has no filesystem.
+        fs_type: Filesystem type, or None if unknown.
+        rotational: True for rotating disks, None if unknown.
+        size: Size in bytes, or None if unknown.
+    """
+
+    path: str
+    uuid: Optional[str] = None
+    fs_type: Optional[str] = None
+    rotational: Optional[bool] = None
+    size: Optional[int] = None
+
+
+def _unescape(value: str) -> str:
+    """Decode the octal escapes (\\ooo) used by the kernel for spaces, tabs, newlines and backslashes."""
+    return _octal_escape.sub(lambda match: chr(int(match.group(1), 8)), value)
+
+
+def read_mountinfo(mountinfo: str = MOUNTINFO_PATH) -> List[Dict[str, str]]:
+    """Read the mount table of the current process.
+
+    Args:
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        A list of mounts, in mount order, with the keys mount_id, parent_id, device
+        (major:minor), root, mount_point, options, fs_type, source and super_options.
+    """
+    mounts = []
+    if not Path(mountinfo).is_file():
+        return mounts
+    with open(mountinfo, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if "-" not in fields:
+                continue
+            separator = fields.index("-")
+            mounts.append(
+                {
+                    "mount_id": fields[0],
+                    "parent_id": fields[1],
+                    "device": fields[2],
+                    "root": _unescape(fields[3]),
+                    "mount_point": _unescape(fields[4]),
+                    "options": fields[5],
+                    "fs_type": fields[separator + 1],
+                    "source": _unescape(fields[separator + 2]),
+                    "super_options": fields[separator + 3] if len(fields) > separator + 3 else "",
+                }
+            )
+    return mounts
+
+
+def _read_udev_properties(path: Path) -> Dict[str, str]:
+    """Read the E: properties of a udev database entry."""
+    properties = {}
+    if path.is_file():
+        for line in path.read_text(errors="replace").splitlines():
+            if line.startswith("E:"):
+                key, _, value = line[2:].partition("=")
+                properties[key] = value
+    return properties
+
+
+def _read_int(path: Path) -> Optional[int]:
+    """Read an integer sysfs attribute, or None if it does not exist."""
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def probe_block_devices(
+    by_uuid: str = BY_UUID_PATH,
+    sys_block: str = SYS_BLOCK_PATH,
+    udev_data: str = UDEV_DATA_PATH,
+    mountinfo: str = MOUNTINFO_PATH,
+) -> Dict[str, BlockDevice]:
+    """Probe the block devices of the machine.
+
+    Args:
+        by_uuid: Directory of the UUID symlinks. Defaults to /dev/disk/by-uuid.
+        sys_block: sysfs directory of the block devices. Defaults to /sys/class/block.
+        udev_data: Directory of the udev database. Defaults to /run/udev/data.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        A dictionary mapping each device path to its facts.
+    """
+    devices: Dict[str, BlockDevice] = {}
+    sys_path = Path(sys_block)
+    if sys_path.is_dir():
+        for entry in sorted(sys_path.iterdir()):
+            device = BlockDevice(f"/dev/{entry.name}")
+            size = _read_int(entry / "size")
+            device.size = size * 512 if size is not None else None
+            # Partitions have no queue, it belongs to the parent disk
+            sys_device = entry.resolve()
+            queue = sys_device / "queue" if (sys_device / "queue").is_dir() else sys_device.parent / "queue"
+            rotational = _read_int(queue / "rotational")
+            device.rotational = bool(rotational) if rotational is not None else None
+            dev = (entry / "dev").read_text().strip() if (entry / "dev").is_file() else ""
+            properties = _read_udev_properties(Path(f"{udev_data}/b{dev}")) if dev else {}
+            device.uuid = properties.get("ID_FS_UUID") or None
+            device.fs_type = properties.get("ID_FS_TYPE") or None
+            devices[device.path] = device
+
+    uuid_path = Path(by_uuid)
+    if uuid_path.is_dir():
+        for link in uuid_path.iterdir():
+            path = os.path.realpath(link)
+            devices.setdefault(path, BlockDevice(path)).uuid = link.name
+
+    for mount in read_mountinfo(mountinfo):
+        device = devices.get(mount["source"])
+        if device and not device.fs_type:
+            device.fs_type = mount["fs_type"]
+    return devices
+
+
+def get_block_devices() -> Dict[str, BlockDevice]:
+    """Get the block devices of the machine, probing them on first use."""
+    global _block_devices
+    if _block_devices is None:
+        _block_devices = probe_block_devices()
+    return _block_devices
+
+
+def invalidate_block_devices() -> None:
+    """Forget the probed block devices, after partitions are created or formatted."""
+    global _block_devices
+    _block_devices = None
+
+
+def get_block_device(path: str) -> Optional[BlockDevice]:
+    """Get the facts about a block device.
+
+    Args:
+        path: Device path, symlinks such as /dev/mapper/* are resolved.
+
+    Returns:
+        The facts about the device, or None if it is not a known block device.
+    """
+    devices = get_block_devices()
+    return devices.get(path) or devices.get(os.path.realpath(path))
+
+
+def device_uuid(path: str) -> Optional[str]:
+    """Get the filesystem UUID of a block device, or None if it is unknown."""
+    device = get_block_device(path)
+    return device.uuid if device else None
@@ -0,0 +1,326 @@
+"""Store of the boot artifacts kept on the ESP.
+
+Kernels and initramfs images are shared by the boot entries of several
+generations. The store keeps a manifest on the ESP that records, for each
+artifact, its size, its digest and the generations whose boot entry uses it.
+Artifacts are copied atomically (written to a temporary file, synced and
+renamed), identical copies are skipped, and the free space of the ESP is checked
+before writing, pruning the unused artifacts first when it is not enough.
+
+Unified kernel images (UKI) of the generations are artifacts too. They are
+stored in EFI/Linux, where systemd-boot finds them without a loader entry, under
+a name with the generation, the kernel version and a key of their inputs.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+MANIFEST_FILE: str = "kodos/artifacts.json"
+
+# Space left free on the ESP, for the loader entries and the firmware
+ESP_RESERVED_SPACE: int = 4 * 1024**2
+
+# Space assumed for an initramfs image when no image exists yet
+DEFAULT_INITRAMFS_SIZE: int = 64 * 1024**2
+
+# Directory of the unified kernel images, relative to the ESP
+UKI_DIR: str = "EFI/Linux"
+
+_boot_file_pattern = re.compile(r"^(?:linux|initrd)\s+/?(\S+)$", re.MULTILINE)
+_uki_pattern = re.compile(r"^kodos-(\d+)-(.+)-([0-9a-f]{12})\.efi$")
+
+# Names of the kernels and initramfs images written by KodOS, which start with the kernel
+# version; the distribution ones (vmlinuz-linux, initramfs-linux-fallback.img) do not
+_kernel_pattern = re.compile(r"^vmlinuz-\d\S*$")
+_initramfs_pattern = re.compile(r"^initramfs-(?:linux-)?\d\S*\.img$")
+
+
+@dataclass
+class EspFullError(Exception):
+    """Raised when the ESP does not have enough free space for a boot artifact."""
+
+    path: str
+    required: int
+    free: int
+
+    def __post_init__(self):
+        super().__init__(
+            f"{self.path} has {self.free // 1024**2} MiB free, {self.required // 1024**2} MiB are required"
+        )
+
+
+def file_digest(path: str) -> str:
+    """Return the sha256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def referenced_boot_files(entries_path: str) -> Set[str]:
+    """Get the kernel and initramfs files used by the boot entries.
+
+    Args:
+        entries_path: Path to the loader entries directory.
+
+    Returns:
+        The file names, relative to the ESP, used by any boot entry.
+    """
+    files = set()
+    for entry in Path(entries_path).glob("*.conf"):
+        files.update(_boot_file_pattern.findall(entry.read_text()))
+    return files
+
+
+def uki_name(generation: int, kver: str, key: str) -> str:
+    """Get the path on the ESP of the unified kernel image of a generation.
+
+    Args:
+        generation: Generation number.
+        kver: Kernel version.
+        key: Key of the inputs of the image.
+
+    Returns:
+        The path of the image, relative to the ESP.
+    """
+    return f"{UKI_DIR}/kodos-{generation}-{kver}-{key[:12]}.efi"
+
+
+def generation_ukis(boot_path: str, generation: int) -> List[str]:
+    """Get the unified kernel images of a generation.
+
+    Args:
+        boot_path: Mount point of the ESP.
+        generation: Generation number.
+
+    Returns:
+        The paths of the images, relative to the ESP, newest first.
+    """
+    images = []
+    for path in Path(f"{boot_path}/{UKI_DIR}").glob(f"kodos-{generation}-*.efi"):
+        match = _uki_pattern.match(path.name)
+        if match and match.group(1) == str(generation):
+            images.append(path)
+    images.sort(key=lambda path: path.stat().st_mtime, reverse=True)
+    return [f"{UKI_DIR}/{path.name}" for path in images]
+
+
+def uki_kver(name: str) -> Optional[str]:
+    """Get the kernel version from the name of a unified kernel image, or None if it is not one."""
+    match = _uki_pattern.match(os.path.basename(name))
+    return match.group(2) if match else None
+
+
+class BootArtifactStore:
+    """Reference-counted store of the kernels and initramfs images on the ESP."""
+
+    def __init__(self, boot_path: str = "/boot") -> None:
+        """Initialize an empty store.
+
+        Args:
+            boot_path: Mount point of the ESP. Defaults to /boot.
+        """
+        self.boot_path = boot_path
+        self.path = f"{boot_path}/{MANIFEST_FILE}"
+        self.artifacts: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def load(cls, boot_path: str = "/boot") -> "BootArtifactStore":
+        """Load the manifest of the store.
+
+        Args:
+            boot_path: Mount point of the ESP. Defaults to /boot.
+
+        Returns:
+            The boot artifact store.
+        """
+        store = cls(boot_path)
+        if Path(store.path).is_file():
+            with open(store.path) as f:
+                store.artifacts = json.load(f)
+        return store
+
+    def save(self) -> None:
+        """Atomically write the manifest."""
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(self.artifacts, indent=2, sort_keys=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def free_space(self) -> int:
+        """Return the free space of the ESP in bytes."""
+        return shutil.disk_usage(self.boot_path).free
+
+    def ensure_free_space(self, required: int) -> None:
+        """Make sure the ESP can receive an artifact.
+
+        Unused artifacts are pruned when the free space is not enough.
+
+        Args:
+            required: Size of the artifact in bytes.
+
+        Raises:
+            EspFullError: If the ESP is still too small once pruned.
+        """
+        required += ESP_RESERVED_SPACE
+        if self.free_space() >= required:
+            return
+        self.prune()
+        free = self.free_space()
+        if free < required:
+            raise EspFullError(self.boot_path, required, free)
+
+    def add_file(self, source: str, name: str) -> str:
+        """Copy a file to the ESP as an artifact.
+
+        The copy is skipped when the ESP already holds an identical artifact. The
+        artifact is pending, and only pruned by `prune(include_pending=True)`, until
+        `reference` is called.
+
+        Args:
+            source: Path of the file to copy.
+            name: File name of the artifact on the ESP.
+
+        Returns:
+            The file name of the artifact.
+        """
+        digest = file_digest(source)
+        target = Path(f"{self.boot_path}/{name}")
+        known = self.artifacts.get(name)
+        current = known["sha256"] if known else None
+        if target.is_file() and (current or file_digest(str(target))) == digest:
+            print(f"Boot artifact {name} is up to date")
+            self.register(name, digest)
+            return name
+
+        size = os.path.getsize(source)
+        self.ensure_free_space(size)
+        tmp_path = f"{target}.tmp"
+        with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, target)
+        self.register(name, digest)
+        return name
+
+    def register(self, name: str, digest: Optional[str] = None) -> None:
+        """Record an artifact written to the ESP.
+
+        Args:
+            name: File name of the artifact on the ESP.
+            digest: sha256 digest of the artifact, computed if not provided.
+        """
+        path = f"{self.boot_path}/{name}"
+        entry = self.artifacts.setdefault(name, {"generations": [], "pending": True})
+        entry["sha256"] = digest or file_digest(path)
+        entry["size"] = os.path.getsize(path)
+        self.save()
+
+    def reference(self, generation: int, names: List[str]) -> None:
+        """Record that the boot entry of a generation uses some artifacts.
+
+        Args:
+            generation: Generation number.
+            names: File names of the artifacts.
+        """
+        for name in names:
+            entry = self.artifacts.get(name)
+            if entry is None:
+                if not Path(f"{self.boot_path}/{name}").is_file():
+                    continue
+                self.register(name)
+                entry = self.artifacts[name]
+            if generation not in entry["generations"]:
+                entry["generations"] = sorted(entry["generations"] + [generation])
+            entry["pending"] = False
+        self.save()
+
+    def release(self, generation: int) -> None:
+        """Record that the boot entry of a generation was removed.
+
+        Args:
+            generation: Generation number.
+        """
+        for entry in self.artifacts.values():
+            if generation in entry["generations"]:
+                entry["generations"].remove(generation)
+        self.save()
+
+    def unused(self, include_pending: bool = False) -> List[str]:
+        """Find the artifacts that no generation and no boot entry uses.
+
+        Kernels and initramfs images written before the store existed are not in
+        the manifest; they are unused when no boot entry refers to them. Only the
+        files named by KodOS are considered, so that the kernels and images the
+        package manager installs in /boot are left alone.
+
+        Args:
+            include_pending: If True, also return the artifacts written by a build
+                that did not create its boot entry yet. Defaults to False.
+
+        Returns:
+            The file names of the unused artifacts.
+        """
+        used = referenced_boot_files(f"{self.boot_path}/loader/entries")
+        candidates = {
+            name
+            for name, entry in self.artifacts.items()
+            if not entry["generations"] and (include_pending or not entry.get("pending"))
+        }
+        for pattern, name_pattern in [
+            ("vmlinuz-*", _kernel_pattern),
+            ("initramfs-*.img", _initramfs_pattern),
+            (f"{UKI_DIR}/kodos-*.efi", _uki_pattern),
+        ]:
+            for path in Path(self.boot_path).glob(pattern):
+                name = str(path.relative_to(self.boot_path))
+                if name not in self.artifacts and name_pattern.match(path.name):
+                    candidates.add(name)
+        return sorted(name for name in candidates if name not in used)
+
+    def prune(self, include_pending: bool = False) -> List[str]:
+        """Delete the unused artifacts.
+
+        Args:
+            include_pending: If True, also delete the artifacts written by a build
+                that did not create its boot entry. Only safe when no build runs.
+                Defaults to False.
+
+        Returns:
+            The file names of the deleted artifacts.
+        """
+        removed = self.unused(include_pending)
+        for name in removed:
+            Path(f"{self.boot_path}/{name}").unlink(missing_ok=True)
+            Path(f"{self.boot_path}/{name}.tmp").unlink(missing_ok=True)
+            self.artifacts.pop(name, None)
+        if removed:
+            print(f"Removed unused boot artifacts: {' '.join(removed)}")
+            self.save()
+        return removed
+
+    def remove(self, name: str) -> None:
+        """Delete an artifact, whatever generations use it.
+
+        Args:
+            name: File name of the artifact on the ESP.
+        """
+        Path(f"{self.boot_path}/{name}").unlink(missing_ok=True)
+        if self.artifacts.pop(name, None) is not None:
+            self.save()
+
+    def initramfs_size_estimate(self) -> int:
+        """Estimate the size of a new initramfs image from the existing ones."""
+        sizes = [path.stat().st_size for path in Path(self.boot_path).glob("initramfs-*.img")]
+        return max(sizes) if sizes else DEFAULT_INITRAMFS_SIZE
@@ -5,11 +5,34 @@ and mount point configuration. It includes support for various filesystem types
 and handles fstab entries for system mounting.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Tuple, Any
 
 from kod.common import exec, exec_critical, exec_warn
+from kod.devices import device_uuid, get_block_device, invalidate_block_devices
 ########################################################################################
 
+# Filesystem labels used by installations that are not bound to a device
+ROOT_LABEL: str = "KODOS_ROOT"
+BOOT_LABEL: str = "KODOS_BOOT"
+
+# Mount options of the btrfs subvolumes of the KodOS hierarchy, when the configuration sets none
+DEFAULT_BTRFS_OPTIONS: str = "rw,relatime,ssd,space_cache=v2"
+
+# Subvolumes of the KodOS hierarchy that can have their own mount options
+HIERARCHY_SUBVOLUMES: List[str] = ["rootfs", "kod", "home"]
+
+# Paths of the root filesystem kept as subvolumes of /kod/store and shared by every
+# generation, with their btrfs attributes: nodatacow disables copy-on-write (and
+# compression) for files rewritten in place, compress=false disables compression
+DEFAULT_STORE_PATHS: Dict[str, Dict[str, bool]] = {
+    "root": {},
+    "var/log": {"nodatacow": True},
+    "var/tmp": {"nodatacow": True},
+    "var/cache": {"compress": False},
+    "var/kod": {},
+}
+
 _filesystem_cmd: Dict[str, Optional[str]] = {
     "esp": "mkfs.vfat -F32",
     "fat32": "mkfs.vfat -F32",
@@ -29,6 +52,16 @@ _filesystem_cmd: Dict[str, Optional[str]] = {
     "noformat": None,
 }
 
+# Format options that skip the discard of the partition, for solid-state disks
+_nodiscard_options: Dict[str, str] = {
+    "btrfs": "--nodiscard",
+    "ext2": "-E nodiscard",
+    "ext3": "-E nodiscard",
+    "ext4": "-E nodiscard",
+    "xfs": "-K",
+    "f2fs": "-t 0",
+}
+
 _filesystem_type: Dict[str, Optional[str]] = {
     "esp": "ef00",
     # "vfat": "",
@@ -38,6 +71,18 @@ _filesystem_type: Dict[str, Optional[str]] = {
 }
 
 
+def is_supported_partition_type(filesystem_type: str) -> bool:
+    """Check whether partitions of the given type can be created.
+
+    Args:
+        filesystem_type: Partition type from the device configuration (e.g. 'esp', 'btrfs').
+
+    Returns:
+        True if both the partition type code and the format command are known.
+    """
+    return filesystem_type in _filesystem_type and filesystem_type in _filesystem_cmd
+
+
 # # fstab
 # source          destination     type    options         dump    pass
 # /proc           /proc           none    rw,bind         0       0
@@ -119,19 +164,59 @@ class FsEntry:
         """Get the UUID representation of the source device.
 
         If the source is a block device path (starts with /dev/), this method
-        attempts to retrieve its UUID and return it in UUID= format. Otherwise,
-        returns the original source value.
+        looks up its UUID in the probed block devices and returns it in UUID=
+        format. Otherwise, returns the original source value.
 
         Returns:
             UUID=<uuid> format string if device has UUID, otherwise the original source.
         """
         if self.source[:5] == "/dev/":
-            uuid = exec(f"lsblk -o UUID {self.source} | tail -n 1", get_output=True)
+            uuid = device_uuid(self.source)
             if uuid:
-                return f"UUID={uuid.strip()}"
+                return f"UUID={uuid}"
         return self.source
 
 
+def partition_device(device: str, number: Any) -> str:
+    """Get the device path of a partition.
+
+    Devices whose name ends with a digit (NVMe, MMC and loop devices) separate the
+    partition number with a "p" (e.g. /dev/nvme0n1p1, /dev/loop0p1).
+
+    Args:
+        device: Block device path (e.g. /dev/sda).
+        number: Partition number.
+
+    Returns:
+        The partition device path.
+    """
+    if "nvme" in device or "mmcblk" in device or "loop" in device:
+        return f"{device}p{number}"
+    return f"{device}{number}"
+
+
+def set_install_device(conf: Any, device: str) -> bool:
+    """Replace the device of the configuration with another one.
+
+    This is used to install the partition layout of the configuration on a device
+    that is not known in advance, such as the loop device of a disk image.
+
+    Args:
+        conf: Configuration object containing device specifications.
+        device: Block device path to use instead of the configured one.
+
+    Returns:
+        True if the device was replaced, False if the configuration does not have
+        exactly one device.
+    """
+    devices = conf["devices"]
+    disks = list(devices.keys()) if devices else []
+    if len(disks) != 1:
+        return False
+    devices[disks[0]]["device"] = device
+    return True
+
+
 def create_btrfs(delay_action: List[str], part: Any, blockdevice: str) -> List[str]:
     """Create BTRFS filesystem with subvolumes and mount configuration.
 
@@ -197,6 +282,11 @@ def create_partitions(conf: Any) -> Tuple[Optional[str], Optional[str], List[FsE
     partitions for each device. It identifies boot and root partitions
     and returns them along with a complete partition list.
 
+    The disks are wiped, partitioned and formatted in parallel, each one in the
+    order of its partitions. The btrfs subvolumes are then created and the
+    partitions mounted one disk at a time, starting with the disk of the root
+    partition, since the other disks are mounted inside it.
+
     Args:
         conf: Configuration object containing device specifications.
 
@@ -209,46 +299,67 @@ def create_partitions(conf: Any) -> Tuple[Optional[str], Optional[str], List[FsE
     print(f"{devices=}")
 
     print(f"{list(devices.keys())=}")
-    print("->>", devices.disk0)
+    disks = list(devices.values())
+    with ThreadPoolExecutor(max_workers=max(len(disks), 1)) as pool:
+        formatted_disks = list(pool.map(partition_disk, disks))
+
+    disk_plans = [plan_disk_mounts(formatted) for formatted in formatted_disks]
+    disk_plans.sort(key=lambda plan: plan[1] is None)
+
     boot_partition = None
     root_partition = None
     partition_list = []
-    for d_id, disk in devices.items():
-        print(d_id)
-        boot_part, root_part, part_list = create_disk_partitions(disk)
+    for boot_part, root_part, part_list, delay_action in disk_plans:
+        run_delay_actions(delay_action)
         partition_list += part_list
         if boot_part:
             boot_partition = boot_part
         if root_part:
             root_partition = root_part
+    # The new filesystems have new UUIDs
+    exec_warn("udevadm settle", "Failed to wait for the new partitions")
+    invalidate_block_devices()
     return boot_partition, root_partition, partition_list
 
 
-def create_disk_partitions(disk_info: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], List[FsEntry]]:
-    """Create partitions on a single disk device.
+def format_command(filesystem_type: str, blockdevice: str, rotational: Optional[bool] = None) -> Optional[str]:
+    """Get the command that formats a partition.
 
-    This function handles the creation of partitions on a single disk according
-    to the disk configuration. It wipes the existing partition table, creates
-    new partitions with specified filesystems, and sets up mount points.
+    Partitions of a new partition table on a solid-state disk hold no data, so the
+    discard of the whole partition that mkfs does by default is skipped, which can
+    take minutes on some NVMe devices.
+
+    Args:
+        filesystem_type: Partition type from the device configuration (e.g. 'esp', 'btrfs').
+        blockdevice: Partition device path.
+        rotational: Rotational flag of the disk, as probed. Defaults to None (unknown).
+
+    Returns:
+        The format command, or None if the partition is not formatted.
+    """
+    cmd = _filesystem_cmd.get(filesystem_type)
+    if not cmd:
+        return None
+    if rotational is False and filesystem_type in _nodiscard_options:
+        cmd = f"{cmd} {_nodiscard_options[filesystem_type]}"
+    return f"{cmd} {blockdevice}"
+
+
+def partition_disk(disk_info: Dict[str, Any]) -> List[Tuple[Any, str]]:
+    """Wipe a disk, create its partitions and format them.
 
     Args:
         disk_info: Dictionary containing device path and partition specifications.
                   Expected keys: 'device', 'partitions'
 
     Returns:
-        Tuple containing (boot_partition, root_partition, partitions_list) where
-        boot_partition and root_partition are device paths or None,
-        and partitions_list contains FsEntry objects for created partitions.
+        A list of (partition configuration, partition device path) tuples, in the
+        order of the partitions.
     """
     device = disk_info["device"]
     # efi = disk_info['efi']
     partitions = disk_info["partitions"]
 
-    if "nvme" in device or "mmcblk" in device:
-        device_sufix = "p"
-    else:
-        device_sufix = ""
-
     # Delete partition table
     exec_critical(f"wipefs -a {device}", f"Failed to wipe partition table on {device}")
     exec_critical("sync", "Failed to sync after wiping partition table")
@@ -259,23 +370,16 @@ def create_disk_partitions(disk_info: Dict[str, Any]) -> Tuple[Optional[str], Op
 
     print(f"{partitions=}")
     if not partitions:
-        return None, None, []
+        return []
 
-    delay_action = []
-    boot_partition = None
-    root_partition = None
-    partitions_list = []
+    disk = get_block_device(device)
+    rotational = disk.rotational if disk else None
+    formatted = []
     for pid, part in partitions.items():
         name = part["name"]
         size = part["size"]
         filesystem_type = part["type"]
-        mountpoint = part["mountpoint"]
-        blockdevice = f"{device}{device_sufix}{pid}"
-
-        if name.lower() == "boot":
-            boot_partition = blockdevice
-        elif name.lower() == "root":
-            root_partition = blockdevice
+        blockdevice = partition_device(device, pid)
 
         end = 0 if size == "100%" else f"+{size}"
         partition_type = _filesystem_type[filesystem_type]
@@ -286,14 +390,47 @@ def create_disk_partitions(disk_info: Dict[str, Any]) -> Tuple[Optional[str], Op
         )
 
         # Format filesystem
-        if filesystem_type in _filesystem_cmd.keys():
-            cmd = _filesystem_cmd[filesystem_type]
-            if cmd:
-                exec_critical(f"{cmd} {blockdevice}", f"Failed to format {blockdevice} as {filesystem_type}")
+        cmd = format_command(filesystem_type, blockdevice, rotational)
+        if cmd:
+            exec_critical(cmd, f"Failed to format {blockdevice} as {filesystem_type}")
+        formatted.append((part, blockdevice))
+    return formatted
+
+
+def plan_disk_mounts(
+    formatted: List[Tuple[Any, str]],
+) -> Tuple[Optional[str], Optional[str], List[FsEntry], List[str]]:
+    """Create the btrfs subvolumes of a formatted disk and plan its mounts.
+
+    Args:
+        formatted: The partitions returned by `partition_disk`.
+
+    Returns:
+        Tuple containing (boot_partition, root_partition, partitions_list, delay_action)
+        where boot_partition and root_partition are device paths or None,
+        partitions_list contains FsEntry objects for the partitions and
+        delay_action the commands that mount them, root first.
+    """
+    delay_action = []
+    boot_partition = None
+    root_partition = None
+    partitions_list = []
+    for part, blockdevice in formatted:
+        name = part["name"]
+        filesystem_type = part["type"]
+        mountpoint = part["mountpoint"]
+
+        if name.lower() == "boot":
+            boot_partition = blockdevice
+        elif name.lower() == "root":
+            root_partition = blockdevice
 
         if filesystem_type == "btrfs":
             delay_action = create_btrfs(delay_action, part, blockdevice)
 
+        if filesystem_type == "linux-swap":
+            partitions_list.append(FsEntry(blockdevice, "none", "swap", "defaults", 0, 0))
+
         if mountpoint and mountpoint != "none":
             install_mountpoint = "/mnt" + mountpoint
             if mountpoint != "/":
@@ -309,16 +446,116 @@ def create_disk_partitions(disk_info: Dict[str, Any]) -> Tuple[Optional[str], Op
                 ] + delay_action
                 partitions_list.append(FsEntry(blockdevice, mountpoint, filesystem_type, "defaults", 0, 0))
             print("====>", blockdevice, mountpoint)
+    return boot_partition, root_partition, partitions_list, delay_action
 
+
+def run_delay_actions(delay_action: List[str]) -> None:
+    """Run the mount commands planned by `plan_disk_mounts`, in order."""
     print("=======================")
-    if delay_action:
-        for cmd_action in delay_action:
-            exec(cmd_action)
+    for cmd_action in delay_action:
+        exec(cmd_action)
     print("=======================")
 
+
+def create_disk_partitions(disk_info: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], List[FsEntry]]:
+    """Create partitions on a single disk device.
+
+    This function handles the creation of partitions on a single disk according
+    to the disk configuration. It wipes the existing partition table, creates
+    new partitions with specified filesystems, and sets up mount points.
+
+    Args:
+        disk_info: Dictionary containing device path and partition specifications.
+                  Expected keys: 'device', 'partitions'
+
+    Returns:
+        Tuple containing (boot_partition, root_partition, partitions_list) where
+        boot_partition and root_partition are device paths or None,
+        and partitions_list contains FsEntry objects for created partitions.
+    """
+    boot_partition, root_partition, partitions_list, delay_action = plan_disk_mounts(partition_disk(disk_info))
+    run_delay_actions(delay_action)
     return boot_partition, root_partition, partitions_list
 
 
+def clean_mount_options(options: str) -> str:
+    """Remove the subvolume selection from mount options, since KodOS sets it."""
+    kept = [opt.strip() for opt in options.split(",") if opt.strip()]
+    return ",".join(opt for opt in kept if not opt.startswith(("subvol=", "subvolid=")))
+
+
+def get_btrfs_options(conf: Any) -> Dict[str, str]:
+    """Get the mount options of the btrfs subvolumes of the KodOS hierarchy.
+
+    The options come from the `mountOptions` of the root partition, and can be
+    overridden for each subvolume of the hierarchy (rootfs, kod and home) with its
+    `subvolumeOptions` table, e.g.:
+
+        mountOptions = "rw,noatime,compress=zstd:1,discard=async,space_cache=v2",
+        subvolumeOptions = { home = "rw,noatime,compress=zstd:3,autodefrag" },
+
+    Btrfs applies the filesystem-wide options (compress, discard, autodefrag,
+    space_cache) from the first subvolume mounted, the root filesystem, while
+    options such as noatime apply to each mount.
+
+    Args:
+        conf: Configuration object containing device specifications.
+
+    Returns:
+        A dictionary mapping each hierarchy subvolume to its mount options.
+    """
+    options = {subvol: DEFAULT_BTRFS_OPTIONS for subvol in HIERARCHY_SUBVOLUMES}
+    devices = conf.devices
+    if not devices:
+        return options
+    for disk in devices.values():
+        partitions = disk["partitions"]
+        if not partitions:
+            continue
+        for part in partitions.values():
+            if part["name"].lower() != "root" or part["type"] != "btrfs":
+                continue
+            if part["mountOptions"]:
+                options = {subvol: clean_mount_options(part["mountOptions"]) for subvol in HIERARCHY_SUBVOLUMES}
+            if part["subvolumeOptions"]:
+                for subvol, subvol_options in part["subvolumeOptions"].items():
+                    if subvol in options:
+                        options[subvol] = clean_mount_options(subvol_options)
+    return options
+
+
+def get_store_paths(conf: Any) -> Dict[str, Dict[str, bool]]:
+    """Get the store paths shared by the generations and their btrfs attributes.
+
+    The `storePaths` table of the root partition adds paths to the defaults, or
+    changes their attributes, e.g.:
+
+        storePaths = {
+            ["var/lib/libvirt/images"] = { nodatacow = true },
+            ["var/lib/postgres"] = { nodatacow = true },
+            ["var/log"] = { nodatacow = false },
+        },
+
+    Args:
+        conf: Configuration object containing device specifications.
+
+    Returns:
+        A dictionary mapping each store path, relative to the root filesystem and
+        parents first, to its attributes (nodatacow, compress).
+    """
+    store_paths = {path: dict(attributes) for path, attributes in DEFAULT_STORE_PATHS.items()}
+    devices = conf.devices
+    for disk in devices.values() if devices else []:
+        partitions = disk["partitions"]
+        for part in partitions.values() if partitions else []:
+            if part["name"].lower() != "root" or not part["storePaths"]:
+                continue
+            for path, attributes in part["storePaths"].items():
+                path = str(path).strip("/")
+                store_paths[path] = {key: bool(value) for key, value in attributes.items()} if attributes else {}
+    return dict(sorted(store_paths.items()))
+
+
 def get_partition_devices(conf: Any) -> Tuple[Optional[str], Optional[str]]:
     """Get boot and root partition device paths from configuration.
 
@@ -339,14 +576,9 @@ def get_partition_devices(conf: Any) -> Tuple[Optional[str], Optional[str]]:
         device = disk["device"]
         partitions = disk["partitions"]
 
-        if "nvme" in device or "mmcblk" in device:
-            device_sufix = "p"
-        else:
-            device_sufix = ""
-
         for pid, part in partitions.items():
             name = part["name"]
-            blockdevice = f"{device}{device_sufix}{pid}"
+            blockdevice = partition_device(device, pid)
 
             if name.lower() == "boot":
                 boot_partition = blockdevice
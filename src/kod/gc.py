@@ -0,0 +1,267 @@
+"""Garbage collection of old KodOS generations.
+
+This module selects the generations to keep according to retention policies
+(last N, one per day, one per week, pinned, current, booted and default boot
+generations), and deletes the others: their btrfs subvolumes in a single
+batched delete that runs in the background at low I/O priority, their boot
+entries, and the kernels and initramfs images on the ESP that no boot entry
+uses anymore.
+"""
+
+import re
+import shlex
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from kod.common import exec
+from kod.esp import BootArtifactStore
+from kod.generations import GENERATIONS_PATH
+
+# Default retention policies
+DEFAULT_KEEP_LAST: int = 5
+DEFAULT_KEEP_DAILY: int = 7
+DEFAULT_KEEP_WEEKLY: int = 4
+
+_booted_pattern = re.compile(r"rootflags=\S*subvol=/?generations/(\d+)/rootfs")
+_entry_pattern = re.compile(r"^kodos-(\d+)(?:\.conf|-.+\.efi)$")
+
+# systemd-boot EFI variable with the entry to boot once, set by `bootctl set-oneshot`
+ONESHOT_EFIVAR: str = "/sys/firmware/efi/efivars/LoaderEntryOneShot-4a67b082-0a4c-41cf-b6c7-440b29bb8c4f"
+
+
+def parse_booted_generation(cmdline: str) -> Optional[int]:
+    """Get the generation booted with a kernel command line.
+
+    Args:
+        cmdline: Kernel command line, as found in /proc/cmdline.
+
+    Returns:
+        The generation number, or None if the root is not a generation subvolume.
+    """
+    match = _booted_pattern.search(cmdline)
+    return int(match.group(1)) if match else None
+
+
+def get_booted_generation() -> Optional[int]:
+    """Get the generation the system was booted with."""
+    cmdline = Path("/proc/cmdline")
+    return parse_booted_generation(cmdline.read_text()) if cmdline.is_file() else None
+
+
+def parse_entry_generation(entry: str) -> Optional[int]:
+    """Get the generation of a systemd-boot entry id.
+
+    Args:
+        entry: Id of the entry: a loader entry (kodos-3.conf) or a unified kernel image.
+
+    Returns:
+        The generation number, or None if the entry is not a KodOS generation.
+    """
+    match = _entry_pattern.match(entry.strip())
+    return int(match.group(1)) if match else None
+
+
+def get_default_generations(boot_path: str = "/boot", oneshot_efivar: str = ONESHOT_EFIVAR) -> Set[int]:
+    """Get the generations selected for the next boot.
+
+    `kod rollback` makes a generation the default entry of loader.conf, or the
+    one-shot entry, before the system is rebooted into it.
+
+    Args:
+        boot_path: Mount point of the ESP. Defaults to /boot.
+        oneshot_efivar: Path of the one-shot entry EFI variable.
+
+    Returns:
+        The generations of the default and one-shot entries.
+    """
+    entries = []
+    loader_conf = Path(f"{boot_path}/loader/loader.conf")
+    if loader_conf.is_file():
+        for line in loader_conf.read_text().splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == "default":
+                entries.append(fields[1])
+    efivar = Path(oneshot_efivar)
+    if efivar.is_file():
+        # 4 bytes of attributes, then the NUL-terminated UTF-16 entry id
+        entries.append(efivar.read_bytes()[4:].decode("utf-16-le", errors="ignore").rstrip("\0"))
+    generations = {parse_entry_generation(entry) for entry in entries}
+    return {generation for generation in generations if generation is not None}
+
+
+def _period_keys(entries: List[Dict[str, Any]], period: str) -> Dict[str, int]:
+    """Map each day or ISO week to its newest generation."""
+    newest: Dict[str, int] = {}
+    for entry in entries:
+        timestamp = datetime.fromisoformat(entry["timestamp"])
+        if period == "day":
+            key = timestamp.strftime("%Y-%m-%d")
+        else:
+            year, week, _ = timestamp.isocalendar()
+            key = f"{year}-W{week:02d}"
+        if key not in newest or entry["id"] > newest[key]:
+            newest[key] = entry["id"]
+    return newest
+
+
+def select_generations_to_keep(
+    entries: List[Dict[str, Any]],
+    keep_last: int = DEFAULT_KEEP_LAST,
+    keep_daily: int = DEFAULT_KEEP_DAILY,
+    keep_weekly: int = DEFAULT_KEEP_WEEKLY,
+    protected: Optional[Set[int]] = None,
+) -> Dict[int, List[str]]:
+    """Apply the retention policies to the generations.
+
+    The newest generation is always kept, so that generation numbers are never
+    reused while an older one is being deleted. Generations that are not complete
+    are kept, since they may belong to a rebuild that can be resumed.
+
+    Args:
+        entries: Generation index entries.
+        keep_last: Number of most recent generations to keep.
+        keep_daily: Number of days for which the newest generation is kept.
+        keep_weekly: Number of weeks for which the newest generation is kept.
+        protected: Generations that must be kept (e.g. current and booted).
+
+    Returns:
+        A dictionary mapping each generation to keep to the reasons it is kept.
+    """
+    keep: Dict[int, List[str]] = {}
+
+    def mark(generation: int, reason: str) -> None:
+        keep.setdefault(generation, []).append(reason)
+
+    complete = sorted((entry for entry in entries if entry["status"] == "complete"), key=lambda e: e["id"])
+    for entry in entries:
+        if entry["status"] != "complete":
+            mark(entry["id"], entry["status"])
+        if entry.get("pinned"):
+            mark(entry["id"], "pinned")
+    for generation in sorted(protected or []):
+        mark(generation, "protected")
+    if entries:
+        mark(max(entry["id"] for entry in entries), "newest")
+
+    for entry in complete[-keep_last:] if keep_last > 0 else []:
+        mark(entry["id"], "last")
+    for period, count in [("day", keep_daily), ("week", keep_weekly)]:
+        newest = _period_keys(complete, period)
+        for key in sorted(newest, reverse=True)[:count] if count > 0 else []:
+            mark(newest[key], period)
+    return keep
+
+
+def find_orphaned_boot_files(boot_path: str = "/boot") -> List[str]:
+    """Find kernels and initramfs images on the ESP that no generation uses.
+
+    Args:
+        boot_path: Mount point of the ESP. Defaults to /boot.
+
+    Returns:
+        Paths of the orphaned files.
+    """
+    return [f"{boot_path}/{name}" for name in BootArtifactStore.load(boot_path).unused(include_pending=True)]
+
+
+def delete_subvolumes(paths: List[str], directories: List[str], background: bool = True) -> None:
+    """Delete btrfs subvolumes with a single batched command.
+
+    The subvolumes are deleted with one `btrfs subvolume delete --commit-after`
+    call, so that the transaction is committed once for the whole batch. The
+    directories are removed afterwards. In background mode the command is detached
+    and runs with idle I/O priority and the lowest CPU priority.
+
+    Args:
+        paths: Subvolumes to delete.
+        directories: Directories to remove once the subvolumes are deleted.
+        background: If True, do not wait for the deletion to finish. Defaults to True.
+    """
+    if not paths and not directories:
+        return
+    commands = []
+    if paths:
+        commands.append(f"btrfs subvolume delete --commit-after {' '.join(paths)}")
+    if directories:
+        commands.append(f"rm -rf {' '.join(directories)}")
+    script = shlex.quote(" && ".join(commands))
+    if background:
+        exec(f"setsid -f ionice -c 3 nice -n 19 sh -c {script} > /dev/null 2>&1")
+    else:
+        exec(f"ionice -c 3 nice -n 19 sh -c {script}")
+
+
+def failed_rootfs_is_mounted() -> bool:
+    """Check whether the root kept by a rebuild rollback is still in use."""
+    with open("/proc/self/mountinfo") as f:
+        return any(line.split()[3].endswith("/current/failed-rootfs") for line in f)
+
+
+def collect_garbage(
+    index: Any,
+    keep_last: int = DEFAULT_KEEP_LAST,
+    keep_daily: int = DEFAULT_KEEP_DAILY,
+    keep_weekly: int = DEFAULT_KEEP_WEEKLY,
+    dry_run: bool = False,
+    background: bool = True,
+) -> List[int]:
+    """Delete the generations that are not kept by the retention policies.
+
+    Args:
+        index: The generation index.
+        keep_last: Number of most recent generations to keep.
+        keep_daily: Number of days for which the newest generation is kept.
+        keep_weekly: Number of weeks for which the newest generation is kept.
+        dry_run: If True, only report what would be deleted. Defaults to False.
+        background: If True, delete the subvolumes in the background. Defaults to True.
+
+    Returns:
+        The generations deleted (or that would be deleted in dry-run mode).
+    """
+    protected = set()
+    current_file = Path("/.generation")
+    if current_file.is_file():
+        protected.add(int(current_file.read_text().strip()))
+    booted = get_booted_generation()
+    if booted is not None:
+        protected.add(booted)
+    # A rolled back generation is the default entry before the system is rebooted into it
+    protected |= get_default_generations()
+
+    entries = index.generations()
+    keep = select_generations_to_keep(entries, keep_last, keep_daily, keep_weekly, protected)
+    to_delete = [entry["id"] for entry in entries if entry["id"] not in keep]
+
+    print("==== Generation garbage collection ====")
+    for entry in entries:
+        if entry["id"] in keep:
+            print(f"  keep   {entry['id']:>4} ({', '.join(keep[entry['id']])})")
+        else:
+            print(f"  delete {entry['id']:>4}")
+    if dry_run:
+        return to_delete
+
+    store = BootArtifactStore.load()
+    subvolumes = []
+    directories = []
+    for generation in to_delete:
+        generation_path = f"{GENERATIONS_PATH}/{generation}"
+        if Path(f"{generation_path}/rootfs").exists():
+            subvolumes.append(f"{generation_path}/rootfs")
+        directories.append(generation_path)
+        exec(f"rm -f /boot/loader/entries/kodos-{generation}.conf")
+        store.release(generation)
+        index.remove(generation)
+
+    failed_rootfs = "/kod/current/failed-rootfs"
+    if Path(failed_rootfs).exists() and not failed_rootfs_is_mounted():
+        subvolumes.append(failed_rootfs)
+
+    # No build is running (checked by the caller), so pending artifacts are leftovers of failed builds
+    store.prune(include_pending=True)
+
+    delete_subvolumes(subvolumes, directories, background=background)
+    if background and subvolumes:
+        print("Subvolumes are being deleted in the background")
+    return to_delete
@@ -0,0 +1,534 @@
+"""Generation state tracking for KodOS.
+
+This module keeps track of the information stored with each generation under
+/kod/generations. It computes a hash for every configuration section so that a
+rebuild can decide which stages need to run again, and reports the decisions
+that were taken. It also maintains the generation index, which stores the
+metadata of every generation in a single file.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from kod.esp import generation_ukis, uki_kver
+
+# Configuration sections tracked per generation
+CONFIG_SECTIONS: List[str] = [
+    "repos",
+    "boot",
+    "packages",
+    "services",
+    "locale",
+    "network",
+    "filesystems",
+    "tuning",
+    "memory",
+]
+
+
+def lua_to_python(value: Any) -> Any:
+    """Convert a Lua configuration value into plain Python data.
+
+    Lua tables are converted into dictionaries, or into lists when their keys are
+    consecutive integers starting at 1. Lua functions cannot be serialized, so they
+    are replaced by a marker.
+
+    Args:
+        value: Lua table, Lua function or plain value.
+
+    Returns:
+        The equivalent value built from dicts, lists and scalars.
+    """
+    if hasattr(value, "items"):
+        items = {key: lua_to_python(val) for key, val in value.items()}
+        keys = list(items.keys())
+        if keys and all(isinstance(key, int) for key in keys) and sorted(keys) == list(range(1, len(keys) + 1)):
+            return [items[key] for key in sorted(keys)]
+        return {str(key): val for key, val in items.items()}
+    if callable(value):
+        return "<function>"
+    return value
+
+
+def hash_value(value: Any) -> str:
+    """Compute a stable hash for a configuration value.
+
+    Args:
+        value: Value to hash. Lua tables are converted with `lua_to_python`.
+
+    Returns:
+        The hex encoded sha256 digest of the value.
+    """
+    data = json.dumps(lua_to_python(value), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def normalize_packages(packages: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the package description with its package lists sorted.
+
+    Args:
+        packages: Dictionary with the "kernel", "base" and "packages" entries.
+
+    Returns:
+        A copy of the dictionary where every list is sorted.
+    """
+    if not packages:
+        return {}
+    return {key: sorted(val) if isinstance(val, list) else val for key, val in packages.items()}
+
+
+def compute_config_hashes(conf: Any, packages_to_install: Dict[str, Any]) -> Dict[str, str]:
+    """Compute the hash of each configuration section used by a rebuild.
+
+    The packages section is hashed from the resolved package set, since user
+    programs, hardware, desktop and fonts all contribute to it.
+
+    Args:
+        conf: The configuration table.
+        packages_to_install: The resolved packages as returned by `get_packages_to_install`.
+
+    Returns:
+        A dictionary mapping each section name to its hash.
+    """
+    return {
+        "repos": hash_value(conf.repos),
+        "boot": hash_value(conf.boot),
+        "packages": hash_value(normalize_packages(packages_to_install)),
+        "services": hash_value({"services": conf.services, "desktop": conf.desktop}),
+        "locale": hash_value(conf.locale),
+        "network": hash_value(conf.network),
+        "filesystems": hash_value(conf.devices),
+        "tuning": hash_value(conf.tuning),
+        "memory": hash_value(conf.memory),
+    }
+
+
+def store_config_hashes(state_path: str, hashes: Dict[str, str]) -> None:
+    """Store the configuration section hashes of a generation.
+
+    Args:
+        state_path: Path to the generation state directory.
+        hashes: Dictionary mapping section names to hashes.
+    """
+    with open(f"{state_path}/config_hashes", "w") as f:
+        f.write(json.dumps(hashes, indent=2, sort_keys=True))
+
+
+def load_config_hashes(state_path: str) -> Dict[str, str]:
+    """Load the configuration section hashes of a generation.
+
+    Args:
+        state_path: Path to the generation state directory.
+
+    Returns:
+        Dictionary mapping section names to hashes. Empty if the generation was
+        created before hashes were stored.
+    """
+    hashes_file = Path(f"{state_path}/config_hashes")
+    if not hashes_file.is_file():
+        return {}
+    with open(hashes_file) as f:
+        return json.load(f)
+
+
+def get_generation_kver(generation: int, mount_point: str = "") -> Optional[str]:
+    """Get the kernel version used by the boot entry of a generation.
+
+    Args:
+        generation: Generation number.
+        mount_point: Root path where /boot is mounted. Defaults to "".
+
+    Returns:
+        The kernel version, or None if the boot entry and the unified kernel image are missing.
+    """
+    entry = Path(f"{mount_point}/boot/loader/entries/kodos-{generation}.conf")
+    if not entry.is_file():
+        images = generation_ukis(f"{mount_point}/boot", generation)
+        return uki_kver(images[0]) if images else None
+    match = re.search(r"^linux\s+\S*vmlinuz-(\S+)$", entry.read_text(), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def get_generation_initrd(generation: int, mount_point: str = "") -> Optional[str]:
+    """Get the initramfs image used by the boot entry of a generation.
+
+    Args:
+        generation: Generation number.
+        mount_point: Root path where /boot is mounted. Defaults to "".
+
+    Returns:
+        The file name of the image on the ESP, or None if the boot entry is missing.
+    """
+    entry = Path(f"{mount_point}/boot/loader/entries/kodos-{generation}.conf")
+    if not entry.is_file():
+        return None
+    match = re.search(r"^initrd\s+/?(\S+)$", entry.read_text(), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+class RebuildPlan:
+    """Decide which rebuild stages must run and keep track of the reasons.
+
+    A stage runs when the hash of its configuration section differs from the one
+    stored in the current generation, when no hash was stored, or when the system
+    state it depends on requires it. Otherwise the stage is skipped.
+    """
+
+    def __init__(self, current_hashes: Dict[str, str], next_hashes: Dict[str, str], force: bool = False) -> None:
+        """Initialize the plan.
+
+        Args:
+            current_hashes: Section hashes stored in the current generation.
+            next_hashes: Section hashes computed from the configuration to apply.
+            force: If True, every stage runs. Defaults to False.
+        """
+        self.current_hashes = current_hashes
+        self.next_hashes = next_hashes
+        self.force = force
+        self.decisions: List[Tuple[str, bool, str]] = []
+
+    def changed(self, section: str) -> bool:
+        """Check whether a configuration section changed.
+
+        Args:
+            section: Configuration section name.
+
+        Returns:
+            True if the section hash differs or is missing.
+        """
+        if section not in self.current_hashes:
+            return True
+        return self.current_hashes[section] != self.next_hashes.get(section)
+
+    def unchanged(self) -> bool:
+        """Check whether every tracked configuration section is unchanged.
+
+        Returns:
+            True if all the section hashes match the current generation.
+        """
+        return not self.force and not any(self.changed(section) for section in CONFIG_SECTIONS)
+
+    def is_noop(self, current_packages: Optional[Dict[str, Any]], next_packages: Dict[str, Any]) -> bool:
+        """Check whether a rebuild would produce the same system as the current generation.
+
+        Args:
+            current_packages: Packages stored in the current generation.
+            next_packages: Packages resolved from the configuration to apply.
+
+        Returns:
+            True if the configuration and the resolved package set are unchanged.
+        """
+        return self.unchanged() and normalize_packages(current_packages) == normalize_packages(next_packages)
+
+    def decide(self, stage: str, section: str, state_ok: bool = True, state_reason: str = "") -> bool:
+        """Decide if a stage must run and record the decision.
+
+        Args:
+            stage: Name of the stage.
+            section: Configuration section the stage depends on.
+            state_ok: False if the system state requires the stage to run. Defaults to True.
+            state_reason: Reason reported when `state_ok` is False.
+
+        Returns:
+            True if the stage must run.
+        """
+        if self.force:
+            run, reason = True, "forced"
+        elif section not in self.current_hashes:
+            run, reason = True, f"no stored hash for {section}"
+        elif self.changed(section):
+            run, reason = True, f"{section} configuration changed"
+        elif not state_ok:
+            run, reason = True, state_reason
+        else:
+            run, reason = False, f"{section} unchanged"
+        self.record(stage, run, reason)
+        return run
+
+    def record(self, stage: str, ran: bool, reason: str) -> None:
+        """Record a stage that is not controlled by a configuration hash.
+
+        Args:
+            stage: Name of the stage.
+            ran: Whether the stage ran.
+            reason: Why the stage ran or was skipped.
+        """
+        self.decisions.append((stage, ran, reason))
+
+    def report(self) -> None:
+        """Print which stages ran and why."""
+        print("==== Rebuild stages ====")
+        for stage, ran, reason in self.decisions:
+            status = "ran" if ran else "skipped"
+            print(f"  {stage:<12} {status:<8} ({reason})")
+
+
+# Location of the generations and of their index
+GENERATIONS_PATH: str = "/kod/generations"
+INDEX_FILE: str = "index.json"
+INDEX_LOCK_FILE: str = "index.lock"
+
+
+def new_generation_entry(
+    generation: int,
+    parent: Optional[int],
+    config_hash: str = "",
+    kver: Optional[str] = None,
+    packages: int = 0,
+    status: str = "building",
+) -> Dict[str, Any]:
+    """Create the index entry of a generation.
+
+    Args:
+        generation: Generation number.
+        parent: Generation the new generation was built from, or None for the first one.
+        config_hash: Hash of the configuration used to build the generation.
+        kver: Kernel version used by the generation.
+        packages: Number of packages requested by the configuration.
+        status: Build status ("building" or "complete"). Defaults to "building".
+
+    Returns:
+        The index entry.
+    """
+    return {
+        "id": generation,
+        "parent": parent,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "kver": kver,
+        "config_hash": config_hash,
+        "packages": packages,
+        "duration": None,
+        "status": status,
+    }
+
+
+def count_packages(packages: Optional[Dict[str, Any]]) -> int:
+    """Count the packages of a resolved package set.
+
+    Args:
+        packages: Dictionary with the "kernel", "base" and "packages" entries.
+
+    Returns:
+        The number of packages, including the kernel.
+    """
+    if not packages:
+        return 0
+    count = 1 if packages.get("kernel") else 0
+    return count + len(packages.get("base", [])) + len(packages.get("packages", []))
+
+
+class GenerationIndex:
+    """Index of the generations stored under /kod/generations.
+
+    The index keeps the metadata of every generation in a single JSON file, so
+    that listing and selecting generations does not scan the generation
+    directories. The file is replaced atomically on every change. Changes are
+    made under a lock on the index, on its current content, so that builds
+    running at the same time (e.g. a rebuild and an import) do not allocate the
+    same generation number or lose each other's entries.
+    """
+
+    def __init__(self, generations_path: str = GENERATIONS_PATH) -> None:
+        """Initialize an empty index.
+
+        Args:
+            generations_path: Path of the generations directory. Defaults to /kod/generations.
+        """
+        self.generations_path = generations_path
+        self.path = f"{generations_path}/{INDEX_FILE}"
+        self.entries: Dict[int, Dict[str, Any]] = {}
+
+    @classmethod
+    def load(cls, generations_path: str = GENERATIONS_PATH) -> "GenerationIndex":
+        """Load the index of the generations.
+
+        Systems installed before the index existed have no index file. In that
+        case the index is built once from the generation directories and stored.
+
+        Args:
+            generations_path: Path of the generations directory. Defaults to /kod/generations.
+
+        Returns:
+            The generation index.
+        """
+        index = cls(generations_path)
+        if Path(index.path).is_file():
+            index.read()
+        elif Path(generations_path).is_dir():
+            index.scan()
+            index.save()
+        return index
+
+    def read(self) -> None:
+        """Read the entries from the index file, if it exists."""
+        if Path(self.path).is_file():
+            with open(self.path) as f:
+                self.entries = {int(key): entry for key, entry in json.load(f).items()}
+
+    @contextmanager
+    def locked(self) -> Iterator["GenerationIndex"]:
+        """Lock the index file and read its current entries.
+
+        Changes made while the lock is held must be stored with `save`.
+
+        Yields:
+            The index, with the entries of the index file.
+        """
+        with open(f"{self.generations_path}/{INDEX_LOCK_FILE}", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.read()
+            yield self
+
+    def scan(self) -> None:
+        """Build the index from the generation directories."""
+        mount_point = str(Path(self.generations_path).parents[1])
+        mount_point = "" if mount_point == "/" else mount_point
+        generations = sorted(int(p.name) for p in Path(self.generations_path).iterdir() if p.name.isdigit())
+        parent = None
+        for generation in generations:
+            state_path = f"{self.generations_path}/{generation}"
+            packages = None
+            if Path(f"{state_path}/installed_packages").is_file():
+                with open(f"{state_path}/installed_packages") as f:
+                    packages = json.load(f)
+            hashes = load_config_hashes(state_path)
+            entry = new_generation_entry(
+                generation,
+                parent,
+                config_hash=hash_value(hashes) if hashes else "",
+                kver=get_generation_kver(generation, mount_point),
+                packages=count_packages(packages),
+                status="complete",
+            )
+            entry["timestamp"] = datetime.fromtimestamp(Path(state_path).stat().st_mtime).isoformat(timespec="seconds")
+            self.entries[generation] = entry
+            parent = generation
+
+    def save(self) -> None:
+        """Atomically write the index file."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({str(key): entry for key, entry in sorted(self.entries.items())}, indent=2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        """Add or replace the entry of a generation and store the index.
+
+        Args:
+            entry: Index entry as returned by `new_generation_entry`.
+        """
+        with self.locked():
+            self.entries[entry["id"]] = entry
+            self.save()
+
+    def allocate(self, parent: Optional[int], **fields: Any) -> Dict[str, Any]:
+        """Register a new generation with the next free generation number.
+
+        The entry is stored before anything is written for the generation, so
+        that the number is never given to another build. Generation directories
+        without an entry, left by an interrupted build, are skipped as well.
+
+        Args:
+            parent: Generation the new generation is built from, or None for the first one.
+            **fields: Other fields of the entry, see `new_generation_entry`.
+
+        Returns:
+            The index entry of the new generation.
+        """
+        with self.locked():
+            directories = Path(self.generations_path).iterdir() if Path(self.generations_path).is_dir() else []
+            existing = [int(path.name) for path in directories if path.name.isdigit()]
+            generation = max([self.max_generation(), *existing]) + 1
+            entry = new_generation_entry(generation, parent, **fields)
+            self.entries[generation] = entry
+            self.save()
+        return entry
+
+    def update(self, generation: int, **fields: Any) -> None:
+        """Update fields of a generation entry and store the index.
+
+        Args:
+            generation: Generation number.
+            **fields: Fields to update.
+        """
+        self.update_entries({generation: fields})
+
+    def update_entries(self, changes: Dict[int, Dict[str, Any]]) -> None:
+        """Update fields of several generation entries and store the index once.
+
+        Entries removed in the meantime (e.g. by `kod gc`) are skipped.
+
+        Args:
+            changes: Fields to update for each generation number.
+        """
+        with self.locked():
+            for generation, fields in changes.items():
+                if generation in self.entries:
+                    self.entries[generation].update(fields)
+            self.save()
+
+    def remove(self, generation: int) -> None:
+        """Remove the entry of a generation and store the index.
+
+        Args:
+            generation: Generation number.
+        """
+        with self.locked():
+            if self.entries.pop(generation, None) is not None:
+                self.save()
+
+    def get(self, generation: int) -> Optional[Dict[str, Any]]:
+        """Return the entry of a generation, or None if it is not indexed."""
+        return self.entries.get(generation)
+
+    def generations(self) -> List[Dict[str, Any]]:
+        """Return the entries of all generations ordered by generation number."""
+        return [self.entries[key] for key in sorted(self.entries)]
+
+    def max_generation(self) -> int:
+        """Return the highest generation number, or 0 if there are no generations."""
+        return max(self.entries, default=0)
+
+
+def format_generations(entries: List[Dict[str, Any]], current: Optional[int] = None, sizes: bool = False) -> List[str]:
+    """Format generation entries as the lines of a table.
+
+    Args:
+        entries: Index entries to format.
+        current: Generation currently running, marked with "*". Defaults to None.
+            Pinned generations are shown in the status column.
+        sizes: If True, add the exclusive and shared disk usage stored in the
+            entries. Defaults to False.
+
+    Returns:
+        The lines of the table, starting with the header.
+    """
+    from kod.usage import format_size
+
+    header = f"  {'ID':>4} {'PARENT':>6}  {'DATE':<19}  {'KERNEL':<24} {'PKGS':>5} {'TIME':>7}"
+    if sizes:
+        header += f" {'EXCL':>8} {'SHARED':>8}"
+    lines = [header + "  STATUS"]
+    for entry in entries:
+        mark = "*" if entry["id"] == current else " "
+        status = entry["status"] + (" (pinned)" if entry.get("pinned") else "")
+        parent = "-" if entry["parent"] is None else str(entry["parent"])
+        duration = "-" if entry["duration"] is None else f"{entry['duration']:.0f}s"
+        line = (
+            f"{mark} {entry['id']:>4} {parent:>6}  {entry['timestamp']:<19}  {entry['kver'] or '-':<24} "
+            f"{entry['packages']:>5} {duration:>7}"
+        )
+        if sizes:
+            usage = entry.get("usage") or {}
+            line += f" {format_size(usage.get('exclusive')):>8} {format_size(usage.get('shared')):>8}"
+        lines.append(f"{line}  {status}")
+    return lines
@@ -0,0 +1,87 @@
+"""Disk images of KodOS installations.
+
+A disk image is built by creating a sparse file, attaching it to a loop device
+and running the installation against the loop device, with the partition layout
+of the configuration. Once the loop device is detached, the raw image can be
+converted to qcow2 or compressed with multithreaded zstd.
+"""
+
+from pathlib import Path
+from typing import List
+
+from kod.common import exec, exec_critical, exec_warn
+
+IMAGE_FORMATS: List[str] = ["raw", "qcow2", "zst"]
+
+
+def raw_image_path(output: str, image_format: str) -> str:
+    """Get the path of the raw image built for an output.
+
+    Args:
+        output: Path of the image to produce.
+        image_format: Format of the image to produce ("raw", "qcow2" or "zst").
+
+    Returns:
+        The output itself for raw images, otherwise a temporary file next to it.
+    """
+    return output if image_format == "raw" else f"{output}.raw"
+
+
+def create_image_file(path: str, size: str) -> None:
+    """
+    Create a sparse image file.
+
+    Args:
+        path (str): Path of the image file.
+        size (str): Size of the image (e.g. "20G").
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    exec(f"rm -f {path}")
+    exec_critical(f"truncate -s {size} {path}", f"Failed to create the image {path}")
+
+
+def attach_loop_device(path: str) -> str:
+    """
+    Attach an image file to a free loop device, with partition scanning.
+
+    Args:
+        path (str): Path of the image file.
+
+    Returns:
+        str: The loop device (e.g. /dev/loop0).
+    """
+    device = exec_critical(
+        f"losetup --find --show --partscan {path}", f"Failed to attach {path} to a loop device", get_output=True
+    )
+    return device.strip()
+
+
+def detach_loop_device(device: str) -> None:
+    """
+    Detach a loop device once every pending write is flushed.
+
+    Args:
+        device (str): The loop device.
+    """
+    exec("sync")
+    exec_warn(f"losetup -d {device}", f"Failed to detach {device}")
+
+
+def convert_image(raw_image: str, output: str, image_format: str, compression_level: int = 3) -> None:
+    """
+    Convert a raw image to the requested format and remove the raw image.
+
+    Args:
+        raw_image (str): Path of the raw image.
+        output (str): Path of the converted image.
+        image_format (str): "qcow2" or "zst". Raw images are left unchanged.
+        compression_level (int, optional): zstd compression level. Defaults to 3.
+    """
+    if image_format == "raw":
+        return
+    print(f"Converting the image to {image_format}")
+    if image_format == "qcow2":
+        exec_critical(f"qemu-img convert -f raw -O qcow2 {raw_image} {output}", "Failed to convert the image")
+    else:
+        exec_critical(f"zstd -T0 -{compression_level} -q -f {raw_image} -o {output}", "Failed to compress the image")
+    exec(f"rm -f {raw_image}")
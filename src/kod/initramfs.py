@@ -0,0 +1,321 @@
+"""Content-addressed initramfs images for KodOS.
+
+Generating an initramfs with dracut is one of the slowest steps of an
+installation or a kernel update. The images are stored on the ESP under a name
+derived from a hash of everything dracut uses to build them: the kernel version
+and its modules, the dracut configuration and version and, for host-only images,
+the storage drivers of the root device, the CPU and the firmware type. An image
+is only generated when no image with the same inputs exists, so rebuilds that do
+not change these inputs reuse it, and generations with the same inputs share a
+single file.
+
+The drivers of the image are set by a dracut configuration file of each
+generation, generated from the `boot.kernel.modules` setting and, for host-only
+images, from the drivers of the device the root filesystem is on. Host-only
+images are built in strict mode, so they only contain what this machine needs to
+mount its root filesystem.
+"""
+
+import hashlib
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from kod.common import exec, exec_chroot, exec_critical
+from kod.devices import MOUNTINFO_PATH, SYS_BLOCK_PATH, read_mountinfo
+from kod.esp import BootArtifactStore
+from kod.generations import hash_value, lua_to_python
+from kod.tuning import write_generated_file
+
+# Dracut configuration files, relative to the root filesystem
+DRACUT_CONFIG_PATHS: List[str] = ["etc/dracut.conf", "etc/dracut.conf.d", "usr/lib/dracut/dracut.conf.d"]
+
+# Dracut configuration generated by kod, relative to the root filesystem
+DRACUT_KODOS_CONFIG: str = "etc/dracut.conf.d/90-kodos.conf"
+
+_module_suffix = re.compile(r"\.ko(\.(gz|xz|zst))?$")
+
+
+def _file_digest(path: Path) -> str:
+    """Return the sha256 digest of a file, or an empty string if it does not exist."""
+    if not path.is_file():
+        return ""
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def dracut_config(root_path: str) -> Dict[str, str]:
+    """Read the dracut configuration of a root filesystem.
+
+    Args:
+        root_path: Path to the root filesystem.
+
+    Returns:
+        A dictionary mapping each configuration file to its content.
+    """
+    config = {}
+    for name in DRACUT_CONFIG_PATHS:
+        path = Path(f"{root_path}/{name}")
+        files = sorted(path.glob("*.conf")) if path.is_dir() else [path]
+        for file in files:
+            if file.is_file():
+                config[str(file.relative_to(root_path))] = file.read_text()
+    return config
+
+
+def get_boot_modules(conf: Any) -> List[str]:
+    """Get the kernel modules declared in `boot.kernel.modules`.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        The module names, empty if none are declared.
+    """
+    boot = lua_to_python(getattr(conf, "boot", None)) or {}
+    modules = (boot.get("kernel") or {}).get("modules") if isinstance(boot, dict) else None
+    if isinstance(modules, dict):
+        modules = list(modules.values())
+    return [str(module) for module in modules or []]
+
+
+def module_name(name: str) -> str:
+    """Normalize a module name or path (e.g. kernel/drivers/ata/ahci.ko.zst) to its name."""
+    return _module_suffix.sub("", os.path.basename(name)).replace("-", "_")
+
+
+def available_modules(root_path: str, kver: str) -> Optional[Set[str]]:
+    """Get the modules of a kernel, loadable or built in.
+
+    Args:
+        root_path: Path to the root filesystem.
+        kver: Kernel version.
+
+    Returns:
+        The module names, or None if the kernel has no module list.
+    """
+    modules_path = Path(f"{root_path}/usr/lib/modules/{kver}")
+    modules = set()
+    found = False
+    for name in ["modules.dep", "modules.builtin"]:
+        path = modules_path / name
+        if path.is_file():
+            found = True
+            modules |= {module_name(line.split(":")[0]) for line in path.read_text().splitlines() if line}
+    return modules if found else None
+
+
+def storage_modules(device: str, sys_block: str = SYS_BLOCK_PATH) -> List[str]:
+    """Get the modules of the drivers a block device depends on.
+
+    The drivers of the device and of its parents (disk, controller, bus) are
+    collected, and those of the underlying devices for device-mapper and md devices.
+
+    Args:
+        device: Device path (e.g. /dev/vda2).
+        sys_block: sysfs directory of the block devices. Defaults to /sys/class/block.
+
+    Returns:
+        The module names, drivers built into the kernel are not included.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    entry = Path(f"{sys_block}/{name}")
+    if not entry.exists():
+        return []
+    modules = []
+    sys_device = entry.resolve()
+    for path in [sys_device, *sys_device.parents]:
+        if (path / "driver" / "module").exists():
+            modules.append(module_name(os.path.realpath(path / "driver" / "module")))
+    slaves = sys_device / "slaves"
+    if slaves.is_dir():
+        for slave in sorted(slaves.iterdir()):
+            modules += storage_modules(slave.name, sys_block)
+    return list(dict.fromkeys(modules))
+
+
+def root_device(mount_point: str, mountinfo: str = MOUNTINFO_PATH) -> Optional[Dict[str, str]]:
+    """Get the mount of the root filesystem mounted at a mount point.
+
+    Args:
+        mount_point: The mount point of the root filesystem.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The mount, as returned by `read_mountinfo`, or None if nothing is mounted there.
+    """
+    mount_point = os.path.normpath(mount_point)
+    found = None
+    for mount in read_mountinfo(mountinfo):
+        if mount["mount_point"] == mount_point:
+            found = mount
+    return found
+
+
+def root_storage_drivers(mount_point: str, mountinfo: str = MOUNTINFO_PATH) -> List[str]:
+    """Get the drivers needed to mount the root filesystem mounted at a mount point.
+
+    Args:
+        mount_point: The mount point of the root filesystem.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The modules of the storage stack of the root device and of its filesystem.
+    """
+    root = root_device(mount_point, mountinfo)
+    if not root:
+        return []
+    return list(dict.fromkeys(storage_modules(root["source"]) + [module_name(root["fs_type"])]))
+
+
+def hardware_facts(mount_point: str, mountinfo: str = MOUNTINFO_PATH) -> Dict[str, Any]:
+    """Get the facts about the machine that shape a host-only image.
+
+    Only the facts dracut uses to select the content of a host-only image are
+    included, so that loading an unrelated module (USB, bluetooth) does not change
+    the image. The storage drivers are those of the root filesystem mounted at the
+    mount point, i.e. of the target disk during an installation.
+
+    Args:
+        mount_point: The mount point of the root filesystem.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The root storage drivers, the CPU vendor and family (for the microcode), and
+        the firmware type.
+    """
+    facts: Dict[str, Any] = {
+        "firmware": "efi" if Path("/sys/firmware/efi").is_dir() else "bios",
+        "storage": root_storage_drivers(mount_point, mountinfo),
+    }
+    cpuinfo = Path("/proc/cpuinfo")
+    if cpuinfo.is_file():
+        for line in cpuinfo.read_text().splitlines():
+            key, _, value = line.partition(":")
+            if key.strip() in ["vendor_id", "cpu family"] and key.strip() not in facts:
+                facts[key.strip()] = value.strip()
+    return facts
+
+
+def render_dracut_config(drivers: List[str], hostonly: bool) -> str:
+    """Render the dracut configuration of the initramfs images.
+
+    Args:
+        drivers: Kernel modules to include in the images.
+        hostonly: If True, the images only support the hardware of this machine.
+
+    Returns:
+        The content of the configuration file.
+    """
+    lines = ["# Generated by kod from boot.kernel.modules and the root device"]
+    if hostonly:
+        lines += ['hostonly="yes"', 'hostonly_mode="strict"']
+    else:
+        lines += ['hostonly="no"']
+    if drivers:
+        lines.append(f'add_drivers+=" {" ".join(drivers)} "')
+    return "\n".join(lines) + "\n"
+
+
+def configure_dracut(
+    modules: List[str], kver: str, mount_point: str = "/mnt", hostonly: bool = True, mountinfo: str = MOUNTINFO_PATH
+) -> List[str]:
+    """Write the dracut configuration of the initramfs images of a root filesystem.
+
+    Args:
+        modules: Kernel modules declared in the configuration.
+        kver: Kernel version the images are built for.
+        mount_point: The mount point of the root filesystem. Defaults to "/mnt".
+        hostonly: If True, the drivers of the root device are added, and the images
+            only support the hardware of this machine. Defaults to True.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The drivers added to the images.
+    """
+    drivers = [module_name(module) for module in modules]
+    if hostonly:
+        drivers += root_storage_drivers(mount_point, mountinfo)
+    drivers = list(dict.fromkeys(drivers))
+
+    # dracut fails on a driver the kernel does not have
+    available = available_modules(mount_point.rstrip("/"), kver)
+    if available is not None:
+        missing = [driver for driver in drivers if driver not in available]
+        if missing:
+            print(f"Kernel {kver} has no module {' '.join(missing)}, not added to the initramfs")
+        drivers = [driver for driver in drivers if driver in available]
+
+    path = Path(f"{mount_point.rstrip('/')}/{DRACUT_KODOS_CONFIG}")
+    if write_generated_file(path, render_dracut_config(drivers, hostonly)):
+        print(f"Initramfs drivers: {' '.join(drivers)}")
+    return drivers
+
+
+def initramfs_key(kver: str, root_path: str, hostonly: bool = True, mountinfo: str = MOUNTINFO_PATH) -> str:
+    """Compute the key of the initramfs image of a kernel.
+
+    Args:
+        kver: Kernel version.
+        root_path: Path to the root filesystem the image is generated from.
+        hostonly: If True, the image only supports the hardware of this machine. Defaults to True.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The key of the image.
+    """
+    inputs = {
+        "kver": kver,
+        "modules": _file_digest(Path(f"{root_path}/usr/lib/modules/{kver}/modules.dep")),
+        "dracut_version": _file_digest(Path(f"{root_path}/usr/lib/dracut/dracut-version.sh")),
+        "dracut_config": dracut_config(root_path),
+        "hostonly": hostonly,
+        "hardware": hardware_facts(root_path, mountinfo) if hostonly else {},
+    }
+    return hash_value(inputs)
+
+
+def initramfs_name(kver: str, key: str) -> str:
+    """Get the file name on the ESP of an initramfs image."""
+    return f"initramfs-{kver}-{key[:16]}.img"
+
+
+def build_initramfs(
+    kver: str, mount_point: str = "/mnt", hostonly: bool = True, modules: Optional[List[str]] = None
+) -> str:
+    """Generate the initramfs image of a kernel, unless an identical one exists.
+
+    The image is generated under a temporary name and renamed once complete, so
+    that an interrupted generation is never reused.
+
+    Args:
+        kver: Kernel version.
+        mount_point: Mount point of the root filesystem, with the ESP mounted at /boot.
+            Defaults to "/mnt".
+        hostonly: If True, the image only supports the hardware of this machine. Defaults to True.
+        modules: Kernel modules declared in the configuration. If provided, the dracut
+            configuration of the root filesystem is generated first, see `configure_dracut`.
+
+    Returns:
+        The file name of the image on the ESP.
+    """
+    if modules is not None:
+        configure_dracut(modules, kver, mount_point, hostonly)
+    name = initramfs_name(kver, initramfs_key(kver, mount_point, hostonly))
+    root = "" if mount_point == "/" else mount_point
+    if Path(f"{root}/boot/{name}").is_file():
+        print(f"Reusing initramfs {name}")
+        return name
+
+    store = BootArtifactStore.load(f"{root}/boot")
+    store.ensure_free_space(store.initramfs_size_estimate())
+    host_option = "--hostonly" if hostonly else "--no-hostonly"
+    dracut = f"dracut --force --kver {kver} {host_option} /boot/{name}.tmp"
+    if root:
+        exec_chroot(dracut, mount_point=mount_point)
+    else:
+        exec(dracut)
+    exec_critical(f"mv {root}/boot/{name}.tmp {root}/boot/{name}", f"Failed to generate the initramfs of {kver}")
+    if Path(f"{root}/boot/{name}").is_file():
+        store.register(name)
+    return name
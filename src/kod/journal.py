@@ -0,0 +1,257 @@
+"""Stage journal for resumable installations and rebuilds.
+
+This module records the stages completed by `kod install` and `kod rebuild`
+together with their outputs, so that a failed run can be resumed at the stage
+that failed instead of starting from scratch. Optionally, a read-only btrfs
+snapshot of the root filesystem is taken at every stage boundary, which allows
+restoring a clean state before re-running the failed stage.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from kod.common import exec, exec_warn
+from kod.filesystem import FsEntry
+
+# Journal locations
+INSTALL_JOURNAL: str = "/var/tmp/kod/install-journal.json"
+REBUILD_JOURNAL: str = "/kod/current/rebuild-journal.json"
+
+
+class JournalError(Exception):
+    """Raised when a journal cannot be used to resume a run."""
+
+
+def _encode(value: Any) -> Any:
+    """Encode the stage outputs that are not JSON types."""
+    if isinstance(value, FsEntry):
+        return {"__fsentry__": [value.source, value.destination, value.fs_type, value.options, value.dump, value.pass_]}
+    raise TypeError(f"Stage output of type {type(value).__name__} cannot be stored in the journal")
+
+
+def _decode(obj: Dict[str, Any]) -> Any:
+    """Decode the stage outputs encoded by `_encode`."""
+    if "__fsentry__" in obj:
+        return FsEntry(*obj["__fsentry__"])
+    return obj
+
+
+class StageJournal:
+    """
+    Journal of the stages completed by an installation or a rebuild.
+
+    The journal is stored as a JSON file which is atomically replaced after each
+    stage. It keeps the name and output of every completed stage, the stage that
+    failed (if any), and the checkpoint taken after each stage.
+    """
+
+    def __init__(self, path: str, operation: str, config_hash: str, checkpoint_dir: Optional[str] = None) -> None:
+        """
+        Initialize a new journal.
+
+        Args:
+            path (str): Path of the journal file.
+            operation (str): Operation recorded by the journal ("install" or "rebuild").
+            config_hash (str): Hash of the configuration used by the run.
+            checkpoint_dir (str, optional): Directory where btrfs checkpoints are created.
+                If None, no checkpoints are taken.
+        """
+        self.path = path
+        self.checkpoint_dir = checkpoint_dir
+        self.data: Dict[str, Any] = {
+            "operation": operation,
+            "config_hash": config_hash,
+            "checkpoints": checkpoint_dir is not None,
+            "stages": [],
+            "outputs": {},
+            "failed": None,
+        }
+
+    @classmethod
+    def load(cls, path: str) -> Optional["StageJournal"]:
+        """
+        Load an existing journal.
+
+        Args:
+            path (str): Path of the journal file.
+
+        Returns:
+            StageJournal: The loaded journal, or None if there is no journal.
+        """
+        if not Path(path).is_file():
+            return None
+        with open(path) as f:
+            data = json.load(f, object_hook=_decode)
+        journal = cls(path, data["operation"], data["config_hash"])
+        journal.data = data
+        return journal
+
+    @classmethod
+    def start(
+        cls,
+        path: str,
+        operation: str,
+        config_hash: str,
+        resume: bool = False,
+        checkpoint_dir: Optional[str] = None,
+    ) -> "StageJournal":
+        """
+        Start a run, resuming the previous one if requested.
+
+        Args:
+            path (str): Path of the journal file.
+            operation (str): Operation recorded by the journal.
+            config_hash (str): Hash of the configuration used by the run.
+            resume (bool): If True, continue the run recorded in the journal. Defaults to False.
+            checkpoint_dir (str, optional): Directory where btrfs checkpoints are created.
+
+        Returns:
+            StageJournal: The journal to use for the run.
+
+        Raises:
+            JournalError: If the run cannot be resumed.
+        """
+        if resume:
+            journal = cls.load(path)
+            if journal is None:
+                raise JournalError(f"No {operation} to resume ({path} not found)")
+            if journal.data["operation"] != operation:
+                raise JournalError(f"The journal records a {journal.data['operation']}, not a {operation}")
+            if journal.data["config_hash"] != config_hash:
+                raise JournalError("The configuration changed since the failed run, it cannot be resumed")
+            if journal.data["checkpoints"]:
+                journal.checkpoint_dir = checkpoint_dir
+            print(f"Resuming {operation}, completed stages: {', '.join(journal.data['stages']) or 'none'}")
+            return journal
+
+        journal = cls(path, operation, config_hash, checkpoint_dir)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        journal.save()
+        return journal
+
+    def save(self) -> None:
+        """Atomically write the journal file."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(self.data, indent=2, default=_encode))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def completed(self, stage: str) -> bool:
+        """Check whether a stage was completed."""
+        return stage in self.data["stages"]
+
+    def output(self, stage: str) -> Any:
+        """Return the output recorded for a completed stage."""
+        return self.data["outputs"].get(stage)
+
+    @property
+    def failed_stage(self) -> Optional[str]:
+        """Name of the stage that failed in the previous run, if any."""
+        return self.data["failed"]["stage"] if self.data["failed"] else None
+
+    def run(self, stage: str, func: Callable[..., Any], *args: Any, subvolume: Optional[str] = None, **kwargs) -> Any:
+        """
+        Run a stage unless it was already completed.
+
+        The output of the stage is stored in the journal, so that it is available
+        when the run is resumed. If the stage fails, the failure is recorded and the
+        exception is raised again.
+
+        Args:
+            stage (str): Name of the stage.
+            func (callable): Function implementing the stage.
+            *args: Positional arguments for `func`.
+            subvolume (str, optional): Subvolume to checkpoint after the stage.
+            **kwargs: Keyword arguments for `func`.
+
+        Returns:
+            The output of the stage, either computed or loaded from the journal.
+        """
+        if self.completed(stage):
+            print(f"[journal] Stage {stage} already completed")
+            return self.output(stage)
+
+        print(f"[journal] Running stage {stage}")
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self.data["failed"] = {"stage": stage, "error": str(e)}
+            self.save()
+            print(f"[journal] Stage {stage} failed, use --resume to continue from this stage")
+            raise
+
+        self.data["stages"].append(stage)
+        self.data["outputs"][stage] = result
+        self.data["failed"] = None
+        if self.checkpoint_dir and subvolume:
+            self.checkpoint(stage, subvolume)
+        self.save()
+        return result
+
+    def checkpoint(self, stage: str, subvolume: str) -> None:
+        """
+        Take a read-only snapshot of a subvolume after a stage.
+
+        Args:
+            stage (str): Name of the completed stage.
+            subvolume (str): Path of the subvolume to snapshot.
+        """
+        exec(f"mkdir -p {self.checkpoint_dir}")
+        exec(f"btrfs subvolume snapshot -r {subvolume} {self.checkpoint_dir}/{stage}")
+        self.data.setdefault("checkpoint_names", []).append(stage)
+
+    def last_checkpoint(self) -> Optional[str]:
+        """
+        Return the name of the checkpoint taken after the last completed stage.
+
+        Returns:
+            str: The checkpoint name, or None if the last completed stage has no checkpoint,
+                in which case restoring an older checkpoint would undo completed stages.
+        """
+        names = self.data.get("checkpoint_names", [])
+        if names and self.data["stages"] and names[-1] == self.data["stages"][-1]:
+            return names[-1]
+        return None
+
+    def restore_checkpoint(self, subvolume: str, checkpoint_dir: Optional[str] = None) -> bool:
+        """
+        Replace a subvolume with a writable copy of the most recent checkpoint.
+
+        The subvolume must not be mounted.
+
+        Args:
+            subvolume (str): Path of the subvolume to restore.
+            checkpoint_dir (str, optional): Directory containing the checkpoints, if it
+                is mounted at a different path than when they were taken.
+
+        Returns:
+            bool: True if a checkpoint was restored.
+        """
+        name = self.last_checkpoint()
+        if name is None:
+            return False
+        checkpoint_dir = checkpoint_dir or self.checkpoint_dir
+        print(f"[journal] Restoring checkpoint {name}")
+        exec(f"btrfs subvolume delete {subvolume}")
+        exec(f"btrfs subvolume snapshot {checkpoint_dir}/{name} {subvolume}")
+        return True
+
+    def finish(self, checkpoint_dir: Optional[str] = None) -> None:
+        """
+        Remove the journal and its checkpoints after a successful run.
+
+        Args:
+            checkpoint_dir (str, optional): Directory containing the checkpoints, if it
+                is mounted at a different path than when they were taken.
+        """
+        checkpoint_dir = checkpoint_dir or self.checkpoint_dir
+        names = self.data.get("checkpoint_names", [])
+        if checkpoint_dir and names:
+            paths = " ".join(f"{checkpoint_dir}/{name}" for name in names)
+            exec_warn(f"btrfs subvolume delete {paths}", "Failed to delete journal checkpoints")
+        if Path(self.path).is_file():
+            os.remove(self.path)
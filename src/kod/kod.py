@@ -9,57 +9,16 @@ with KodOS functionality including installation, configuration, and system manag
 
 import os
 import sys
+import time
 from pathlib import Path
 from typing import Optional, Tuple
 
 import click
 
-# from kod.arch import get_base_packages, get_kernel_file, install_essentials_pkgs, proc_repos, refresh_package_db
-from kod.common import (
-    exec,
-    set_debug,
-    set_verbose,
-    report_problems,
-    exec_warn,
-    exec_critical,
-)
-from kod.core import (
-    Context,
-    change_subvol,
-    configure_system,
-    configure_user_dotfiles,
-    configure_user_scripts,
-    create_boot_entry,
-    create_filesystem_hierarchy,
-    create_kod_user,
-    create_next_generation,
-    disable_services,
-    enable_services,
-    enable_user_services,
-    generate_fstab,
-    get_max_generation,
-    get_packages_to_install,
-    get_packages_updates,
-    get_pending_packages,
-    get_services_to_enable,
-    load_config,
-    load_fstab,
-    load_package_lock,
-    load_packages_services,
-    load_repos,
-    manage_packages,
-    manage_packages_shell,
-    proc_user_home,
-    proc_users,
-    setup_bootloader,
-    store_packages_services,
-    update_all_packages,
-    user_configs,
-    user_dotfile_manager,
-    user_services,
-)
-from kod.core import set_base_distribution
-from kod.filesystem import create_partitions, get_partition_devices
+# Subcommands import the modules they need when they run, so that the CLI
+# starts quickly and `--help` or `shell` do not load Lua or the chroot support.
+from kod.common import set_debug, set_verbose
+from kod.image import IMAGE_FORMATS
 
 # from kod.core import *
 
@@ -82,8 +41,61 @@ base_distribution = "arch"
 @cli.command()
 @click.option("-c", "--config", default=None, help="System configuration file")
 @click.option("-m", "--mount_point", default="/mnt", help="Mount poin used to install")
-def install(config: Optional[str], mount_point: str) -> None:
+@click.option("-r", "--resume", is_flag=True, help="Resume a failed installation at the stage that failed")
+@click.option("--checkpoint", is_flag=True, help="Snapshot the root filesystem after each stage")
+@click.option(
+    "-t", "--target", default=None, help="Install into a directory of an existing btrfs filesystem (no partitioning)"
+)
+@click.option("--device", default=None, help="Install on this device instead of the one of the configuration")
+@click.option("--portable", is_flag=True, help="Do not tie the boot setup to this machine (EFI variables, drivers)")
+@click.option("--no-base-cache", is_flag=True, help="Bootstrap the base system without the base layer cache")
+def install(
+    config: Optional[str],
+    mount_point: str,
+    resume: bool = False,
+    checkpoint: bool = False,
+    target: Optional[str] = None,
+    device: Optional[str] = None,
+    portable: bool = False,
+    no_base_cache: bool = False,
+) -> None:
     "Install KodOS based on the given configuration"
+    from kod.common import exec, exec_critical, exec_warn, report_problems
+    from kod.core import (
+        Context,
+        configure_system,
+        create_directory_hierarchy,
+        create_filesystem_hierarchy,
+        create_kod_user,
+        enable_services,
+        get_packages_to_install,
+        get_pending_packages,
+        get_services_to_enable,
+        load_config,
+        manage_packages,
+        mount_directory_hierarchy,
+        mount_filesystem_hierarchy,
+        proc_users,
+        set_base_distribution,
+        setup_bootloader,
+        store_packages_services,
+    )
+    from kod.filesystem import create_partitions, get_btrfs_options, get_store_paths, set_install_device
+    from kod.generations import (
+        GenerationIndex,
+        compute_config_hashes,
+        count_packages,
+        get_generation_initrd,
+        get_generation_kver,
+        hash_value,
+        new_generation_entry,
+        store_config_hashes,
+    )
+    from kod.journal import INSTALL_JOURNAL, JournalError, StageJournal
+    from kod.layers import BASE_CACHE_PATH, install_base_layer
+    from kod.preflight import PreflightError, run_preflight
+
+    start_time = time.monotonic()
     ctx = Context(os.environ["USER"], mount_point=mount_point, use_chroot=True, stage="install")
 
     conf = load_config(config)
@@ -94,6 +106,10 @@ def install(config: Optional[str], mount_point: str) -> None:
 
     dist = set_base_distribution(base_distribution)
 
+    if device and not set_install_device(conf, device):
+        print("--device requires a configuration with exactly one device")
+        sys.exit(1)
+
     # if base_distribution == "debian":
     #     from kod.debian import (
     #         generale_package_lock,
@@ -110,56 +126,167 @@ def install(config: Optional[str], mount_point: str) -> None:
     #         proc_repos,
     #     )
 
-    print("-------------------------------")
-    boot_partition, root_partition, partition_list = create_partitions(conf)
+    # Validate the whole configuration before any disk or network operation
+    packages_to_install, packages_to_remove = get_packages_to_install(conf)
+    if target:
+        target = os.path.abspath(target)
+    try:
+        run_preflight(conf, dist, packages_to_install, target=target)
+    except PreflightError:
+        print("Installation aborted, no changes were made")
+        sys.exit(1)
+
+    # Each stage is recorded in the journal so that a failed installation can be resumed
+    checkpoint_dir = f"{mount_point}/kod/checkpoints/install" if checkpoint else None
+    try:
+        journal_hash = hash_value({"config": conf, "target": target, "portable": portable})
+        journal = StageJournal.start(INSTALL_JOURNAL, "install", journal_hash, resume, checkpoint_dir)
+    except JournalError as e:
+        print(e)
+        sys.exit(1)
 
-    partition_list = create_filesystem_hierarchy(boot_partition, root_partition, partition_list, mount_point)
+    print("-------------------------------")
+    if target:
+        # The target directory takes the place of the partitions
+        boot_partition, root_partition = None, None
+        if journal.completed("hierarchy"):
+            partition_list = journal.output("hierarchy")
+            if Path(mount_point).is_mount():
+                exec_warn(f"umount -R {mount_point}", f"Failed to unmount {mount_point}")
+            if journal.last_checkpoint():
+                journal.restore_checkpoint(f"{target}/generations/0/rootfs", f"{target}/checkpoints/install")
+            mount_directory_hierarchy(target, mount_point, store_paths=get_store_paths(conf))
+        else:
+            partition_list = journal.run(
+                "hierarchy",
+                create_directory_hierarchy,
+                target,
+                mount_point,
+                get_btrfs_options(conf),
+                get_store_paths(conf),
+            )
+    else:
+        boot_partition, root_partition, partition_list = journal.run("partitions", create_partitions, conf)
+        if journal.completed("hierarchy"):
+            partition_list = journal.output("hierarchy")
+            # Restart the failed stage from the last checkpoint, since it may have left partial changes
+            if journal.last_checkpoint():
+                exec_warn(f"umount -R {mount_point}", f"Failed to unmount {mount_point}")
+                exec_critical(f"mount {root_partition} {mount_point}", "Failed to mount the root partition")
+                journal.restore_checkpoint(f"{mount_point}/generations/0/rootfs", f"{mount_point}/checkpoints/install")
+                exec_critical(f"umount {mount_point}", "Failed to unmount the root partition")
+            mount_filesystem_hierarchy(partition_list, mount_point)
+        else:
+            partition_list = journal.run(
+                "hierarchy",
+                create_filesystem_hierarchy,
+                boot_partition,
+                root_partition,
+                partition_list,
+                mount_point,
+                get_btrfs_options(conf),
+                get_store_paths(conf),
+            )
 
     # Install base packages and configure system
     base_packages = dist.get_base_packages(conf)  # TODO: this function requires a wrapper
 
     input("Before install essentials")
 
-    dist.install_essentials_pkgs(base_packages, mount_point)  # TODO: this function requires a wrapper
+    journal.run(
+        "essentials",
+        install_base_layer,
+        dist,
+        base_distribution,
+        base_packages,
+        mount_point,
+        cache_path=None if no_base_cache else BASE_CACHE_PATH,
+        subvolume=mount_point,
+    )
 
     input("Before configure system")
-    configure_system(conf, partition_list=partition_list, mount_point=mount_point)
+    journal.run(
+        "configure",
+        configure_system,
+        conf,
+        partition_list=partition_list,
+        mount_point=mount_point,
+        subvolume=mount_point,
+    )
     # setup_bootloader(conf, partition_list, base_distribution)
 
     input("Before setup boot loader")
-    setup_bootloader(conf, partition_list, dist)
-    create_kod_user(mount_point)
+    journal.run(
+        "bootloader",
+        setup_bootloader,
+        conf,
+        partition_list,
+        dist,
+        portable=portable or bool(target),
+        subvolume=mount_point,
+    )
+    journal.run("kod user", create_kod_user, mount_point, subvolume=mount_point)
 
     # === Proc packages
-    repos, repo_packages = dist.proc_repos(conf, mount_point=mount_point)  # TODO: this function requires a wrapper
-    packages_to_install, packages_to_remove = get_packages_to_install(conf)
+    repos, repo_packages = journal.run(
+        "repos", dist.proc_repos, conf, mount_point=mount_point, subvolume=mount_point
+    )  # TODO: this function requires a wrapper
     pending_to_install = get_pending_packages(packages_to_install)
     print("packages\n", packages_to_install)
 
-    manage_packages(mount_point, repos, "install", pending_to_install, chroot=True)
+    journal.run(
+        "packages",
+        manage_packages,
+        mount_point,
+        repos,
+        "install",
+        pending_to_install,
+        chroot=True,
+        subvolume=mount_point,
+    )
     # === Proc services
     system_services_to_enable = get_services_to_enable(ctx, conf)
     print(f"Services to enable: {system_services_to_enable}")
-    enable_services(system_services_to_enable, use_chroot=True)
+    journal.run("services", enable_services, system_services_to_enable, use_chroot=True, subvolume=mount_point)
 
     # === Proc users
     input("Before creating users")
     print("\n====== Creating users ======")
-    proc_users(ctx, conf)
+    journal.run("users", proc_users, ctx, conf, subvolume=mount_point)
 
     # print("==== Deploying generation ====")
     store_packages_services(f"{mount_point}/kod/generations/0", packages_to_install, system_services_to_enable)
+    config_hashes = compute_config_hashes(conf, packages_to_install)
+    store_config_hashes(f"{mount_point}/kod/generations/0", config_hashes)
     dist.generale_package_lock(mount_point, f"{mount_point}/kod/generations/0")
 
+    entry = new_generation_entry(
+        0,
+        None,
+        config_hash=hash_value(config_hashes),
+        kver=get_generation_kver(0, mount_point),
+        packages=count_packages(packages_to_install),
+        status="complete",
+    )
+    entry["duration"] = round(time.monotonic() - start_time, 1)
+    entry["initrd"] = get_generation_initrd(0, mount_point)
+    GenerationIndex(f"{mount_point}/kod/generations").add(entry)
+
+    journal.finish()
+    if checkpoint_dir:
+        exec(f"rm -rf {mount_point}/kod/checkpoints")
     exec_warn(f"umount -R {mount_point}", f"Failed to unmount {mount_point}")
 
     print("Done")
     print("=-=-=-=-=-=-=-=-=-=-")
     report_problems()
     print("-=-=-=-=-=-=-=-=-=-=")
-    exec_critical(f"mount {root_partition} {mount_point}", "Failed to mount for kodos copy")
-    exec_critical(f"cp -r /root/kodos {mount_point}/store/root/", "Failed to copy kodos to installation")
-    exec_critical(f"umount {mount_point}", "Failed to unmount after kodos copy")
+    if target:
+        exec_critical(f"cp -r /root/kodos {target}/store/root/", "Failed to copy kodos to installation")
+    else:
+        exec_critical(f"mount {root_partition} {mount_point}", "Failed to mount for kodos copy")
+        exec_critical(f"cp -r /root/kodos {mount_point}/store/root/", "Failed to copy kodos to installation")
+        exec_critical(f"umount {mount_point}", "Failed to unmount after kodos copy")
     print(" Done installing KodOS")
 
 
@@ -167,10 +294,80 @@ def install(config: Optional[str], mount_point: str) -> None:
 @click.option("-c", "--config", default=None, help="System configuration file")
 @click.option("-n", "--new_generation", is_flag=True, help="Create a new generation")
 @click.option("-u", "--update", is_flag=True, help="Update package versions")
-def rebuild(config: Optional[str], new_generation: bool = False, update: bool = False) -> None:
+@click.option("-f", "--force", is_flag=True, help="Create a new generation even if nothing changed")
+@click.option("-r", "--resume", is_flag=True, help="Resume a failed rebuild at the stage that failed")
+@click.option("--rollback", is_flag=True, help="Discard the changes of a failed rebuild")
+@click.option("--checkpoint", is_flag=True, help="Snapshot the new generation after each stage")
+def rebuild(
+    config: Optional[str],
+    new_generation: bool = False,
+    update: bool = False,
+    force: bool = False,
+    resume: bool = False,
+    rollback: bool = False,
+    checkpoint: bool = False,
+) -> None:
     "Rebuild KodOS system installation"
+    from kod.common import exec
+    from kod.core import (
+        Context,
+        change_subvol,
+        configure_locale,
+        configure_memory,
+        configure_network,
+        create_boot_entry,
+        create_next_generation,
+        disable_services,
+        enable_services,
+        generate_fstab,
+        get_packages_to_install,
+        get_packages_updates,
+        get_services_to_enable,
+        load_config,
+        load_fstab,
+        load_package_lock,
+        load_packages_services,
+        load_repos,
+        manage_packages,
+        rollback_rebuild,
+        set_base_distribution,
+        set_hierarchy_options,
+        store_packages_services,
+        update_all_packages,
+    )
+    from kod.filesystem import get_btrfs_options, get_partition_devices, get_store_paths
+    from kod.generations import (
+        GenerationIndex,
+        RebuildPlan,
+        compute_config_hashes,
+        count_packages,
+        get_generation_initrd,
+        get_generation_kver,
+        hash_value,
+        load_config_hashes,
+        store_config_hashes,
+    )
+    from kod.initramfs import build_initramfs, get_boot_modules
+    from kod.journal import REBUILD_JOURNAL, JournalError, StageJournal
+    from kod.mounts import enter_private_mount_namespace, unmount_tree
+    from kod.preflight import PreflightError, run_preflight
+    from kod.tuning import configure_tuning, get_kernel_params
+    from kod.uki import uki_requested
+
+    if rollback:
+        journal = StageJournal.load(REBUILD_JOURNAL)
+        if journal is None:
+            print("There is no failed rebuild to roll back")
+            return
+        rollback_rebuild(journal)
+        return
+
+    if not resume and StageJournal.load(REBUILD_JOURNAL) is not None:
+        print("A previous rebuild did not finish, use --resume to continue it or --rollback to discard it")
+        sys.exit(1)
 
     # stage = "rebuild"
+    start_time = time.monotonic()
     conf = load_config(config)
     base_distribution = conf.base_distribution
     base_distribution = "arch" if base_distribution is None else base_distribution
@@ -180,10 +377,6 @@ def rebuild(config: Optional[str], new_generation: bool = False, update: bool =
 
     print("========================================")
 
-    # Get next generation number
-    max_generation = get_max_generation()
-    generation_id = int(max_generation) + 1
-
     with open("/.generation") as f:
         current_generation = int(f.readline().strip())
     print(f"{current_generation = }")
@@ -200,24 +393,79 @@ def rebuild(config: Optional[str], new_generation: bool = False, update: bool =
     print(f"{current_packages = }")
     print(f"{current_services = }")
 
+    # Decide which stages have to run based on the configuration hashes
+    packages_to_install, packages_to_remove = get_packages_to_install(conf)
+    print("packages\n", packages_to_install)
+    kernel_package = packages_to_install["kernel"] or "linux"
+
+    next_hashes = compute_config_hashes(conf, packages_to_install)
+    plan = RebuildPlan(load_config_hashes(current_state_path), next_hashes)
+
+    if not resume and not force and not update and plan.is_noop(current_packages, packages_to_install):
+        print(f"Generation {current_generation} is up to date, nothing to rebuild (use --force to rebuild anyway)")
+        return
+
+    try:
+        run_preflight(conf, dist, packages_to_install, install=False)
+    except PreflightError:
+        print("Rebuild aborted, no changes were made")
+        sys.exit(1)
+
+    # Each stage is recorded in the journal so that a failed rebuild can be resumed or rolled back.
+    # Checkpoints are only possible for a new generation, since the running root cannot be replaced.
+    journal_hash = hash_value({"config": conf, "new_generation": new_generation, "update": update})
+    checkpoint_dir = "/kod/checkpoints/rebuild" if checkpoint and new_generation else None
+    try:
+        journal = StageJournal.start(REBUILD_JOURNAL, "rebuild", journal_hash, resume, checkpoint_dir)
+    except JournalError as e:
+        print(e)
+        sys.exit(1)
+    next_root = "/kod/current/.next_current" if new_generation else None
+    if new_generation:
+        # The mounts of the next generation are released when kod exits, even on failure
+        enter_private_mount_namespace()
+
+    # Get next generation number and register it in the generation index
+    index = GenerationIndex.load()
+
+    def allocate_generation() -> dict:
+        entry = index.allocate(
+            current_generation, config_hash=hash_value(next_hashes), packages=count_packages(packages_to_install)
+        )
+        return {"id": entry["id"], "current": current_generation, "new_generation": new_generation}
+
+    generation_id = journal.run("generation", allocate_generation)["id"]
+
     boot_partition, root_partition = get_partition_devices(conf)
+    btrfs_options = get_btrfs_options(conf)
+    store_paths = get_store_paths(conf)
 
     next_state_path = f"/kod/generations/{generation_id}"
-    exec(f"mkdir -p {next_state_path}")
 
-    if new_generation:
-        print("Creating a new generation")
-        exec(f"btrfs subvolume snapshot / {next_state_path}/rootfs")
-        use_chroot = True
-        new_root_path = create_next_generation(boot_partition, root_partition, generation_id)
-    else:
+    def prepare_generation() -> str:
+        exec(f"mkdir -p {next_state_path}")
+        if new_generation:
+            print("Creating a new generation")
+            exec(f"btrfs subvolume snapshot / {next_state_path}/rootfs")
+            return create_next_generation(boot_partition, root_partition, generation_id, btrfs_options, store_paths)
         # os._exit(0)
         exec("btrfs subvolume snapshot / /kod/current/old-rootfs")
         exec(f"cp /kod/generations/{current_generation}/installed_packages /kod/current/installed_packages")
         exec(f"cp /kod/generations/{current_generation}/enabled_services /kod/current/enabled_services")
-        use_chroot = False
-        new_root_path = "/"
         # exec("mount -o remount,rw /usr")
+        return "/"
+
+    if journal.completed("snapshot") and new_generation:
+        new_root_path = journal.output("snapshot")
+        # Restart the failed stage from the last checkpoint, since it may have left partial changes
+        if journal.last_checkpoint():
+            unmount_tree(new_root_path)
+            journal.restore_checkpoint(f"{next_state_path}/rootfs")
+        # Only the mounts that are missing are done again
+        create_next_generation(boot_partition, root_partition, generation_id, btrfs_options, store_paths)
+    else:
+        new_root_path = journal.run("snapshot", prepare_generation, subvolume=next_root)
+    use_chroot = new_generation
 
     ctx = Context(os.environ["USER"], mount_point=new_root_path, use_chroot=use_chroot)
 
@@ -225,67 +473,97 @@ def rebuild(config: Optional[str], new_generation: bool = False, update: bool =
     print("==== Processing packages and services ====")
 
     current_repos = load_repos()
-    repos, repo_packages = dist.proc_repos(conf, current_repos, update, mount_point=new_root_path)
-    print("repo_packages\n", repo_packages)
+
+    def process_repos() -> dict:
+        repos, repo_packages = dist.proc_repos(conf, current_repos, update, mount_point=new_root_path)
+        print("repo_packages\n", repo_packages)
+        return repos
+
+    if plan.decide("repos", "repos", state_ok=not update, state_reason="package update requested"):
+        repos = journal.run("repos", process_repos, subvolume=next_root)
+    else:
+        repos = current_repos
     if repos is None:
         print("Missing repos information")
         return
 
-    if update:
+    def update_packages() -> None:
         print("Updating packages")
         dist.refresh_package_db(new_root_path, new_generation)  # TODO: this function requires a wrapper
         update_all_packages(new_root_path, new_generation, repos)
 
-    # === Proc packages
-    packages_to_install, packages_to_remove = get_packages_to_install(conf)
-    print("packages\n", packages_to_install)
-    kernel_package = packages_to_install["kernel"] or "linux"
+    if update:
+        journal.run("update", update_packages, subvolume=next_root)
 
+    # === Proc packages
     # Package filtering
     current_installed_packages = load_package_lock(current_state_path)
-    new_packages_to_install, packages_to_remove, packages_to_update, hooks_to_run = get_packages_updates(
-        dist,
-        current_packages,
-        packages_to_install,
-        packages_to_remove,
-        current_installed_packages,
-        new_root_path,
-    )
-
-    # === Proc services
-    next_services = get_services_to_enable(ctx, conf)
 
-    # Services filtering
-    services_to_disable = list(set(current_services) - set(next_services))
-    new_service_to_enable = list(set(next_services) - set(current_services))
+    def process_packages() -> bool:
+        new_packages_to_install, packages_to_remove_now, packages_to_update, hooks_to_run = get_packages_updates(
+            dist,
+            current_packages,
+            packages_to_install,
+            packages_to_remove,
+            current_installed_packages,
+            new_root_path,
+        )
 
-    if not new_generation and services_to_disable:
-        disable_services(services_to_disable, new_root_path, use_chroot=use_chroot)
+        # try:
+        if packages_to_remove_now:
+            print("Packages to remove:", packages_to_remove_now)
+            for pkg in packages_to_remove_now:
+                try:
+                    manage_packages(new_root_path, repos, "remove", [pkg], chroot=use_chroot)
+                except Exception:
+                    # Silently ignore package removal failures as they may not be critical
+                    pass
+
+        if new_packages_to_install:
+            print("Packages to install:", new_packages_to_install)
+            manage_packages(new_root_path, repos, "install", new_packages_to_install, chroot=use_chroot)
+
+        print("Running hooks")
+        for hook in hooks_to_run:
+            print(f"Running {hook}")
+            hook()
+        # Hooks are only returned when the kernel was updated
+        return bool(hooks_to_run)
+
+    kernel_updated = False
+    if plan.decide("packages", "packages", state_ok=not update, state_reason="package update requested"):
+        kernel_updated = journal.run("packages", process_packages, subvolume=next_root)
 
-    # ======
+    # === Proc services
+    def process_services() -> list:
+        next_services = get_services_to_enable(ctx, conf)
 
-    # try:
-    if packages_to_remove:
-        print("Packages to remove:", packages_to_remove)
-        for pkg in packages_to_remove:
-            try:
-                manage_packages(new_root_path, repos, "remove", [pkg], chroot=use_chroot)
-            except Exception:
-                # Silently ignore package removal failures as they may not be critical
-                pass
+        # Services filtering
+        services_to_disable = list(set(current_services) - set(next_services))
+        new_service_to_enable = list(set(next_services) - set(current_services))
 
-    if new_packages_to_install:
-        print("Packages to install:", new_packages_to_install)
-        manage_packages(new_root_path, repos, "install", new_packages_to_install, chroot=use_chroot)
+        if not new_generation and services_to_disable:
+            disable_services(services_to_disable, new_root_path, use_chroot=use_chroot)
 
-    print("Running hooks")
-    for hook in hooks_to_run:
-        print(f"Running {hook}")
-        hook()
+        # System services
+        print(f"Services to enable: {new_service_to_enable}")
+        enable_services(new_service_to_enable, new_root_path, use_chroot=use_chroot)
+        return next_services
 
-    # System services
-    print(f"Services to enable: {new_service_to_enable}")
-    enable_services(new_service_to_enable, new_root_path, use_chroot=use_chroot)
+    if plan.decide("services", "services"):
+        next_services = journal.run("services", process_services, subvolume=next_root)
+    else:
+        next_services = current_services
+
+    # === Proc locale and network
+    if plan.decide("locale", "locale"):
+        journal.run("locale", configure_locale, conf, new_root_path, use_chroot=use_chroot, subvolume=next_root)
+    if plan.decide("network", "network"):
+        journal.run("network", configure_network, conf, new_root_path, subvolume=next_root)
+    if plan.decide("tuning", "tuning"):
+        journal.run("tuning", configure_tuning, conf, new_root_path, subvolume=next_root)
+    if plan.decide("memory", "memory"):
+        journal.run("memory", configure_memory, conf, new_root_path, subvolume=next_root)
 
     # # === Proc users
     # print("\n====== Processing users ======")
@@ -301,18 +579,34 @@ def rebuild(config: Optional[str], new_generation: bool = False, update: bool =
     # Storing list of installed packages and enabled services
     # Create a list of installed packages
     store_packages_services(next_state_path, packages_to_install, next_services)
+    store_config_hashes(next_state_path, next_hashes)
     dist.generale_package_lock(new_root_path, next_state_path)
 
     partition_list = load_fstab("/")
 
-    _kernel_file, kver = dist.get_kernel_file(
-        new_root_path, package=kernel_package
-    )  # TODO: this function requires a wrapper
-
-    print("==== Deploying new generation ====")
-    if new_generation:
-        create_boot_entry(generation_id, partition_list, mount_point=new_root_path, kver=kver)
-    else:
+    # The kernel only needs to be probed if the boot config or the kernel changed
+    kver = get_generation_kver(current_generation)
+    if plan.decide("kernel", "boot", state_ok=not kernel_updated and kver is not None, state_reason="kernel updated"):
+        kver = journal.run(
+            "kernel", lambda: dist.get_kernel_file(new_root_path, package=kernel_package)[1]
+        )  # TODO: this function requires a wrapper
+
+    def deploy_generation() -> None:
+        # The kernel options are read from the generation, so that a rollback restores them
+        boot_options = get_kernel_params(new_root_path)
+        # Reuses the image of the current generation unless its inputs changed
+        initrd = build_initramfs(kver, new_root_path, modules=get_boot_modules(conf))
+        if new_generation:
+            create_boot_entry(
+                generation_id,
+                partition_list,
+                boot_options,
+                mount_point=new_root_path,
+                kver=kver,
+                initrd=initrd,
+                uki=uki_requested(conf),
+            )
+            return
         # Move current updated rootfs to a new generation
         exec(f"mv /kod/generations/{current_generation}/rootfs /kod/generations/{generation_id}/")
         # Moving the current rootfs copy to the current generation path
@@ -320,23 +614,44 @@ def rebuild(config: Optional[str], new_generation: bool = False, update: bool =
         exec(f"mv /kod/current/installed_packages /kod/generations/{current_generation}/installed_packages")
         exec(f"mv /kod/current/enabled_services /kod/generations/{current_generation}/enabled_services")
         updated_partition_list = change_subvol(
-            partition_list,
+            set_hierarchy_options(partition_list, btrfs_options),
             subvol=f"generations/{generation_id}",
             mount_points=["/"],
         )
         generate_fstab(updated_partition_list, new_root_path)
-        create_boot_entry(generation_id, updated_partition_list, mount_point=new_root_path, kver=kver)
+        create_boot_entry(
+            generation_id,
+            updated_partition_list,
+            boot_options,
+            mount_point=new_root_path,
+            kver=kver,
+            initrd=initrd,
+            uki=uki_requested(conf),
+        )
+
+    print("==== Deploying new generation ====")
+    plan.record("boot entry", True, f"new generation {generation_id}")
+    journal.run("deploy", deploy_generation)
 
     # Write generation number
     with open(f"{next_state_path}/rootfs/.generation", "w") as f:
         f.write(str(generation_id))
 
     if new_generation:
-        exec(f"umount -R {new_root_path}")
+        unmount_tree(new_root_path)
 
     # else:
     # exec("mount -o remount,ro /usr")
 
+    index.update(
+        generation_id,
+        kver=kver,
+        initrd=get_generation_initrd(generation_id),
+        status="complete",
+        duration=round(time.monotonic() - start_time, 1),
+    )
+    journal.finish()
+    plan.report()
     print(f"Done. Generation {generation_id} created")
 
 
@@ -345,6 +660,18 @@ def rebuild(config: Optional[str], new_generation: bool = False, update: bool =
 @click.option("--user", default=os.environ["USER"], help="User to rebuild config")
 def rebuild_user(config: Optional[str], user: str = os.environ["USER"]) -> None:
     "Rebuild user configuration"
+    from kod.core import (
+        Context,
+        configure_user_dotfiles,
+        configure_user_scripts,
+        enable_user_services,
+        load_config,
+        proc_user_home,
+        user_configs,
+        user_dotfile_manager,
+        user_services,
+    )
+
     # stage = "rebuild-user"
     ctx = Context(os.environ["USER"], mount_point="/", use_chroot=False, stage="rebuild-user")
     conf = load_config(config)
@@ -377,6 +704,8 @@ def rebuild_user(config: Optional[str], user: str = os.environ["USER"]) -> None:
 @click.option("-p", "--package", default=None, help="Package(s) to install", multiple=True)
 def shell(package: Optional[Tuple[str, ...]] = None) -> None:
     "Run shell"
+    from kod.common import exec
+    from kod.core import load_repos, manage_packages_shell
 
     local_session = exec("schroot -c virtual_env -b", get_output=True).strip()
     print(f"{local_session=}")
@@ -390,30 +719,171 @@ def shell(package: Optional[Tuple[str, ...]] = None) -> None:
     exec(f"schroot -e -c {local_session}")
 
 
-# # TODO: Update rollbackboot loader
-# # @task(help={"generation": "Generation number to rollback to"})
-# @cli.command()
-# @click.option('-c', '--config', default=None, help='System configuration file')
-# @click.option('-g','--generation', default=None, help='Generation number to rollback to')
-# def rollback(config, generation=None):
-#     "Rollback current generation to use the specified generation"
+@cli.group()
+def generations() -> None:
+    "Inspect the system generations"
+
+
+@generations.command(name="list")
+@click.option("-s", "--size", is_flag=True, help="Show the exclusive and shared disk usage of each generation")
+@click.option("--refresh", is_flag=True, help="Measure the disk usage of every generation again")
+def list_generations(size: bool = False, refresh: bool = False) -> None:
+    "List the generations recorded in the generation index"
+    from kod.generations import GenerationIndex, format_generations
+
+    index = GenerationIndex.load()
+    if size or refresh:
+        from kod.usage import update_generation_usage
+
+        update_generation_usage(index, refresh=refresh)
+    current = None
+    if Path("/.generation").is_file():
+        current = int(Path("/.generation").read_text().strip())
+    for line in format_generations(index.generations(), current, sizes=size or refresh):
+        print(line)
+
 
-#     if generation is None:
-#         print("Please specify a generation number")
-#         return
+@generations.command()
+@click.argument("generation", type=int)
+def pin(generation: int) -> None:
+    "Keep a generation from being garbage collected"
+    from kod.generations import GenerationIndex
 
-#     conf = load_config(config)
+    index = GenerationIndex.load()
+    if index.get(generation) is None:
+        print(f"Generation {generation} not found")
+        sys.exit(1)
+    index.update(generation, pinned=True)
 
-#     print("Updating current generation")
-#     rollback_path = f"/kod/generations/{generation}"
-#     boot_partition, root_partition = get_partition_devices(conf)
-#     copy_generation(boot_partition, root_partition, rollback_path, "/kod/current", new_generation=True)
 
-#     update_boot(boot_partition, root_partition, "/current")
+@generations.command()
+@click.argument("generation", type=int)
+def unpin(generation: int) -> None:
+    "Allow a pinned generation to be garbage collected"
+    from kod.generations import GenerationIndex
+
+    index = GenerationIndex.load()
+    if index.get(generation) is None:
+        print(f"Generation {generation} not found")
+        sys.exit(1)
+    index.update(generation, pinned=False)
+
+
+@cli.command()
+@click.option("--keep-last", default=5, show_default=True, help="Number of most recent generations to keep")
+@click.option("--keep-daily", default=7, show_default=True, help="Number of days to keep one generation for")
+@click.option("--keep-weekly", default=4, show_default=True, help="Number of weeks to keep one generation for")
+@click.option("-n", "--dry-run", is_flag=True, help="Only show which generations would be deleted")
+@click.option("-w", "--wait", is_flag=True, help="Wait for the subvolumes to be deleted")
+def gc(keep_last: int, keep_daily: int, keep_weekly: int, dry_run: bool = False, wait: bool = False) -> None:
+    "Delete old generations according to the retention policies"
+    from kod.gc import collect_garbage
+    from kod.generations import GenerationIndex
+    from kod.journal import REBUILD_JOURNAL
+
+    if Path(REBUILD_JOURNAL).is_file():
+        print("A rebuild did not finish, use kod rebuild --resume or --rollback before collecting generations")
+        sys.exit(1)
+    deleted = collect_garbage(
+        GenerationIndex.load(), keep_last, keep_daily, keep_weekly, dry_run=dry_run, background=not wait
+    )
+    print(f"{len(deleted)} generation(s) {'to delete' if dry_run else 'deleted'}")
+
+
+@cli.command()
+@click.option("-g", "--generation", type=int, required=True, help="Generation number to rollback to")
+@click.option("--next-boot", is_flag=True, help="Only use the generation for the next boot")
+def rollback(generation: int, next_boot: bool = False) -> None:
+    "Boot an existing generation, without rebuilding it"
+    from kod.core import rollback_generation
+
+    if not rollback_generation(generation, next_boot_only=next_boot):
+        sys.exit(1)
+    when = "at the next boot" if next_boot else "from the next boot on"
+    print(f"Generation {generation} will be used {when}")
+
+
+@cli.command(name="export")
+@click.option("-g", "--generation", type=int, required=True, help="Generation number to export")
+@click.option("-p", "--parent", type=int, default=None, help="Exported generation to send the differences from")
+@click.option("-o", "--output", required=True, help="Directory where the export is written")
+@click.option("-l", "--level", default=3, show_default=True, help="zstd compression level")
+def export_generation(generation: int, parent: Optional[int], output: str, level: int = 3) -> None:
+    "Export a generation as a btrfs send stream"
+    from kod.transfer import export_generation as export
+
+    if not export(generation, output, parent=parent, compression_level=level):
+        sys.exit(1)
+
+
+@cli.command(name="import")
+@click.argument("path")
+def import_generation(path: str) -> None:
+    "Import a generation exported with kod export"
+    from kod.core import load_fstab
+    from kod.mounts import enter_private_mount_namespace
+    from kod.transfer import import_generation as import_
+
+    # The partitions of this machine are the ones of the running system
+    devices = {part.destination: part.source for part in load_fstab("/")}
+    missing = [mount_point for mount_point in ["/", "/boot"] if mount_point not in devices]
+    if missing:
+        print(f"No {' or '.join(missing)} partition in /etc/fstab, the generation cannot be imported")
+        sys.exit(1)
+    enter_private_mount_namespace()
+    if import_(path, devices["/boot"], devices["/"]) is None:
+        sys.exit(1)
+
+
+@cli.group()
+def image() -> None:
+    "Build disk images"
+
+
+@image.command(name="build")
+@click.option("-c", "--config", default=None, help="System configuration file")
+@click.option("-o", "--output", required=True, help="Image file to create")
+@click.option("-s", "--size", default="20G", show_default=True, help="Size of the disk image")
+@click.option(
+    "-f",
+    "--format",
+    "image_format",
+    type=click.Choice(IMAGE_FORMATS),
+    default="raw",
+    show_default=True,
+    help="Format of the image",
+)
+@click.option("-l", "--level", default=3, show_default=True, help="zstd compression level")
+@click.option("-m", "--mount_point", default="/mnt", help="Mount point used to install")
+@click.pass_context
+def build_image(
+    ctx: click.Context,
+    config: Optional[str],
+    output: str,
+    size: str,
+    image_format: str,
+    level: int = 3,
+    mount_point: str = "/mnt",
+) -> None:
+    "Build a bootable disk image from a configuration"
+    from kod.image import attach_loop_device, convert_image, create_image_file, detach_loop_device, raw_image_path
+    from kod.preflight import parse_size
+
+    if parse_size(size) is None:
+        print(f"Invalid image size '{size}'")
+        sys.exit(1)
+
+    raw_image = raw_image_path(output, image_format)
+    create_image_file(raw_image, size)
+    device = attach_loop_device(raw_image)
+    print(f"Image {raw_image} attached to {device}")
+    try:
+        ctx.invoke(install, config=config, mount_point=mount_point, device=device, portable=True)
+    finally:
+        detach_loop_device(device)
+    convert_image(raw_image, output, image_format, compression_level=level)
+    print(f"Image written to {output}")
 
-#     # print("Recreating grub.cfg")
-#     # exec("grub-mkconfig -o /boot/grub/grub.cfg")
-#     print("Done")
 
 ##############################################################################
 
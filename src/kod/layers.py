@@ -0,0 +1,153 @@
+"""Cache of the base root filesystem of KodOS installations.
+
+Bootstrapping the base system (pacstrap or debootstrap) downloads and installs
+the same packages on every installation. The resulting root filesystem is stored
+as a zstd compressed tarball, keyed by the distribution, the base package list
+and the versions the package manager resolves for it, and later installations
+with the same key extract the tarball instead of bootstrapping again.
+
+The cache lives on the machine running the installation, while the root
+filesystem is created on a new filesystem, so a tarball is used rather than a
+btrfs snapshot, which cannot cross filesystems. Files that must be unique to each
+installation (machine-id, package signing keys) are not stored and are created
+again by the distribution after the layer is restored.
+"""
+
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from kod.common import exec, exec_critical
+from kod.generations import hash_value
+
+BASE_CACHE_PATH: str = "/var/cache/kod/base"
+
+# Number of base layers kept in the cache
+MAX_BASE_LAYERS: int = 3
+
+# Files of the root filesystem that are unique to each installation
+LAYER_EXCLUDES: List[str] = ["./etc/machine-id", "./etc/pacman.d/gnupg"]
+
+_tar_options = "--xattrs --xattrs-include='*' --acls --numeric-owner"
+
+
+def base_layer_key(distribution: str, base_pkgs: Dict[str, Any], versions: str) -> str:
+    """Compute the cache key of a base layer.
+
+    Args:
+        distribution: The base distribution name.
+        base_pkgs: The packages returned by `get_base_packages`.
+        versions: The resolved package versions, as returned by `resolve_base_versions`.
+
+    Returns:
+        The key of the base layer.
+    """
+    packages = sorted([base_pkgs["kernel"]] + list(base_pkgs["base"]))
+    return hash_value({"distribution": distribution, "packages": packages, "versions": versions})
+
+
+def layer_path(key: str, cache_path: str = BASE_CACHE_PATH) -> str:
+    """Get the path of the tarball of a base layer."""
+    return f"{cache_path}/{key}.tar.zst"
+
+
+def store_base_layer(mount_point: str, key: str, cache_path: str = BASE_CACHE_PATH) -> None:
+    """Store the root filesystem at the mount point as a base layer.
+
+    Only the root filesystem itself is stored: the other filesystems and the
+    store directories bind mounted into it are skipped.
+
+    Args:
+        mount_point: Mount point of the root filesystem.
+        key: Key of the base layer.
+        cache_path: Directory of the cache. Defaults to /var/cache/kod/base.
+    """
+    path = layer_path(key, cache_path)
+    excludes = " ".join(f"--exclude={name}" for name in LAYER_EXCLUDES)
+    exec(f"mkdir -p {cache_path}")
+    # Written to a temporary file first, so that an interrupted store leaves no partial layer
+    exec_critical(
+        f"tar -I 'zstd -T0 -3' {_tar_options} --one-file-system {excludes} -cpf {path}.tmp -C {mount_point} .",
+        "Failed to store the base layer",
+    )
+    exec_critical(f"mv {path}.tmp {path}", "Failed to store the base layer")
+    with open(f"{cache_path}/{key}.json", "w") as f:
+        f.write(json.dumps({"key": key, "created": time.strftime("%Y-%m-%dT%H:%M:%S")}, indent=2))
+
+
+def restore_base_layer(mount_point: str, key: str, cache_path: str = BASE_CACHE_PATH) -> None:
+    """Extract a base layer into the root filesystem at the mount point.
+
+    Args:
+        mount_point: Mount point of the root filesystem.
+        key: Key of the base layer.
+        cache_path: Directory of the cache. Defaults to /var/cache/kod/base.
+    """
+    exec_critical(
+        f"tar -I 'zstd -T0' {_tar_options} -xpf {layer_path(key, cache_path)} -C {mount_point}",
+        "Failed to restore the base layer",
+    )
+    # Mark the layer as recently used, for the pruning of the cache
+    Path(layer_path(key, cache_path)).touch()
+
+
+def prune_base_layers(cache_path: str = BASE_CACHE_PATH, keep: int = MAX_BASE_LAYERS) -> List[str]:
+    """Remove the least recently used base layers.
+
+    Args:
+        cache_path: Directory of the cache. Defaults to /var/cache/kod/base.
+        keep: Number of base layers to keep. Defaults to MAX_BASE_LAYERS.
+
+    Returns:
+        The keys of the removed base layers.
+    """
+    layers = sorted(Path(cache_path).glob("*.tar.zst"), key=lambda path: path.stat().st_mtime, reverse=True)
+    removed = []
+    for path in layers[keep:]:
+        key = path.name[: -len(".tar.zst")]
+        path.unlink()
+        Path(f"{cache_path}/{key}.json").unlink(missing_ok=True)
+        removed.append(key)
+    return removed
+
+
+def install_base_layer(
+    dist: Any,
+    distribution: str,
+    base_pkgs: Dict[str, Any],
+    mount_point: str,
+    cache_path: Optional[str] = BASE_CACHE_PATH,
+) -> bool:
+    """Install the base packages, using the base layer cache when possible.
+
+    When the versions of the base packages cannot be resolved, the cache is not
+    used, since a layer could not be told apart from an outdated one.
+
+    Args:
+        dist: The distribution module.
+        distribution: The base distribution name.
+        base_pkgs: The packages returned by `get_base_packages`.
+        mount_point: Mount point of the root filesystem.
+        cache_path: Directory of the cache, or None to disable it. Defaults to /var/cache/kod/base.
+
+    Returns:
+        True if the base layer was restored from the cache.
+    """
+    versions = dist.resolve_base_versions(base_pkgs) if cache_path else ""
+    if not versions:
+        dist.install_essentials_pkgs(base_pkgs, mount_point)
+        return False
+
+    key = base_layer_key(distribution, base_pkgs, versions)
+    if Path(layer_path(key, cache_path)).is_file():
+        print(f"Restoring cached base layer {key[:12]}")
+        restore_base_layer(mount_point, key, cache_path)
+        dist.finalize_base_layer(mount_point)
+        return True
+
+    dist.install_essentials_pkgs(base_pkgs, mount_point)
+    print(f"Storing base layer {key[:12]}")
+    store_base_layer(mount_point, key, cache_path)
+    prune_base_layers(cache_path)
+    return False
@@ -4,7 +4,7 @@ function disk_definition(device, swap_size)
    -- device to define the partitions on. (e.g., device = "/dev/vda")
    -- spap_size is the size of the swap partition (e.g., swap_size = "3GB") or nil
 
-   btrfs_options = "rw,noatime,compress-force=zstd:1,space_cache=v2"
+   local btrfs_options = "rw,noatime,compress-force=zstd:1,space_cache=v2"
       
    device_definition = {
       device = device,
@@ -34,6 +34,7 @@ function disk_definition(device, swap_size)
       name = "Root",
       size = "100%",
       type = "btrfs",
+      mountOptions = btrfs_options,
    }
 
    table.insert(partitions, root_part)
@@ -0,0 +1,185 @@
+"""Swap and compressed memory for KodOS.
+
+The `memory` section of the configuration sets up compressed swap in RAM with
+zram, a swapfile and the device used to resume from hibernation. The zram device
+is created at boot by zram-generator from a configuration file of the root
+filesystem, the swapfile is activated through the fstab, and the resume device
+is passed on the kernel command line, so all of them are part of each generation.
+
+The swapfile itself is shared by the generations: it lives in the `swap` btrfs
+subvolume at the top of the root partition, outside of the generation snapshots
+(a swapfile cannot be in a subvolume that is snapshotted), with copy-on-write
+disabled as btrfs requires.
+
+Example:
+    memory = {
+        zram = { enable = true, size = "min(ram / 2, 8192)", compression = "zstd", priority = 100 },
+        swapfile = { enable = true, size = "8G", priority = 10 },
+        resume = "swapfile",
+    }
+"""
+
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from kod.common import exec, exec_critical
+from kod.devices import device_uuid
+from kod.filesystem import FsEntry
+from kod.generations import lua_to_python
+from kod.preflight import parse_size
+
+ZRAM_CONFIG_FILE: str = "etc/systemd/zram-generator.conf"
+RESUME_PARAMS_FILE: str = "etc/kernel/kodos-resume.cmdline"
+
+# Subvolume of the swapfile, relative to the top of the root partition mounted at /kod
+SWAP_SUBVOLUME: str = "swap"
+SWAPFILE_PATH: str = f"/kod/{SWAP_SUBVOLUME}/swapfile"
+
+DEFAULT_ZRAM_PACKAGE: str = "zram-generator"
+DEFAULT_ZRAM_SIZE: str = "min(ram / 2, 4096)"
+DEFAULT_ZRAM_PRIORITY: int = 100
+
+
+def get_memory(conf: Any) -> Dict[str, Any]:
+    """Get the memory section of the configuration as plain Python data.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        The memory settings, empty if the section is missing.
+    """
+    memory = getattr(conf, "memory", None)
+    memory = lua_to_python(memory) if memory else {}
+    return memory if isinstance(memory, dict) else {}
+
+
+def _enabled(settings: Any) -> bool:
+    """Check whether a zram or swapfile setting is enabled, enable defaults to true."""
+    return isinstance(settings, dict) and settings.get("enable", True) is not False
+
+
+def get_memory_packages(conf: Any) -> List[str]:
+    """Get the packages required by the memory section.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        The zram-generator package when zram is enabled.
+    """
+    zram = get_memory(conf).get("zram")
+    if not _enabled(zram):
+        return []
+    return [zram.get("package") or DEFAULT_ZRAM_PACKAGE]
+
+
+def render_zram_config(zram: Any) -> str:
+    """Render the zram settings as a zram-generator configuration.
+
+    Args:
+        zram: The zram settings: size (an expression in MiB of the RAM size), compression
+            (compression algorithm) and priority (swap priority).
+
+    Returns:
+        The content of the configuration file, empty if zram is disabled.
+    """
+    if not _enabled(zram):
+        return ""
+    lines = [
+        "# Generated by kod from the memory section",
+        "[zram0]",
+        f"zram-size = {zram.get('size') or DEFAULT_ZRAM_SIZE}",
+    ]
+    if zram.get("compression"):
+        lines.append(f"compression-algorithm = {zram['compression']}")
+    lines.append(f"swap-priority = {zram.get('priority', DEFAULT_ZRAM_PRIORITY)}")
+    return "\n".join(lines) + "\n"
+
+
+def swap_entries(partition_list: List, swapfile: Any) -> List:
+    """Set the swapfile entry of a partition list.
+
+    Swap partitions are kept as they are, only the swapfile entry is managed.
+
+    Args:
+        partition_list: The list of FsEntry objects of the fstab.
+        swapfile: The swapfile settings: size and priority.
+
+    Returns:
+        The partition list with the swapfile entry added, updated or removed.
+    """
+    partition_list = [part for part in partition_list if part.source != SWAPFILE_PATH]
+    if _enabled(swapfile):
+        options = f"defaults,pri={swapfile['priority']}" if swapfile.get("priority") is not None else "defaults"
+        partition_list.append(FsEntry(SWAPFILE_PATH, "none", "swap", options))
+    return partition_list
+
+
+def active_swaps() -> List[str]:
+    """Get the paths of the active swap areas of the running system."""
+    swaps = Path("/proc/swaps")
+    if not swaps.is_file():
+        return []
+    return [line.split()[0] for line in swaps.read_text().splitlines()[1:] if line]
+
+
+def create_swapfile(kod_path: str, size: str) -> str:
+    """Create the swapfile in its NOCOW subvolume, unless it exists with the same size.
+
+    Args:
+        kod_path: Path where the top of the root partition is mounted (e.g. /mnt/kod).
+        size: Size of the swapfile (e.g. "8G").
+
+    Returns:
+        The path of the swapfile.
+    """
+    subvolume = f"{kod_path}/{SWAP_SUBVOLUME}"
+    path = f"{subvolume}/swapfile"
+    if not Path(subvolume).is_dir():
+        exec_critical(f"btrfs subvolume create {subvolume}", "Failed to create the swap subvolume")
+        exec_critical(f"chattr +C {subvolume}", "Failed to disable copy-on-write on the swap subvolume")
+    if Path(path).is_file():
+        if os.path.getsize(path) == parse_size(size):
+            print(f"Swapfile {path} is up to date")
+            return path
+        # A swapfile in use cannot be removed, the file seen by the host is the same
+        if SWAPFILE_PATH in active_swaps() and os.path.samefile(path, SWAPFILE_PATH):
+            exec_critical(f"swapoff {SWAPFILE_PATH}", "Failed to disable the swapfile")
+        exec(f"rm -f {path}")
+    exec_critical(f"btrfs filesystem mkswapfile --size {size} {path}", "Failed to create the swapfile")
+    return path
+
+
+def resume_params(resume: Any, partition_list: List, swapfile_path: Optional[str] = None) -> List[str]:
+    """Get the kernel command line options that select the resume device.
+
+    Args:
+        resume: "swapfile", a device path or UUID= specification, or None to use the
+            swap partition when there is a single one.
+        partition_list: The list of FsEntry objects of the fstab.
+        swapfile_path: Path of the swapfile, required to resume from it.
+
+    Returns:
+        The resume options, empty if there is no resume device.
+    """
+    if resume == "swapfile":
+        if not swapfile_path:
+            return []
+        root_fs = [part for part in partition_list if part.destination == "/"][0]
+        offset = exec(f"btrfs inspect-internal map-swapfile -r {swapfile_path}", get_output=True)
+        offset = offset.strip() if offset else ""
+        if not offset.isdigit():
+            print("Unknown offset of the swapfile, it cannot be used to resume")
+            return []
+        return [f"resume={root_fs.source_uuid()}", f"resume_offset={offset}"]
+    if not resume:
+        swaps = [part for part in partition_list if part.fs_type == "swap" and part.source != SWAPFILE_PATH]
+        if len(swaps) != 1:
+            return []
+        resume = swaps[0].source
+    if str(resume).startswith("/dev/"):
+        uuid = device_uuid(resume)
+        resume = f"UUID={uuid}" if uuid else resume
+    return [f"resume={resume}"]
@@ -0,0 +1,229 @@
+"""Mount management for KodOS.
+
+The filesystem hierarchy of a generation is described as an ordered list of
+desired mounts. The mount table of the process is compared with it, and only the
+operations needed to reach it are run: mounts that are already in place are
+skipped, mounts of another source at a desired mount point are removed first,
+and everything mounted below a mount point is unmounted children first. Mounting
+the same hierarchy twice is therefore a no-op, which makes interrupted builds
+cheap to resume.
+
+Builds of a new generation run in a private mount namespace, so that their
+mounts are not visible to the host and disappear when the process exits, even
+if it is interrupted.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from kod.common import exec, exec_critical, exec_warn
+from kod.devices import MOUNTINFO_PATH, read_mountinfo
+
+
+@dataclass
+class Mount:
+    """A desired mount.
+
+    Attributes:
+        source: Device, LABEL=/UUID= specification, or directory for bind mounts.
+        target: Absolute path of the mount point.
+        fs_type: Filesystem type, or an empty string to let mount detect it.
+        options: Mount options (e.g. subvol=store/home).
+        bind: If True, the source directory is bind mounted.
+    """
+
+    source: str
+    target: str
+    fs_type: str = ""
+    options: str = ""
+    bind: bool = False
+
+    def command(self) -> str:
+        """Return the mount command of this mount."""
+        if self.bind:
+            return f"mount --bind {self.source} {self.target}"
+        fs_type = f" -t {self.fs_type}" if self.fs_type else ""
+        options = f" -o {self.options}" if self.options else ""
+        return f"mount{fs_type}{options} {self.source} {self.target}"
+
+
+def _inside(path: str, mount_point: str) -> bool:
+    """Check whether a path is a mount point or lies below it."""
+    return path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+
+
+def _device_path(source: str) -> str:
+    """Resolve a device, LABEL= or UUID= specification to a device path."""
+    for prefix, directory in [("UUID=", "/dev/disk/by-uuid"), ("LABEL=", "/dev/disk/by-label")]:
+        if source.startswith(prefix):
+            source = f"{directory}/{source[len(prefix) :]}"
+    return os.path.realpath(source) if source.startswith("/dev/") else source
+
+
+def _subvolume(options: str) -> Optional[str]:
+    """Get the btrfs subvolume selected by mount options, as shown in the mount table."""
+    for option in options.split(","):
+        if option.startswith("subvol="):
+            return "/" + option[len("subvol=") :].strip("/")
+    return None
+
+
+def _top_mount(path: str, mounts: List[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    """Get the mount visible at a mount point, the last one mounted there."""
+    found = None
+    for mount in mounts:
+        if mount["mount_point"] == path:
+            found = mount
+    return found
+
+
+def _containing_mount(path: str, mounts: List[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    """Get the mount a path belongs to."""
+    found = None
+    for mount in mounts:
+        if _inside(path, mount["mount_point"]) and (
+            not found or len(mount["mount_point"]) >= len(found["mount_point"])
+        ):
+            found = mount
+    return found
+
+
+def is_mounted(desired: Mount, mounts: List[Dict[str, str]]) -> bool:
+    """Check whether a desired mount is the one visible at its mount point.
+
+    Args:
+        desired: The desired mount.
+        mounts: The mount table, as returned by `read_mountinfo`.
+
+    Returns:
+        True if the same filesystem and subvolume, or the same directory for a bind
+        mount, is mounted at the mount point.
+    """
+    current = _top_mount(desired.target, mounts)
+    if not current:
+        return False
+    if desired.bind:
+        source = _containing_mount(desired.source, mounts)
+        if not source:
+            return False
+        relative = os.path.relpath(desired.source, source["mount_point"])
+        root = os.path.normpath(os.path.join(source["root"], relative))
+        return current["device"] == source["device"] and current["root"] == root
+    if _device_path(current["source"]) != _device_path(desired.source):
+        return False
+    return current["root"] == (_subvolume(desired.options) or "/")
+
+
+def unmount_order(mount_point: str, mounts: List[Dict[str, str]]) -> List[str]:
+    """Get the mount points to unmount to release a mount point, children first.
+
+    Args:
+        mount_point: The mount point to release.
+        mounts: The mount table, as returned by `read_mountinfo`.
+
+    Returns:
+        The mount points at or below the mount point, in reverse topological order.
+    """
+    parents = {mount["mount_id"]: mount["parent_id"] for mount in mounts}
+
+    def depth(mount_id: str) -> int:
+        level = 0
+        while mount_id in parents and level < len(parents):
+            mount_id = parents[mount_id]
+            level += 1
+        return level
+
+    subtree = [(position, mount) for position, mount in enumerate(mounts) if _inside(mount["mount_point"], mount_point)]
+    subtree.sort(key=lambda item: (depth(item[1]["mount_id"]), item[0]), reverse=True)
+    return [mount["mount_point"] for _, mount in subtree]
+
+
+def plan_mounts(desired: List[Mount], mounts: List[Dict[str, str]]) -> Tuple[List[str], List[Mount]]:
+    """Compute the operations that turn the mount table into the desired mounts.
+
+    Args:
+        desired: The desired mounts, parents before children.
+        mounts: The mount table, as returned by `read_mountinfo`.
+
+    Returns:
+        A tuple with the mount points to unmount, in order, and the mounts to run, in order.
+    """
+    mounts = list(mounts)
+    unmounts: List[str] = []
+    to_mount: List[Mount] = []
+    for mount in desired:
+        # A new mount hides what was mounted below it, and changes what a bind mount of it shows
+        changed = any(
+            _inside(mount.target, done.target) or (mount.bind and _inside(mount.source, done.target))
+            for done in to_mount
+        )
+        if not changed and is_mounted(mount, mounts):
+            continue
+        if not changed and _top_mount(mount.target, mounts):
+            stale = unmount_order(mount.target, mounts)
+            unmounts += stale
+            mounts = [entry for entry in mounts if not _inside(entry["mount_point"], mount.target)]
+        to_mount.append(mount)
+    return unmounts, to_mount
+
+
+def apply_mounts(desired: List[Mount], mountinfo: str = MOUNTINFO_PATH) -> int:
+    """Mount the desired mounts that are not in place yet.
+
+    Args:
+        desired: The desired mounts, parents before children.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The number of mount and unmount operations run.
+    """
+    unmounts, to_mount = plan_mounts(desired, read_mountinfo(mountinfo))
+    for mount_point in unmounts:
+        exec_critical(f"umount {mount_point}", f"Failed to unmount {mount_point}")
+    for mount in to_mount:
+        exec(f"mkdir -p {mount.target}")
+        exec_critical(mount.command(), f"Failed to mount {mount.target}")
+    if not unmounts and not to_mount:
+        print("All mounts are in place")
+    return len(unmounts) + len(to_mount)
+
+
+def unmount_tree(mount_point: str, mountinfo: str = MOUNTINFO_PATH) -> List[str]:
+    """Unmount a mount point and everything mounted below it, children first.
+
+    Args:
+        mount_point: The mount point to release.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The unmounted mount points, in order. Empty if nothing was mounted.
+    """
+    mount_point = os.path.normpath(mount_point)
+    unmounts = unmount_order(mount_point, read_mountinfo(mountinfo))
+    for path in unmounts:
+        exec_warn(f"umount {path}", f"Failed to unmount {path}")
+    return unmounts
+
+
+def enter_private_mount_namespace() -> bool:
+    """Move the process to a private mount namespace.
+
+    The mounts done afterwards by the process and its children are not propagated
+    to the host, and are released by the kernel when the last process of the
+    namespace exits.
+
+    Returns:
+        True if the process is in a private mount namespace, False if the namespace
+        could not be created (e.g. without the CAP_SYS_ADMIN capability), in which
+        case mounts remain visible to the host.
+    """
+    try:
+        os.unshare(os.CLONE_NEWNS)
+    except OSError as e:
+        print(f"Private mount namespace not available ({e}), mounts are shared with the host")
+        return False
+    # Without this, mounts would still propagate to the host through the shared peer groups
+    exec_critical("mount --make-rprivate /", "Failed to make the mounts private")
+    print("Using a private mount namespace")
+    return True
@@ -0,0 +1,509 @@
+"""Preflight validation for KodOS installations and rebuilds.
+
+This module validates the whole configuration before any destructive or expensive
+step is executed. It checks the required configuration sections, the device and
+partition layout, the repository commands, the package names against the package
+index of the base distribution, and the available disk space.
+"""
+
+import re
+import shlex
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from kod.devices import get_block_device, read_mountinfo
+from kod.filesystem import HIERARCHY_SUBVOLUMES, is_supported_partition_type
+from kod.tuning import CPU_SETTINGS, IO_SCHEDULER_CLASSES, IO_SCHEDULERS, get_tuning
+
+# Minimum size left for the root partition when it takes the rest of the disk
+MIN_ROOT_SIZE: int = 8 * 1024**3
+
+# Minimum free space on /kod required to build a new generation
+MIN_REBUILD_FREE_SPACE: int = 2 * 1024**3
+
+# Minimum free space required to install into a directory target
+MIN_TARGET_FREE_SPACE: int = 4 * 1024**3
+
+# Repository commands required by the package management functions
+REQUIRED_REPO_COMMANDS: List[str] = ["install", "remove"]
+
+# Compression algorithms of the zram devices
+ZRAM_COMPRESSION_ALGORITHMS: List[str] = ["lzo", "lzo-rle", "lz4", "lz4hc", "zstd", "deflate", "842"]
+
+_size_units: Dict[str, int] = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4, "P": 1024**5}
+_size_pattern = re.compile(r"^(\d+(?:\.\d+)?)\s*([KMGTP]?)(?:i?B)?$", re.IGNORECASE)
+_hostname_pattern = re.compile(r"^(?!-)[A-Za-z0-9-]{1,63}(?<!-)$")
+
+
+@dataclass
+class PreflightError(Exception):
+    """Raised when the preflight validation finds problems in the configuration."""
+
+    problems: List[str]
+
+    def __post_init__(self):
+        super().__init__(f"Preflight validation failed with {len(self.problems)} problem(s)")
+
+
+def _get(table: Any, key: Any) -> Any:
+    """Get a value from a Lua table or a dictionary, returning None if it is missing."""
+    if table is None:
+        return None
+    try:
+        return table[key]
+    except (KeyError, TypeError, IndexError):
+        return None
+
+
+def parse_size(size: str) -> Optional[int]:
+    """Parse a partition size such as "1GB" or "512M" into bytes.
+
+    Args:
+        size: The size string from the partition definition.
+
+    Returns:
+        The size in bytes, or None if the size cannot be parsed.
+    """
+    match = _size_pattern.match(str(size).strip())
+    if not match:
+        return None
+    return int(float(match.group(1)) * _size_units[match.group(2).upper()])
+
+
+def get_device_size(device: str) -> Optional[int]:
+    """Get the size of a block device in bytes from sysfs.
+
+    Args:
+        device: Block device path (e.g. /dev/vda).
+
+    Returns:
+        The size in bytes, or None if it cannot be determined.
+    """
+    block_device = get_block_device(device)
+    return block_device.size if block_device else None
+
+
+def get_filesystem_type(path: str, mountinfo: str = "/proc/self/mountinfo") -> Optional[str]:
+    """Get the type of the filesystem a path belongs to.
+
+    Args:
+        path: Path to look up.
+        mountinfo: Path to the mountinfo table. Defaults to /proc/self/mountinfo.
+
+    Returns:
+        The filesystem type of the longest mount point containing the path, or
+        None if it cannot be determined.
+    """
+    resolved = str(Path(path).resolve())
+    best_mount = ""
+    best_type = None
+    for mount in read_mountinfo(mountinfo):
+        mount_point = mount["mount_point"]
+        inside = resolved == mount_point or resolved.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) >= len(best_mount):
+            best_mount = mount_point
+            best_type = mount["fs_type"]
+    return best_type
+
+
+def check_locale(conf: Any) -> List[str]:
+    """Check the locale section of the configuration.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    locale_conf = _get(conf, "locale")
+    if not locale_conf:
+        return ["locale: section is missing"]
+    if not _get(_get(locale_conf, "locale"), "default"):
+        problems.append("locale: locale.default is missing")
+    time_zone = _get(locale_conf, "timezone")
+    if not time_zone:
+        problems.append("locale: timezone is missing")
+    elif Path("/usr/share/zoneinfo").is_dir() and not Path(f"/usr/share/zoneinfo/{time_zone}").exists():
+        problems.append(f"locale: unknown timezone '{time_zone}'")
+    return problems
+
+
+def check_network(conf: Any) -> List[str]:
+    """Check the network section of the configuration.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        List of problems found.
+    """
+    network_conf = _get(conf, "network")
+    if not network_conf:
+        return ["network: section is missing"]
+    hostname = _get(network_conf, "hostname")
+    if not hostname:
+        return ["network: hostname is missing"]
+    if not _hostname_pattern.match(str(hostname)):
+        return [f"network: invalid hostname '{hostname}'"]
+    return []
+
+
+def check_boot(conf: Any) -> List[str]:
+    """Check the boot section of the configuration.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        List of problems found.
+    """
+    boot_conf = _get(conf, "boot")
+    if not boot_conf:
+        return ["boot: section is missing"]
+    loader_conf = _get(boot_conf, "loader")
+    if not loader_conf:
+        return ["boot: loader is missing"]
+    boot_type = _get(loader_conf, "type") or "systemd-boot"
+    if boot_type not in ["systemd-boot", "grub"]:
+        return [f"boot: unknown loader type '{boot_type}'"]
+    if _get(loader_conf, "uki") and boot_type != "systemd-boot":
+        return ["boot: unified kernel images require systemd-boot"]
+    return []
+
+
+def check_users(conf: Any) -> List[str]:
+    """Check the users section of the configuration.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    users = _get(conf, "users")
+    if not users:
+        return problems
+    for user, info in users.items():
+        if user != "root" and not _get(info, "name"):
+            problems.append(f"users: user '{user}' has no name")
+    return problems
+
+
+def check_tuning(conf: Any) -> List[str]:
+    """Check the tuning section of the configuration.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    tuning = get_tuning(conf)
+    for section in tuning:
+        if section not in ["sysctl", "io_scheduler", "cpu", "kernel_params"]:
+            problems.append(f"tuning: unknown setting '{section}'")
+    for device_class, scheduler in (tuning.get("io_scheduler") or {}).items():
+        if device_class not in IO_SCHEDULER_CLASSES:
+            problems.append(f"tuning: unknown device class '{device_class}' in io_scheduler")
+        elif scheduler not in IO_SCHEDULERS:
+            problems.append(f"tuning: unknown I/O scheduler '{scheduler}' for {device_class}")
+    for name in tuning.get("cpu") or {}:
+        if name not in CPU_SETTINGS:
+            problems.append(f"tuning: unknown cpu setting '{name}'")
+    for key in tuning.get("sysctl") or {}:
+        if not key or re.search(r"[\s=]", key):
+            problems.append(f"tuning: invalid sysctl key '{key}'")
+    return problems
+
+
+def check_memory(conf: Any) -> List[str]:
+    """Check the memory section of the configuration.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    memory = _get(conf, "memory")
+    if not memory:
+        return problems
+    zram = _get(memory, "zram")
+    compression = _get(zram, "compression")
+    if compression and compression not in ZRAM_COMPRESSION_ALGORITHMS:
+        problems.append(f"memory: unknown zram compression algorithm '{compression}'")
+    swapfile = _get(memory, "swapfile")
+    swapfile_enabled = bool(swapfile) and _get(swapfile, "enable") is not False
+    if swapfile_enabled and parse_size(_get(swapfile, "size")) is None:
+        problems.append(f"memory: invalid swapfile size '{_get(swapfile, 'size')}'")
+    resume = _get(memory, "resume")
+    if resume == "swapfile" and not swapfile_enabled:
+        problems.append("memory: resume uses the swapfile, but there is no swapfile")
+    elif resume and resume != "swapfile" and not re.match(r"^(/dev/|UUID=|PARTUUID=|LABEL=)", str(resume)):
+        problems.append(f"memory: invalid resume device '{resume}'")
+    return problems
+
+
+def check_devices(conf: Any, check_hardware: bool = True) -> List[str]:
+    """Check the device and partition layout.
+
+    Args:
+        conf: The configuration table.
+        check_hardware: If True, also check that the devices exist and are large
+            enough for the partitions. Defaults to True.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    devices = _get(conf, "devices")
+    if not devices:
+        return ["devices: section is missing"]
+
+    boot_partitions = 0
+    root_partitions = 0
+    for d_id, disk in devices.items():
+        device = _get(disk, "device")
+        if not device:
+            problems.append(f"devices.{d_id}: device is missing")
+            continue
+        partitions = _get(disk, "partitions")
+        if not partitions:
+            continue
+
+        fixed_size = 0
+        fill_partitions = 0
+        for pid, part in partitions.items():
+            name = _get(part, "name")
+            size = _get(part, "size")
+            filesystem_type = _get(part, "type")
+            where = f"devices.{d_id}.partitions[{pid}]"
+            if not name:
+                problems.append(f"{where}: name is missing")
+            elif name.lower() == "boot":
+                boot_partitions += 1
+            elif name.lower() == "root":
+                root_partitions += 1
+
+            if not is_supported_partition_type(filesystem_type):
+                problems.append(f"{where}: unsupported partition type '{filesystem_type}'")
+
+            subvolume_options = _get(part, "subvolumeOptions")
+            for subvol in subvolume_options.keys() if subvolume_options else []:
+                if subvol not in HIERARCHY_SUBVOLUMES:
+                    problems.append(f"{where}: unknown subvolume '{subvol}' in subvolumeOptions")
+
+            store_paths = _get(part, "storePaths")
+            for path in store_paths.keys() if store_paths else []:
+                parts = str(path).strip("/").split("/")
+                if parts[0] in ["", "home", "boot", "kod"] or ".." in parts:
+                    problems.append(f"{where}: invalid store path '{path}' in storePaths")
+
+            if size == "100%":
+                fill_partitions += 1
+            elif parse_size(size) is None:
+                problems.append(f"{where}: invalid size '{size}'")
+            else:
+                fixed_size += parse_size(size)
+
+        if fill_partitions > 1:
+            problems.append(f"devices.{d_id}: only one partition can use the remaining space")
+
+        if check_hardware:
+            if not Path(device).is_block_device():
+                problems.append(f"devices.{d_id}: {device} is not a block device")
+                continue
+            device_size = get_device_size(device)
+            required = fixed_size + (MIN_ROOT_SIZE if fill_partitions else 0)
+            if device_size is not None and required > device_size:
+                problems.append(
+                    f"devices.{d_id}: {device} has {device_size // 1024**2} MiB, {required // 1024**2} MiB are required"
+                )
+
+    if boot_partitions != 1:
+        problems.append(f"devices: expected one boot partition, found {boot_partitions}")
+    if root_partitions != 1:
+        problems.append(f"devices: expected one root partition, found {root_partitions}")
+    return problems
+
+
+def check_target(target: str) -> List[str]:
+    """Check a directory used as installation target.
+
+    Args:
+        target: Directory or subvolume where KodOS is installed.
+
+    Returns:
+        List of problems found.
+    """
+    if not Path(target).is_dir():
+        return [f"target: {target} is not a directory"]
+    fs_type = get_filesystem_type(target)
+    if fs_type is not None and fs_type != "btrfs":
+        return [f"target: {target} is on a {fs_type} filesystem, btrfs is required"]
+    return check_free_space(target, MIN_TARGET_FREE_SPACE)
+
+
+def check_repos(conf: Any, check_commands: bool = True) -> List[str]:
+    """Check the repository definitions and their command strings.
+
+    Args:
+        conf: The configuration table.
+        check_commands: If True, check that the commands of repositories that do not
+            need to be built or installed are available. Defaults to True.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    repos = _get(conf, "repos")
+    if not repos:
+        return ["repos: section is missing"]
+    for repo, repo_desc in repos.items():
+        commands = _get(repo_desc, "commands")
+        if not commands:
+            problems.append(f"repos.{repo}: commands are missing")
+            continue
+        for action in REQUIRED_REPO_COMMANDS:
+            if not _get(commands, action):
+                problems.append(f"repos.{repo}: '{action}' command is missing")
+        missing_tools = []
+        for action, cmd in commands.items():
+            if action == "run_as_root":
+                continue
+            if not isinstance(cmd, str) or not cmd.strip():
+                problems.append(f"repos.{repo}: '{action}' command must be a non empty string")
+                continue
+            try:
+                args = shlex.split(cmd)
+            except ValueError as e:
+                problems.append(f"repos.{repo}: '{action}' command cannot be parsed ({e})")
+                continue
+            needs_setup = _get(repo_desc, "build") or _get(repo_desc, "package")
+            if check_commands and not needs_setup and args and shutil.which(args[0]) is None:
+                if args[0] not in missing_tools:
+                    missing_tools.append(args[0])
+                    problems.append(f"repos.{repo}: '{args[0]}' is not available")
+    return problems
+
+
+def check_packages(conf: Any, dist: Any, packages_to_install: Dict[str, Any]) -> List[str]:
+    """Check the packages to install against the repositories and the package index.
+
+    Packages prefixed with a repository name (e.g. "aur:pkg") must use a defined
+    repository. Packages without a prefix are installed from the "official"
+    repository and are checked against the package index of the distribution.
+
+    Args:
+        conf: The configuration table.
+        dist: The distribution module.
+        packages_to_install: The resolved packages as returned by `get_packages_to_install`.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    repos = _get(conf, "repos")
+    repo_names = list(repos.keys()) if repos else []
+
+    packages = [packages_to_install["kernel"]] + packages_to_install.get("base", [])
+    packages += packages_to_install.get("packages", [])
+    official_packages = []
+    for pkg in packages:
+        if ":" in pkg:
+            repo = pkg.split(":")[0]
+            if repo not in repo_names:
+                problems.append(f"packages: '{pkg}' uses undefined repository '{repo}'")
+        else:
+            official_packages.append(pkg)
+
+    pending = sorted(set(packages_to_install.get("packages", [])) & set(official_packages))
+    if pending and "official" not in repo_names:
+        problems.append("repos: an 'official' repository is required for packages without a prefix")
+
+    for pkg in dist.find_missing_packages(sorted(set(official_packages))):
+        problems.append(f"packages: '{pkg}' was not found in the package index")
+    return problems
+
+
+def check_free_space(path: str, required: int) -> List[str]:
+    """Check that a path has enough free space.
+
+    Args:
+        path: Path on the filesystem to check.
+        required: Required free space in bytes.
+
+    Returns:
+        List of problems found.
+    """
+    if not Path(path).exists():
+        return []
+    free = shutil.disk_usage(path).free
+    if free < required:
+        return [f"disk: {path} has {free // 1024**2} MiB free, {required // 1024**2} MiB are required"]
+    return []
+
+
+def preflight_checks(
+    conf: Any, dist: Any, packages_to_install: Dict[str, Any], install: bool = True, target: Optional[str] = None
+) -> List[str]:
+    """Run every preflight check on the configuration.
+
+    Args:
+        conf: The configuration table.
+        dist: The distribution module.
+        packages_to_install: The resolved packages as returned by `get_packages_to_install`.
+        install: If True, the devices are checked for an installation. Otherwise the
+            free space for a new generation is checked. Defaults to True.
+        target: Directory used as installation target. The devices are not checked,
+            since they are not partitioned. Defaults to None.
+
+    Returns:
+        List of problems found.
+    """
+    problems = []
+    problems += check_locale(conf)
+    problems += check_network(conf)
+    problems += check_boot(conf)
+    problems += check_users(conf)
+    problems += check_tuning(conf)
+    problems += check_memory(conf)
+    if target:
+        problems += check_target(target)
+    else:
+        problems += check_devices(conf, check_hardware=install)
+    problems += check_repos(conf, check_commands=install)
+    problems += check_packages(conf, dist, packages_to_install)
+    if not install:
+        problems += check_free_space("/kod", MIN_REBUILD_FREE_SPACE)
+    return problems
+
+
+def run_preflight(
+    conf: Any, dist: Any, packages_to_install: Dict[str, Any], install: bool = True, target: Optional[str] = None
+) -> None:
+    """Run the preflight checks and report the problems found.
+
+    Args:
+        conf: The configuration table.
+        dist: The distribution module.
+        packages_to_install: The resolved packages as returned by `get_packages_to_install`.
+        install: If True, validate for an installation, otherwise for a rebuild. Defaults to True.
+        target: Directory used as installation target instead of the devices. Defaults to None.
+
+    Raises:
+        PreflightError: If any problem was found.
+    """
+    print("==== Preflight checks ====")
+    problems = preflight_checks(conf, dist, packages_to_install, install=install, target=target)
+    if problems:
+        for problem in problems:
+            print(f"  - {problem}")
+        raise PreflightError(problems)
+    print("Preflight checks passed")
@@ -0,0 +1,204 @@
+"""Export and import of KodOS generations.
+
+A generation is exported as a directory containing a zstd compressed btrfs send
+stream of its root filesystem, its metadata files, and the kernel and initramfs
+used by its boot entry. The stream can be incremental, relative to a parent
+generation that was exported before, so that machines which already imported
+the parent only receive the differences.
+
+Read-only snapshots of the exported generations are kept in /kod/exports on the
+sending machine and the received snapshots in /kod/received on the receiving
+machine, since incremental streams need the parent snapshot on both sides.
+"""
+
+import json
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from kod.common import exec, exec_critical
+from kod.esp import BootArtifactStore
+from kod.generations import GENERATIONS_PATH, GenerationIndex
+from kod.mounts import unmount_tree
+from kod.tuning import get_kernel_params
+from kod.uki import uki_enabled
+
+EXPORTS_PATH: str = "/kod/exports"
+RECEIVED_PATH: str = "/kod/received"
+
+# Files stored with each generation that are exported with it
+METADATA_FILES: List[str] = ["installed_packages", "enabled_services", "packages.lock", "config_hashes"]
+
+STREAM_FILE: str = "rootfs.btrfs.zst"
+METADATA_FILE: str = "generation.json"
+
+
+def snapshot_name(generation: int) -> str:
+    """Return the name of the read-only snapshot used to send a generation."""
+    return f"generation-{generation}"
+
+
+def boot_files(kver: str, initrd: Optional[str] = None) -> List[str]:
+    """Return the files on the ESP used by the boot entry of a generation.
+
+    Args:
+        kver (str): Kernel version of the generation.
+        initrd (str, optional): Initramfs image of the generation. Defaults to the
+            image name used before images were content-addressed.
+    """
+    return [f"vmlinuz-{kver}", initrd or f"initramfs-linux-{kver}.img"]
+
+
+def export_generation(generation: int, output: str, parent: Optional[int] = None, compression_level: int = 3) -> bool:
+    """
+    Export a generation as a compressed btrfs send stream with its metadata.
+
+    Args:
+        generation (int): The generation to export.
+        output (str): Directory where the export is written.
+        parent (int, optional): Previously exported generation used as the base of an
+            incremental stream. Defaults to None (full stream).
+        compression_level (int, optional): zstd compression level. Defaults to 3.
+
+    Returns:
+        bool: True if the generation was exported.
+    """
+    index = GenerationIndex.load()
+    entry = index.get(generation)
+    if entry is None or entry["status"] != "complete":
+        print(f"Generation {generation} not found or not complete")
+        return False
+
+    parent_snapshot = None
+    if parent is not None:
+        parent_snapshot = f"{EXPORTS_PATH}/{snapshot_name(parent)}"
+        if not Path(parent_snapshot).is_dir():
+            print(f"Generation {parent} was never exported, it cannot be used as parent")
+            return False
+
+    snapshot = f"{EXPORTS_PATH}/{snapshot_name(generation)}"
+    if not Path(snapshot).is_dir():
+        exec(f"mkdir -p {EXPORTS_PATH}")
+        exec_critical(
+            f"btrfs subvolume snapshot -r {GENERATIONS_PATH}/{generation}/rootfs {snapshot}",
+            f"Failed to snapshot generation {generation}",
+        )
+
+    Path(output).mkdir(parents=True, exist_ok=True)
+    parent_option = f"-p {parent_snapshot} " if parent_snapshot else ""
+    print(f"Exporting generation {generation}" + (f" relative to generation {parent}" if parent is not None else ""))
+    exec_critical(
+        f"bash -o pipefail -c 'btrfs send {parent_option}{snapshot} | zstd -T0 -{compression_level} -q -f "
+        f"-o {output}/{STREAM_FILE}'",
+        "Failed to send the generation",
+    )
+
+    for name in METADATA_FILES:
+        state_file = Path(f"{GENERATIONS_PATH}/{generation}/{name}")
+        if state_file.is_file():
+            shutil.copy(state_file, f"{output}/{name}")
+    for name in boot_files(entry["kver"], entry.get("initrd")) if entry["kver"] else []:
+        if Path(f"/boot/{name}").is_file():
+            shutil.copy(f"/boot/{name}", f"{output}/{name}")
+
+    metadata = {"generation": generation, "parent": parent, "snapshot": snapshot_name(generation), "entry": entry}
+    with open(f"{output}/{METADATA_FILE}", "w") as f:
+        f.write(json.dumps(metadata, indent=2))
+    print(f"Generation {generation} exported to {output}")
+    return True
+
+
+def find_imported_generation(index: Any, source: int) -> Optional[int]:
+    """
+    Find the local generation created by importing a generation of the build machine.
+
+    Args:
+        index (GenerationIndex): The generation index.
+        source (int): Generation number on the machine that exported it.
+
+    Returns:
+        int: The local generation number, or None if it was never imported.
+    """
+    for entry in index.generations():
+        if entry.get("source") == source:
+            return entry["id"]
+    return None
+
+
+def read_export_metadata(path: str) -> Dict[str, Any]:
+    """Read the metadata of an exported generation."""
+    with open(f"{path}/{METADATA_FILE}") as f:
+        return json.load(f)
+
+
+def import_generation(path: str, boot_partition: str, root_partition: str) -> Optional[int]:
+    """
+    Import a generation exported by `export_generation`.
+
+    The stream is received into /kod/received, a writable snapshot of it becomes
+    the root filesystem of a new local generation, its fstab is generated for this
+    machine, and its boot entry is created with `create_boot_entry`.
+
+    Args:
+        path (str): Directory containing the export.
+        boot_partition (str): Boot partition of this machine.
+        root_partition (str): Root partition of this machine.
+
+    Returns:
+        int: The number of the new generation, or None if the import failed.
+    """
+    from kod.core import create_boot_entry, create_next_generation, load_fstab
+
+    metadata = read_export_metadata(path)
+    index = GenerationIndex.load()
+    parent = None
+    if metadata["parent"] is not None:
+        parent = find_imported_generation(index, metadata["parent"])
+        if not Path(f"{RECEIVED_PATH}/{snapshot_name(metadata['parent'])}").is_dir():
+            print(f"Generation {metadata['parent']} of the exporting machine must be imported first")
+            return None
+
+    received = f"{RECEIVED_PATH}/{metadata['snapshot']}"
+    if not Path(received).is_dir():
+        exec(f"mkdir -p {RECEIVED_PATH}")
+        exec_critical(
+            f"bash -o pipefail -c 'zstd -dc {path}/{STREAM_FILE} | btrfs receive {RECEIVED_PATH}'",
+            "Failed to receive the generation",
+        )
+
+    source_entry = metadata["entry"]
+    kver = source_entry["kver"]
+    initrd = source_entry.get("initrd")
+
+    # Registered before anything is written, so that a failed import never hands its number to another build
+    generation = index.allocate(
+        parent, config_hash=source_entry["config_hash"], kver=kver, packages=source_entry["packages"]
+    )["id"]
+    state_path = f"{GENERATIONS_PATH}/{generation}"
+    exec(f"mkdir -p {state_path}")
+    exec_critical(f"btrfs subvolume snapshot {received} {state_path}/rootfs", "Failed to create the generation")
+    for name in METADATA_FILES:
+        if Path(f"{path}/{name}").is_file():
+            shutil.copy(f"{path}/{name}", f"{state_path}/{name}")
+
+    store = BootArtifactStore.load()
+    for name in boot_files(kver, initrd) if kver else []:
+        if Path(f"{path}/{name}").is_file() and not Path(f"/boot/{name}").is_file():
+            store.add_file(f"{path}/{name}", name)
+
+    # Mounting the generation generates its fstab for the partitions of this machine
+    next_root = create_next_generation(boot_partition, root_partition, generation)
+    create_boot_entry(
+        generation,
+        load_fstab(next_root),
+        get_kernel_params(next_root),
+        mount_point=next_root,
+        kver=kver,
+        initrd=initrd,
+        uki=uki_enabled(f"{next_root}/boot"),
+    )
+    unmount_tree(next_root)
+
+    index.update(generation, status="complete", source=metadata["generation"], initrd=initrd)
+    print(f"Generation {metadata['generation']} imported as generation {generation}")
+    return generation
@@ -0,0 +1,220 @@
+"""Kernel and device tuning for KodOS.
+
+The `tuning` section of the configuration is rendered into files of the root
+filesystem: sysctl settings into /etc/sysctl.d, I/O schedulers per device class
+into udev rules, and the CPU frequency governor and energy/performance preference
+into a tmpfiles.d entry applied at boot. The kernel command line options are
+stored in the root filesystem too and read back when the boot entry of a
+generation is created, so every tuning setting is part of the generation
+snapshot and rolling back a generation rolls back its tuning.
+
+Example:
+    tuning = {
+        sysctl = { ["vm.swappiness"] = 10 },
+        io_scheduler = { nvme = "none", ssd = "mq-deadline", hdd = "bfq" },
+        cpu = { governor = "schedutil", energy_performance_preference = "balance_performance" },
+        kernel_params = { "nowatchdog", ["mitigations"] = "auto" },
+    }
+"""
+
+from pathlib import Path
+from typing import Any, Dict, List
+
+from kod.common import exec_warn
+from kod.generations import lua_to_python
+
+SYSCTL_FILE: str = "etc/sysctl.d/90-kodos-tuning.conf"
+IO_SCHEDULER_RULES_FILE: str = "etc/udev/rules.d/60-kodos-ioschedulers.rules"
+CPU_TMPFILES_FILE: str = "etc/tmpfiles.d/kodos-cpu.conf"
+KERNEL_PARAMS_FILE: str = "etc/kernel/kodos-tuning.cmdline"
+
+# Kernel command line options of the generation, written by tuning and by the other sections
+KERNEL_PARAMS_PATTERN: str = "etc/kernel/kodos-*.cmdline"
+
+# udev matches of each device class, NVMe disks are always non-rotational
+IO_SCHEDULER_CLASSES: Dict[str, str] = {
+    "nvme": 'KERNEL=="nvme[0-9]*n[0-9]*"',
+    "ssd": 'KERNEL=="sd[a-z]*|mmcblk[0-9]*|vd[a-z]*", ATTR{queue/rotational}=="0"',
+    "hdd": 'KERNEL=="sd[a-z]*|vd[a-z]*", ATTR{queue/rotational}=="1"',
+}
+
+IO_SCHEDULERS: List[str] = ["none", "mq-deadline", "kyber", "bfq"]
+
+CPU_SETTINGS: Dict[str, str] = {
+    "governor": "/sys/devices/system/cpu/cpufreq/policy*/scaling_governor",
+    "energy_performance_preference": "/sys/devices/system/cpu/cpufreq/policy*/energy_performance_preference",
+}
+
+
+def get_tuning(conf: Any) -> Dict[str, Any]:
+    """Get the tuning section of the configuration as plain Python data.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        The tuning settings, empty if the section is missing.
+    """
+    tuning = getattr(conf, "tuning", None)
+    tuning = lua_to_python(tuning) if tuning else {}
+    return tuning if isinstance(tuning, dict) else {}
+
+
+def _sysctl_value(value: Any) -> str:
+    """Format a sysctl value, booleans are written as 0 or 1."""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, list):
+        return " ".join(str(item) for item in value)
+    return str(value)
+
+
+def render_sysctl(settings: Dict[str, Any]) -> str:
+    """Render sysctl settings as a sysctl.d file.
+
+    Args:
+        settings: Dictionary mapping each sysctl key (e.g. vm.swappiness) to its value.
+
+    Returns:
+        The content of the file, empty if there are no settings.
+    """
+    if not settings:
+        return ""
+    lines = [f"{key} = {_sysctl_value(value)}" for key, value in sorted(settings.items())]
+    return "# Generated by kod from the tuning section\n" + "\n".join(lines) + "\n"
+
+
+def render_io_scheduler_rules(schedulers: Dict[str, str]) -> str:
+    """Render the I/O scheduler of each device class as udev rules.
+
+    Args:
+        schedulers: Dictionary mapping a device class (nvme, ssd or hdd) to a scheduler.
+
+    Returns:
+        The content of the rules file, empty if there are no schedulers.
+    """
+    rules = []
+    for device_class, match in IO_SCHEDULER_CLASSES.items():
+        scheduler = schedulers.get(device_class)
+        if scheduler:
+            rules.append(f'ACTION=="add|change", {match}, ATTR{{queue/scheduler}}="{scheduler}"')
+    if not rules:
+        return ""
+    return "# Generated by kod from the tuning section\n" + "\n".join(rules) + "\n"
+
+
+def render_cpu_tmpfiles(cpu: Dict[str, str]) -> str:
+    """Render the CPU frequency settings as a tmpfiles.d file.
+
+    The settings are written to sysfs by systemd-tmpfiles at boot, for every
+    cpufreq policy.
+
+    Args:
+        cpu: Dictionary with the governor and energy_performance_preference settings.
+
+    Returns:
+        The content of the file, empty if there are no settings.
+    """
+    lines = [f"w {path} - - - - {cpu[name]}" for name, path in CPU_SETTINGS.items() if cpu.get(name)]
+    if not lines:
+        return ""
+    return "# Generated by kod from the tuning section\n" + "\n".join(lines) + "\n"
+
+
+def kernel_params(params: Any) -> List[str]:
+    """Get the kernel command line options of the tuning section.
+
+    Args:
+        params: List of options, or table mapping options to values. In a table, a true
+            value adds the option as a flag, a false value omits it, and list items are
+            added first as they are.
+
+    Returns:
+        The kernel command line options, in order.
+    """
+    if not params:
+        return []
+    if isinstance(params, list):
+        return [str(param) for param in params]
+    # The list items of a mixed Lua table have numeric keys
+    items = sorted((int(key), value) for key, value in params.items() if key.isdigit())
+    options = [str(value) for _, value in items]
+    for key, value in params.items():
+        if key.isdigit() or value is False:
+            continue
+        options.append(key if value is True else f"{key}={value}")
+    return options
+
+
+def write_generated_file(path: Path, content: str) -> bool:
+    """Write a generated file, or remove it when there is no content.
+
+    Returns:
+        True if the file changed.
+    """
+    current = path.read_text() if path.is_file() else None
+    if not content:
+        if current is None:
+            return False
+        path.unlink()
+        return True
+    if current == content:
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return True
+
+
+def configure_tuning(conf: Any, mount_point: str) -> List[str]:
+    """Write the tuning settings of the configuration into a root filesystem.
+
+    Files of settings that are no longer configured are removed. When the running
+    system is configured in place, the changed settings are also applied to it; the
+    kernel command line options take effect on the next boot.
+
+    Args:
+        conf: The configuration table.
+        mount_point: The mount point of the root filesystem.
+
+    Returns:
+        The kernel command line options.
+    """
+    tuning = get_tuning(conf)
+    params = kernel_params(tuning.get("kernel_params"))
+
+    files = {
+        SYSCTL_FILE: render_sysctl(tuning.get("sysctl") or {}),
+        IO_SCHEDULER_RULES_FILE: render_io_scheduler_rules(tuning.get("io_scheduler") or {}),
+        CPU_TMPFILES_FILE: render_cpu_tmpfiles(tuning.get("cpu") or {}),
+        KERNEL_PARAMS_FILE: " ".join(params) + "\n" if params else "",
+    }
+    changed = [name for name, content in files.items() if write_generated_file(Path(mount_point) / name, content)]
+    if not changed:
+        print("Tuning settings are up to date")
+        return params
+    print(f"Updated tuning settings: {' '.join(changed)}")
+
+    if mount_point.rstrip("/") == "":
+        if SYSCTL_FILE in changed:
+            exec_warn("sysctl --system", "Failed to apply the sysctl settings")
+        if IO_SCHEDULER_RULES_FILE in changed:
+            exec_warn("udevadm control --reload", "Failed to reload the udev rules")
+            exec_warn("udevadm trigger --subsystem-match=block --action=change", "Failed to apply the I/O schedulers")
+        if CPU_TMPFILES_FILE in changed and files[CPU_TMPFILES_FILE]:
+            exec_warn(f"systemd-tmpfiles --create /{CPU_TMPFILES_FILE}", "Failed to apply the CPU settings")
+    return params
+
+
+def get_kernel_params(root_path: str) -> List[str]:
+    """Read the kernel command line options stored in a root filesystem, in file name order.
+
+    Args:
+        root_path: Path to the root filesystem of a generation.
+
+    Returns:
+        The kernel command line options, empty if none are configured.
+    """
+    params = []
+    for path in sorted(Path(root_path).glob(KERNEL_PARAMS_PATTERN)):
+        params += path.read_text().split()
+    return params
@@ -0,0 +1,180 @@
+"""Unified kernel images for KodOS.
+
+With `boot.loader.uki = true`, each generation boots from a unified kernel image
+(UKI) built with ukify: a single EFI binary with the kernel, the initramfs and the
+kernel command line of the generation, including its root subvolume. The images
+are written to EFI/Linux on the ESP, where systemd-boot lists them without a
+loader entry, and only one file has to be copied and verified per generation.
+
+Like the initramfs images, the images are named after a key of their inputs
+(the kernel, the initramfs image, the command line, the os-release data and the
+systemd stub), so an image is only built when no image with the same inputs
+exists.
+"""
+
+import hashlib
+import os
+import shlex
+from pathlib import Path
+from typing import Any, Optional
+
+from kod.common import exec, exec_chroot, exec_critical
+from kod.esp import UKI_DIR, BootArtifactStore, file_digest, generation_ukis, uki_name
+from kod.generations import hash_value
+
+# systemd stub used by ukify, relative to the root filesystem
+STUB_PATH: str = "usr/lib/systemd/boot/efi/linuxx64.efi.stub"
+
+
+def uki_requested(conf: Any) -> bool:
+    """Check whether the configuration asks for unified kernel images.
+
+    Args:
+        conf: The configuration table.
+
+    Returns:
+        True if `boot.loader.uki` is true.
+    """
+    boot = getattr(conf, "boot", None)
+    loader = boot["loader"] if boot and "loader" in boot else None
+    return bool(loader and "uki" in loader and loader["uki"])
+
+
+def uki_enabled(boot_path: str) -> bool:
+    """Check whether the generations boot from unified kernel images.
+
+    Used when the configuration is not available, e.g. to recreate the boot entry
+    of an imported generation.
+
+    Args:
+        boot_path: Mount point of the ESP.
+
+    Returns:
+        True if the ESP has KodOS unified kernel images.
+    """
+    return any(Path(f"{boot_path}/{UKI_DIR}").glob("kodos-*.efi"))
+
+
+def os_release(root_path: str, generation: int, kver: str) -> str:
+    """Get the os-release data embedded in the image of a generation.
+
+    systemd-boot shows and sorts the images by these fields, so the generation is
+    used as the image version.
+
+    Args:
+        root_path: Path to the root filesystem.
+        generation: Generation number.
+        kver: Kernel version.
+
+    Returns:
+        The os-release data.
+    """
+    path = Path(f"{root_path}/etc/os-release")
+    lines = path.read_text().splitlines() if path.is_file() else ['NAME="KodOS"']
+    lines = [line for line in lines if not line.startswith(("IMAGE_ID=", "IMAGE_VERSION=", "PRETTY_NAME="))]
+    lines += ["IMAGE_ID=kodos", f"IMAGE_VERSION={generation}", f'PRETTY_NAME="KodOS Generation {generation} ({kver})"']
+    return "\n".join(lines) + "\n"
+
+
+def _digest(path: str) -> str:
+    """Return the sha256 digest of a file, or an empty string if it does not exist."""
+    return file_digest(path) if Path(path).is_file() else ""
+
+
+def uki_key(kver: str, initrd: str, cmdline: str, release: str, root_path: str, boot_path: str) -> str:
+    """Compute the key of a unified kernel image.
+
+    Args:
+        kver: Kernel version.
+        initrd: File name of the initramfs image on the ESP.
+        cmdline: Kernel command line.
+        release: os-release data, as returned by `os_release`.
+        root_path: Path to the root filesystem the image is built from.
+        boot_path: Mount point of the ESP.
+
+    Returns:
+        The key of the image.
+    """
+    store = BootArtifactStore.load(boot_path)
+
+    def digest(name: str) -> str:
+        known = store.artifacts.get(name)
+        return known["sha256"] if known else _digest(f"{boot_path}/{name}")
+
+    inputs = {
+        "kernel": digest(f"vmlinuz-{kver}"),
+        "initrd": digest(initrd),
+        "cmdline": cmdline,
+        "os_release": hashlib.sha256(release.encode()).hexdigest(),
+        "stub": _digest(f"{root_path}/{STUB_PATH}"),
+    }
+    return hash_value(inputs)
+
+
+def build_uki(generation: int, kver: str, initrd: str, cmdline: str, mount_point: str = "/mnt") -> str:
+    """Build the unified kernel image of a generation, unless an identical one exists.
+
+    The image is built under a temporary name and renamed once complete. The
+    images of the generation built from other inputs are removed.
+
+    Args:
+        generation: Generation number.
+        kver: Kernel version.
+        initrd: File name of the initramfs image on the ESP, as returned by `build_initramfs`.
+        cmdline: Kernel command line.
+        mount_point: Mount point of the root filesystem, with the ESP mounted at /boot.
+            Defaults to "/mnt".
+
+    Returns:
+        The path of the image, relative to the ESP.
+    """
+    root = mount_point.rstrip("/")
+    boot_path = f"{root}/boot"
+    release = os_release(root, generation, kver)
+    name = uki_name(generation, kver, uki_key(kver, initrd, cmdline, release, root, boot_path))
+
+    store = BootArtifactStore.load(boot_path)
+    for old in generation_ukis(boot_path, generation):
+        if old != name:
+            store.remove(old)
+    if Path(f"{boot_path}/{name}").is_file():
+        print(f"Reusing unified kernel image {name}")
+        return name
+
+    sizes = [f"{boot_path}/vmlinuz-{kver}", f"{boot_path}/{initrd}"]
+    store.ensure_free_space(sum(os.path.getsize(path) for path in sizes if Path(path).is_file()))
+    Path(f"{boot_path}/{UKI_DIR}").mkdir(parents=True, exist_ok=True)
+    release_path = f"{root}/tmp/kodos-os-release-{generation}"
+    Path(release_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(release_path).write_text(release)
+
+    ukify = (
+        f"ukify build --linux=/boot/vmlinuz-{kver} --initrd=/boot/{initrd} --uname={kver}"
+        f" --cmdline={shlex.quote(cmdline)} --os-release=@/tmp/kodos-os-release-{generation}"
+        f" --output=/boot/{name}.tmp"
+    )
+    if root:
+        exec_chroot(ukify, mount_point=mount_point)
+    else:
+        exec(ukify)
+    Path(release_path).unlink(missing_ok=True)
+    exec_critical(
+        f"mv {boot_path}/{name}.tmp {boot_path}/{name}", f"Failed to build the unified kernel image of {kver}"
+    )
+    if Path(f"{boot_path}/{name}").is_file():
+        store.register(name)
+    return name
+
+
+def generation_uki(generation: int, boot_path: str = "/boot") -> Optional[str]:
+    """Get the unified kernel image used to boot a generation.
+
+    Args:
+        generation: Generation number.
+        boot_path: Mount point of the ESP. Defaults to /boot.
+
+    Returns:
+        The path of the newest image of the generation, relative to the ESP, or None.
+    """
+    images = generation_ukis(boot_path, generation)
+    return images[0] if images else None
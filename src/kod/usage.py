@@ -0,0 +1,190 @@
+"""Disk usage accounting of KodOS generations.
+
+This module computes the exclusive and shared bytes held by each generation.
+When btrfs quotas are enabled the values are read from the qgroups, which the
+kernel keeps up to date. Otherwise they are computed with `btrfs filesystem du`,
+which walks the extents of the subvolume, so the results are cached in the
+generation index and only the generations that changed, or whose neighbours
+changed, are measured again.
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from kod.common import exec
+
+_subvolume_pattern = re.compile(r"^ID (\d+) gen (\d+) .*path (?:<FS_TREE>/)?(\S+)$")
+_qgroup_pattern = re.compile(r"^0/(\d+)\s+(\d+)\s+(\d+)")
+_du_pattern = re.compile(r"^\s*(\d+)\s+(\d+)\s+(\d+|-)\s+(\S+)$")
+
+
+def parse_subvolume_list(output: str) -> Dict[str, Tuple[int, int]]:
+    """Parse the output of `btrfs subvolume list`.
+
+    Args:
+        output: Command output.
+
+    Returns:
+        A dictionary mapping each subvolume path to its id and last transaction id.
+    """
+    subvolumes = {}
+    for line in output.splitlines():
+        match = _subvolume_pattern.match(line.strip())
+        if match:
+            subvolumes[match.group(3)] = (int(match.group(1)), int(match.group(2)))
+    return subvolumes
+
+
+def parse_qgroup_show(output: str) -> Dict[int, Tuple[int, int]]:
+    """Parse the output of `btrfs qgroup show --raw`.
+
+    Args:
+        output: Command output.
+
+    Returns:
+        A dictionary mapping each subvolume id to its referenced and exclusive bytes.
+    """
+    qgroups = {}
+    for line in output.splitlines():
+        match = _qgroup_pattern.match(line.strip())
+        if match:
+            qgroups[int(match.group(1))] = (int(match.group(2)), int(match.group(3)))
+    return qgroups
+
+
+def parse_filesystem_du(output: str) -> Dict[str, Tuple[int, int]]:
+    """Parse the output of `btrfs filesystem du -s --raw`.
+
+    Args:
+        output: Command output.
+
+    Returns:
+        A dictionary mapping each path to its total and exclusive bytes.
+    """
+    usage = {}
+    for line in output.splitlines():
+        match = _du_pattern.match(line)
+        if match:
+            usage[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return usage
+
+
+def format_size(size: Optional[int]) -> str:
+    """Format a number of bytes for display.
+
+    Args:
+        size: Number of bytes, or None if unknown.
+
+    Returns:
+        The size with a binary unit suffix (e.g. "1.5G"), or "-" if unknown.
+    """
+    if size is None:
+        return "-"
+    value = float(size)
+    for unit in ["B", "K", "M", "G", "T"]:
+        if value < 1024 or unit == "T":
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}T"
+
+
+def generation_neighbours(entries: List[Dict[str, Any]], subvolumes: Dict[str, Tuple[int, int]]) -> Dict[int, List]:
+    """Find the previous and next existing generation of each generation.
+
+    Each generation is a snapshot of the previous one, so it shares most of its
+    extents with its neighbours.
+
+    Args:
+        entries: Generation index entries.
+        subvolumes: Subvolumes as returned by `parse_subvolume_list`.
+
+    Returns:
+        A dictionary mapping each generation with a subvolume to its previous and
+        next generation, None at either end.
+    """
+    ids = sorted(entry["id"] for entry in entries if f"generations/{entry['id']}/rootfs" in subvolumes)
+    return {
+        gen: [ids[pos - 1] if pos > 0 else None, ids[pos + 1] if pos + 1 < len(ids) else None]
+        for pos, gen in enumerate(ids)
+    }
+
+
+def stale_generations(entries: List[Dict[str, Any]], subvolumes: Dict[str, Tuple[int, int]]) -> List[int]:
+    """Find the generations whose cached disk usage must be measured again.
+
+    A measurement is stale when the subvolume was written since it was taken, or
+    when one of its neighbours was added or deleted: deleting a generation turns
+    the extents it shared with its neighbours into exclusive extents of theirs.
+    The other generations keep their cached measurement.
+
+    Args:
+        entries: Generation index entries.
+        subvolumes: Subvolumes as returned by `parse_subvolume_list`.
+
+    Returns:
+        The generations to measure.
+    """
+    neighbours = generation_neighbours(entries, subvolumes)
+    stale = []
+    for entry in entries:
+        if entry["id"] not in neighbours:
+            continue
+        usage = entry.get("usage")
+        transid = subvolumes[f"generations/{entry['id']}/rootfs"][1]
+        if not usage or usage.get("transid") != transid or usage.get("neighbours") != neighbours[entry["id"]]:
+            stale.append(entry["id"])
+    return stale
+
+
+def update_generation_usage(index: Any, kod_path: str = "/kod", refresh: bool = False) -> None:
+    """Update the disk usage stored in the generation index.
+
+    Args:
+        index: The generation index.
+        kod_path: Mount point of the btrfs top-level subvolume. Defaults to /kod.
+        refresh: If True, measure every generation again. Defaults to False.
+    """
+    subvolumes = parse_subvolume_list(exec(f"btrfs subvolume list {kod_path}", get_output=True))
+    entries = index.generations()
+    neighbours = generation_neighbours(entries, subvolumes)
+
+    # The command fails when quotas are disabled, which selects the extent scan
+    qgroups = parse_qgroup_show(exec(f"btrfs qgroup show --raw {kod_path} 2>/dev/null || true", get_output=True))
+    if qgroups:
+        # Quotas are maintained by the kernel, reading them is cheap
+        measured = {}
+        for entry in entries:
+            subvolume = subvolumes.get(f"generations/{entry['id']}/rootfs")
+            if subvolume is None or subvolume[0] not in qgroups:
+                continue
+            referenced, exclusive = qgroups[subvolume[0]]
+            measured[entry["id"]] = {
+                "exclusive": exclusive,
+                "shared": referenced - exclusive,
+                "method": "qgroup",
+                "transid": subvolume[1],
+                "neighbours": neighbours[entry["id"]],
+            }
+        index.update_entries({generation: {"usage": value} for generation, value in measured.items()})
+        return
+
+    to_measure = [entry["id"] for entry in entries] if refresh else stale_generations(entries, subvolumes)
+    to_measure = [gen for gen in to_measure if f"generations/{gen}/rootfs" in subvolumes]
+    if not to_measure:
+        return
+    print(f"Measuring disk usage of generation(s) {', '.join(str(gen) for gen in to_measure)}")
+    paths = [f"{kod_path}/generations/{gen}/rootfs" for gen in to_measure]
+    usage = parse_filesystem_du(exec(f"btrfs filesystem du -s --raw {' '.join(paths)}", get_output=True))
+    measured = {}
+    for generation, path in zip(to_measure, paths):
+        if path not in usage:
+            continue
+        total, exclusive = usage[path]
+        measured[generation] = {
+            "exclusive": exclusive,
+            "shared": total - exclusive,
+            "method": "du",
+            "transid": subvolumes[f"generations/{generation}/rootfs"][1],
+            "neighbours": neighbours[generation],
+        }
+    index.update_entries({generation: {"usage": value} for generation, value in measured.items()})
@@ -0,0 +1,35 @@
+"""Test helpers shared by the KodOS unit tests.
+
+This module contains the replacements of the Lua configuration tables and of
+the distribution modules used by several test modules.
+"""
+
+
+class Table(dict):
+    """Dictionary with attribute access and None for missing keys, like the Lua tables of the configuration."""
+
+    __getattr__ = dict.get
+
+    def __missing__(self, key):
+        return None
+
+
+class FakeDist:
+    """Distribution module replacement with a fixed package index, recording the bootstrap calls."""
+
+    def __init__(self, available=(), versions=""):
+        self.available = set(available)
+        self.versions = versions
+        self.calls = []
+
+    def find_missing_packages(self, packages):
+        return [pkg for pkg in packages if pkg not in self.available]
+
+    def resolve_base_versions(self, base_pkgs):
+        return self.versions
+
+    def install_essentials_pkgs(self, base_pkgs, mount_point):
+        self.calls.append("bootstrap")
+
+    def finalize_base_layer(self, mount_point):
+        self.calls.append("finalize")
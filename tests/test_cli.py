@@ -0,0 +1,80 @@
+"""Unit tests for the KodOS command-line interface startup.
+
+This module checks that importing the CLI stays within its import-time budget
+and does not load the heavy modules used only by some subcommands.
+"""
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+SRC_PATH = Path(__file__).parent.parent / "src"
+
+# Time allowed to import kod.kod on top of click itself
+IMPORT_TIME_BUDGET = 0.05
+
+# Modules that must only be loaded by the subcommands that use them
+LAZY_MODULES = ["lupa", "chorut", "kod.core", "kod.arch", "kod.debian", "kod.filesystem"]
+
+_measure_import = f"""
+import json, sys, time
+sys.path.insert(0, {str(SRC_PATH)!r})
+import click
+start = time.perf_counter()
+import kod.kod
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [m for m in {LAZY_MODULES!r} if m in sys.modules]}}))
+"""
+
+# The CLI reads the current user at import time
+_env = {"USER": "root", **os.environ}
+
+
+def _import_cli() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", _measure_import], capture_output=True, text=True, check=True, env=_env
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_cli_does_not_load_heavy_modules():
+    """Test that importing the CLI leaves subcommand dependencies unloaded."""
+    assert _import_cli()["loaded"] == []
+
+
+def test_cli_import_time_budget():
+    """Test that importing the CLI stays within the import-time budget."""
+    # Best of three runs to avoid noise from a cold file system cache
+    elapsed = min(_import_cli()["elapsed"] for _ in range(3))
+    assert elapsed < IMPORT_TIME_BUDGET, f"kod.kod import took {elapsed * 1000:.1f} ms"
+
+
+def test_cli_help_lists_commands():
+    """Test that the help message is produced without running any subcommand."""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys; sys.path.insert(0, {str(SRC_PATH)!r}); from kod.kod import cli; cli()",
+            "--help",
+        ],
+        capture_output=True,
+        text=True,
+        env=_env,
+    )
+    assert result.returncode == 0
+    for command in [
+        "install",
+        "rebuild",
+        "rebuild-user",
+        "shell",
+        "generations",
+        "gc",
+        "rollback",
+        "export",
+        "import",
+        "image",
+    ]:
+        assert command in result.stdout
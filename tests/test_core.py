@@ -0,0 +1,122 @@
+"""Unit tests for KodOS core functions.
+
+This module contains unit tests for the boot configuration and fstab helpers
+using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from kod.common import set_debug
+from kod.core import (
+    add_store_entries,
+    change_subvol,
+    create_directory_hierarchy,
+    create_filesystem_hierarchy,
+    hierarchy_fstab_entries,
+    load_fstab,
+    set_default_boot_entry,
+    set_hierarchy_options,
+)
+from kod.filesystem import DEFAULT_BTRFS_OPTIONS
+
+FSTAB = """UUID=1234 / btrfs rw,relatime,subvol=generations/3/rootfs 0 0
+UUID=ABCD /boot vfat rw,relatime 0 0
+UUID=1234 /home btrfs rw,relatime,subvol=store/home 0 0
+"""
+
+
+def test_set_default_boot_entry(tmp_path):
+    """Test that loader.conf points to the selected entry."""
+    (tmp_path / "boot" / "loader").mkdir(parents=True)
+    set_default_boot_entry("kodos-2.conf", str(tmp_path))
+    assert "default kodos-2.conf" in (tmp_path / "boot" / "loader" / "loader.conf").read_text()
+
+
+def test_set_default_boot_entry_next_boot_only(tmp_path, capsys):
+    """Test that a one-shot default does not change loader.conf."""
+    set_debug(True)
+    set_default_boot_entry("kodos-2.conf", str(tmp_path), next_boot_only=True)
+    assert "bootctl set-oneshot kodos-2.conf" in capsys.readouterr().out
+    assert not (tmp_path / "boot" / "loader" / "loader.conf").exists()
+
+
+def test_change_subvol_only_changes_root(tmp_path):
+    """Test that the root subvolume reference is moved to another generation."""
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc" / "fstab").write_text(FSTAB)
+    partition_list = change_subvol(load_fstab(str(tmp_path)), subvol="generations/5", mount_points=["/"])
+    assert partition_list[0].options == "rw,relatime,subvol=generations/5/rootfs"
+    assert partition_list[2].options == "rw,relatime,subvol=store/home"
+
+
+def test_set_hierarchy_options_keeps_subvolumes(tmp_path):
+    """Test that configured btrfs options replace the fstab options of the hierarchy."""
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc" / "fstab").write_text(FSTAB)
+    options = {"rootfs": "rw,noatime,compress=zstd:1", "home": "rw,noatime,compress=zstd:3,autodefrag"}
+    partition_list = set_hierarchy_options(load_fstab(str(tmp_path)), options)
+    assert partition_list[0].options == "rw,noatime,compress=zstd:1,subvol=generations/3/rootfs"
+    assert partition_list[1].options == "rw,relatime"
+    assert partition_list[2].options == "rw,noatime,compress=zstd:3,autodefrag,subvol=store/home"
+
+
+def test_hierarchy_fstab_entries_options():
+    """Test that the hierarchy uses the configured options and the defaults for the others."""
+    entries = hierarchy_fstab_entries("/dev/vda1", "/dev/vda3", 2, {"rootfs": "rw,noatime,compress=zstd:1"})
+    assert entries[0].options == "rw,noatime,compress=zstd:1,subvol=generations/2/rootfs"
+    assert entries[2].options == DEFAULT_BTRFS_OPTIONS
+    assert entries[3].options == f"{DEFAULT_BTRFS_OPTIONS},subvol=store/home"
+
+
+def test_create_directory_hierarchy(tmp_path, capsys):
+    """Test that a directory installation bind mounts the target and uses labels in fstab."""
+    set_debug(True)
+    target = tmp_path / "target"
+    mount_point = tmp_path / "mnt"
+    mount_point.mkdir()
+    partition_list = create_directory_hierarchy(str(target), str(mount_point))
+    commands = capsys.readouterr().out
+    assert f"btrfs subvolume create {target}/generations/0/rootfs" in commands
+    assert f"mount --bind {target}/generations/0/rootfs {mount_point}" in commands
+    assert "sgdisk" not in commands and "mkfs" not in commands
+    assert f"btrfs subvolume create {target}/store/var/log" in commands
+    assert f"chattr +C {target}/store/var/log" in commands
+    assert f"btrfs property set {target}/store/var/cache compression none" in commands
+    assert [(part.source, part.destination) for part in partition_list[:3]] == [
+        ("LABEL=KODOS_ROOT", "/"),
+        ("LABEL=KODOS_BOOT", "/boot"),
+        ("LABEL=KODOS_ROOT", "/kod"),
+    ]
+    assert (mount_point / ".generation").read_text() == "0"
+
+
+def test_resume_filesystem_hierarchy(tmp_path, capsys):
+    """Test that resuming at the hierarchy stage mounts the root partition and keeps the existing subvolumes."""
+    set_debug(True)
+    # The partitions stage is done and the first attempt created some subvolumes before it failed
+    (tmp_path / "store" / "home").mkdir(parents=True)
+    (tmp_path / "generations" / "0" / "rootfs").mkdir(parents=True)
+    partition_list = create_filesystem_hierarchy("/dev/vda1", "/dev/vda2", [], str(tmp_path))
+    commands = capsys.readouterr().out
+    assert commands.index(f"mount /dev/vda2 {tmp_path}") < commands.index("btrfs subvolume create")
+    assert f"btrfs subvolume create {tmp_path}/store/home" not in commands
+    assert f"btrfs subvolume create {tmp_path}/generations/0/rootfs" not in commands
+    assert f"btrfs subvolume create {tmp_path}/store/var/log" in commands
+    assert partition_list[0].options.endswith("subvol=generations/0/rootfs")
+    assert (tmp_path / ".generation").read_text() == "0"
+
+
+def test_add_store_entries(tmp_path):
+    """Test that only the bind mounts of new store paths are added to the fstab."""
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc" / "fstab").write_text(FSTAB + "/kod/store/var/log /var/log none rw,bind 0 0\n")
+    store_paths = {"var/log": {"nodatacow": True}, "var/lib/postgres": {"nodatacow": True}}
+    partition_list = add_store_entries(load_fstab(str(tmp_path)), store_paths)
+    assert [(part.source, part.destination) for part in partition_list[3:]] == [
+        ("/kod/store/var/log", "/var/log"),
+        ("/kod/store/var/lib/postgres", "/var/lib/postgres"),
+    ]
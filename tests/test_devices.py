@@ -0,0 +1,88 @@
+"""Unit tests for the KodOS block device probe.
+
+This module contains unit tests for the probing of the block devices from sysfs,
+the udev database, /dev/disk/by-uuid and the mount table using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import kod.devices as devices
+from kod.devices import BlockDevice, probe_block_devices, read_mountinfo
+from kod.filesystem import FsEntry
+
+
+def make_tree(tmp_path):
+    """Create a sysfs, udev database, by-uuid directory and mountinfo for a disk with two partitions."""
+    sys_devices = tmp_path / "sys" / "devices" / "sda"
+    for name, size in [("sda1", 1024), ("sda2", 2048)]:
+        (sys_devices / name).mkdir(parents=True)
+        (sys_devices / name / "size").write_text(f"{size}\n")
+        (sys_devices / name / "dev").write_text(f"8:{name[-1]}\n")
+    (sys_devices / "queue").mkdir()
+    (sys_devices / "queue" / "rotational").write_text("0\n")
+    (sys_devices / "size").write_text("4096\n")
+    (sys_devices / "dev").write_text("8:0\n")
+    sys_block = tmp_path / "sys" / "class" / "block"
+    sys_block.mkdir(parents=True)
+    for name, target in [("sda", sys_devices), ("sda1", sys_devices / "sda1"), ("sda2", sys_devices / "sda2")]:
+        (sys_block / name).symlink_to(target)
+
+    udev_data = tmp_path / "udev"
+    udev_data.mkdir()
+    (udev_data / "b8:1").write_text("S:disk/by-uuid/1234-ABCD\nE:ID_FS_UUID=1234-ABCD\nE:ID_FS_TYPE=vfat\n")
+
+    by_uuid = tmp_path / "by-uuid"
+    by_uuid.mkdir()
+    (by_uuid / "0f6e2b4c-root").symlink_to("/dev/sda2")
+
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(
+        "25 1 8:2 /generations/1/rootfs / rw,relatime shared:1 - btrfs /dev/sda2 rw,ssd,subvol=/generations/1/rootfs\n"
+        "30 25 8:1 / /boot rw,relatime shared:2 - vfat /dev/sda1 rw\n"
+    )
+    return {
+        "by_uuid": str(by_uuid),
+        "sys_block": str(sys_block),
+        "udev_data": str(udev_data),
+        "mountinfo": str(mountinfo),
+    }
+
+
+def test_probe_block_devices(tmp_path):
+    """Test that sysfs, udev, by-uuid and mountinfo facts are merged per device."""
+    probed = probe_block_devices(**make_tree(tmp_path))
+    assert probed["/dev/sda"] == BlockDevice("/dev/sda", None, None, False, 4096 * 512)
+    assert probed["/dev/sda1"] == BlockDevice("/dev/sda1", "1234-ABCD", "vfat", False, 1024 * 512)
+    assert probed["/dev/sda2"] == BlockDevice("/dev/sda2", "0f6e2b4c-root", "btrfs", False, 2048 * 512)
+
+
+def test_read_mountinfo(tmp_path):
+    """Test that mount points with escaped spaces are decoded."""
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text("40 25 0:30 / /srv/build\\040dir rw - tmpfs tmpfs rw\n")
+    (mount,) = read_mountinfo(str(mountinfo))
+    assert mount["mount_point"] == "/srv/build dir"
+    assert mount["parent_id"] == "25"
+    assert mount["fs_type"] == "tmpfs"
+
+
+def test_read_mountinfo_utf8_path(tmp_path):
+    """Test that non-ASCII mount points are kept as they are."""
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text("40 25 0:30 / /mnt/café\\040x rw - tmpfs tmpfs rw\n", encoding="utf-8")
+    (mount,) = read_mountinfo(str(mountinfo))
+    assert mount["mount_point"] == "/mnt/café x"
+
+
+def test_fs_entry_source_uuid(tmp_path, monkeypatch):
+    """Test that FsEntry uses the probed UUID and keeps unknown sources."""
+    monkeypatch.setattr(devices, "_block_devices", probe_block_devices(**make_tree(tmp_path)))
+    assert FsEntry("/dev/sda1", "/boot", "vfat", "defaults").source_uuid() == "UUID=1234-ABCD"
+    assert FsEntry("/dev/sdb1", "/data", "ext4", "defaults").source_uuid() == "/dev/sdb1"
+    assert FsEntry("/kod/store/home", "/home", "none", "rw,bind").source_uuid() == "/kod/store/home"
+    devices.invalidate_block_devices()
+    assert devices._block_devices is None
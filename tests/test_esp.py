@@ -0,0 +1,68 @@
+"""Unit tests for the KodOS boot artifact store.
+
+This module contains unit tests for the copy, the reference counting and the
+pruning of the kernels and initramfs images on the ESP using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from kod.esp import BootArtifactStore, EspFullError
+
+
+def make_boot(tmp_path):
+    """Create an ESP with a loader entry for generation 1."""
+    boot = tmp_path / "boot"
+    (boot / "loader" / "entries").mkdir(parents=True)
+    (boot / "loader" / "entries" / "kodos-1.conf").write_text("linux /vmlinuz-6.9.1\ninitrd /initramfs-6.9.1-a.img\n")
+    return boot
+
+
+def test_add_file_is_atomic_and_deduplicated(tmp_path, capsys):
+    """Test that a kernel is copied once and identical copies are skipped."""
+    boot = make_boot(tmp_path)
+    kernel = tmp_path / "vmlinuz"
+    kernel.write_bytes(b"kernel 6.9.1")
+    store = BootArtifactStore.load(str(boot))
+    assert store.add_file(str(kernel), "vmlinuz-6.9.1") == "vmlinuz-6.9.1"
+    assert (boot / "vmlinuz-6.9.1").read_bytes() == b"kernel 6.9.1"
+    assert not (boot / "vmlinuz-6.9.1.tmp").exists()
+
+    store = BootArtifactStore.load(str(boot))
+    store.add_file(str(kernel), "vmlinuz-6.9.1")
+    assert "vmlinuz-6.9.1 is up to date" in capsys.readouterr().out
+    assert store.artifacts["vmlinuz-6.9.1"]["size"] == len(b"kernel 6.9.1")
+
+
+def test_prune_keeps_referenced_and_pending_artifacts(tmp_path):
+    """Test that only artifacts without generation, entry or pending build are pruned."""
+    boot = make_boot(tmp_path)
+    for name in ["vmlinuz-6.9.1", "initramfs-6.9.1-a.img", "vmlinuz-6.8.0", "initramfs-6.8.0-b.img"]:
+        (boot / name).write_text(name)
+    store = BootArtifactStore.load(str(boot))
+    store.reference(2, ["vmlinuz-6.8.0", "initramfs-6.8.0-b.img"])
+    (boot / "vmlinuz-7.0.0").write_text("new")
+    store.register("vmlinuz-7.0.0")
+
+    assert store.prune() == []
+    store.release(2)
+    assert store.prune() == ["initramfs-6.8.0-b.img", "vmlinuz-6.8.0"]
+    # The kernel of a build that never created its boot entry
+    assert store.prune(include_pending=True) == ["vmlinuz-7.0.0"]
+    assert sorted(path.name for path in boot.glob("*-*")) == ["initramfs-6.9.1-a.img", "vmlinuz-6.9.1"]
+
+
+def test_ensure_free_space(tmp_path):
+    """Test that a full ESP is reported once the unused artifacts are pruned."""
+    boot = make_boot(tmp_path)
+    (boot / "vmlinuz-6.8.0").write_text("old")
+    store = BootArtifactStore.load(str(boot))
+    store.free_space = lambda: 1024
+    with pytest.raises(EspFullError):
+        store.ensure_free_space(32 * 1024**2)
+    assert not (boot / "vmlinuz-6.8.0").exists()
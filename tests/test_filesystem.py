@@ -0,0 +1,132 @@
+"""Unit tests for the KodOS partitioning functions.
+
+This module contains unit tests for the format commands and the creation of the
+partitions of several disks using pytest framework.
+"""
+
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from helpers import Table
+
+import kod.common as common
+import kod.filesystem as filesystem
+from kod.common import set_debug
+from kod.devices import BlockDevice
+from kod.filesystem import (
+    DEFAULT_BTRFS_OPTIONS,
+    create_partitions,
+    format_command,
+    get_btrfs_options,
+    get_store_paths,
+)
+
+
+def test_format_command_skips_discard_on_ssd():
+    """Test that the discard is only skipped on solid-state disks."""
+    assert format_command("btrfs", "/dev/nvme0n1p2", rotational=False) == "mkfs.btrfs -f --nodiscard /dev/nvme0n1p2"
+    assert format_command("ext4", "/dev/nvme0n1p3", rotational=False) == "mkfs.ext4 -E nodiscard /dev/nvme0n1p3"
+    assert format_command("btrfs", "/dev/sda2", rotational=True) == "mkfs.btrfs -f /dev/sda2"
+    assert format_command("btrfs", "/dev/vda2") == "mkfs.btrfs -f /dev/vda2"
+    assert format_command("esp", "/dev/nvme0n1p1", rotational=False) == "mkfs.vfat -F32 /dev/nvme0n1p1"
+    assert format_command("noformat", "/dev/sda3") is None
+
+
+def test_create_partitions_mounts_root_disk_first(monkeypatch, capsys):
+    """Test that the disk of the root partition is mounted before the other disks."""
+    set_debug(True)
+    monkeypatch.setattr(filesystem, "get_block_device", lambda device: BlockDevice(device, rotational=False))
+    data = {1: Table(name="data", size="100%", type="btrfs", mountpoint="/data")}
+    system = {
+        1: Table(name="boot", size="512M", type="esp", mountpoint="/boot"),
+        2: Table(name="root", size="100%", type="btrfs", mountpoint="/"),
+    }
+    conf = SimpleNamespace(
+        devices={
+            "disk0": {"device": "/dev/nvme1n1", "partitions": data},
+            "disk1": {"device": "/dev/nvme0n1", "partitions": system},
+        }
+    )
+    boot, root, partition_list = create_partitions(conf)
+    assert (boot, root) == ("/dev/nvme0n1p1", "/dev/nvme0n1p2")
+    assert [part.destination for part in partition_list] == ["/boot", "/", "/data"]
+
+    output = capsys.readouterr().out
+    assert "mkfs.btrfs -f --nodiscard /dev/nvme1n1p1" in output
+    assert output.rindex("mount /dev/nvme0n1p2 /mnt/") < output.rindex("mount /dev/nvme1n1p1 /mnt/data")
+
+
+def test_failed_disk_does_not_abort_the_others(monkeypatch):
+    """Test that a command failing on one disk is not reported by the disks partitioned in parallel."""
+    monkeypatch.setattr(common, "use_debug", False)
+    monkeypatch.setattr(filesystem, "get_block_device", lambda device: BlockDevice(device, rotational=True))
+    started = threading.Event()
+    failed = threading.Event()
+    commands = []
+
+    def run(cmd, shell=True, **kwargs):
+        commands.append(cmd)
+        returncode = 0
+        if cmd.startswith("sgdisk") and "/dev/sda" in cmd:
+            # The other disk fails while this command runs
+            started.set()
+            failed.wait(5)
+        elif cmd.startswith("wipefs") and "/dev/sdb" in cmd:
+            started.wait(5)
+            failed.set()
+            returncode = 1
+        return subprocess.CompletedProcess(cmd, returncode, stdout="", stderr="")
+
+    monkeypatch.setattr(common.subprocess, "run", run)
+    partitions = {1: Table(name="data", size="100%", type="btrfs", mountpoint="/data")}
+    conf = SimpleNamespace(
+        devices={
+            "disk0": {"device": "/dev/sda", "partitions": partitions},
+            "disk1": {"device": "/dev/sdb", "partitions": partitions},
+        }
+    )
+    with pytest.raises(RuntimeError, match="Failed to wipe partition table on /dev/sdb"):
+        create_partitions(conf)
+    assert "mkfs.btrfs -f /dev/sda1" in commands
+
+
+def test_get_btrfs_options():
+    """Test that the root partition options apply to the hierarchy, overridden per subvolume."""
+    root = Table(
+        name="Root",
+        type="btrfs",
+        mountOptions="rw,noatime,compress-force=zstd:1,subvol=@",
+        subvolumeOptions={"home": "rw,noatime,autodefrag", "swap": "nodatacow"},
+    )
+    conf = SimpleNamespace(devices={"disk0": {"device": "/dev/vda", "partitions": {3: root}}})
+    assert get_btrfs_options(conf) == {
+        "rootfs": "rw,noatime,compress-force=zstd:1",
+        "kod": "rw,noatime,compress-force=zstd:1",
+        "home": "rw,noatime,autodefrag",
+    }
+    root = Table(name="Root", type="btrfs")
+    conf = SimpleNamespace(devices={"disk0": {"device": "/dev/vda", "partitions": {3: root}}})
+    assert set(get_btrfs_options(conf).values()) == {DEFAULT_BTRFS_OPTIONS}
+
+
+def test_get_store_paths():
+    """Test that configured store paths are added to the defaults, parents first."""
+    root = Table(
+        name="Root",
+        type="btrfs",
+        storePaths={"/var/lib/libvirt/images/": {"nodatacow": True}, "var/log": {"nodatacow": False}},
+    )
+    conf = SimpleNamespace(devices={"disk0": {"device": "/dev/vda", "partitions": {3: root}}})
+    store_paths = get_store_paths(conf)
+    assert list(store_paths) == ["root", "var/cache", "var/kod", "var/lib/libvirt/images", "var/log", "var/tmp"]
+    assert store_paths["var/lib/libvirt/images"] == {"nodatacow": True}
+    assert store_paths["var/log"] == {"nodatacow": False}
+    assert store_paths["var/cache"] == {"compress": False}
@@ -0,0 +1,108 @@
+"""Unit tests for KodOS generation garbage collection.
+
+This module contains unit tests for the retention policies and the cleanup of
+boot files using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from kod.common import set_debug
+from kod.gc import (
+    delete_subvolumes,
+    find_orphaned_boot_files,
+    get_default_generations,
+    parse_booted_generation,
+    select_generations_to_keep,
+)
+
+
+def make_entry(generation, timestamp, status="complete", pinned=False):
+    """Build a generation index entry."""
+    return {"id": generation, "timestamp": timestamp, "status": status, "pinned": pinned}
+
+
+ENTRIES = [
+    make_entry(1, "2026-09-01T10:00:00"),
+    make_entry(2, "2026-09-01T12:00:00"),
+    make_entry(3, "2026-09-09T09:00:00", pinned=True),
+    make_entry(4, "2026-09-20T09:00:00"),
+    make_entry(5, "2026-09-21T09:00:00"),
+    make_entry(6, "2026-09-21T18:00:00"),
+]
+
+
+def test_keep_last():
+    """Test that only the most recent generations are kept without other policies."""
+    keep = select_generations_to_keep(ENTRIES, keep_last=2, keep_daily=0, keep_weekly=0)
+    assert sorted(keep) == [3, 5, 6]
+    assert keep[3] == ["pinned"]
+
+
+def test_keep_daily_and_weekly():
+    """Test that the newest generation of each day and week is kept."""
+    keep = select_generations_to_keep(ENTRIES, keep_last=0, keep_daily=2, keep_weekly=0)
+    assert sorted(keep) == [3, 4, 6]
+    keep = select_generations_to_keep(ENTRIES, keep_last=0, keep_daily=0, keep_weekly=10)
+    # 2026-09-20 is a Sunday, so generation 4 shares its ISO week with 3
+    assert sorted(keep) == [2, 3, 4, 6]
+
+
+def test_protected_and_incomplete_generations_are_kept():
+    """Test that current, booted and unfinished generations are never deleted."""
+    entries = ENTRIES + [make_entry(7, "2026-09-22T09:00:00", status="building")]
+    keep = select_generations_to_keep(entries, keep_last=0, keep_daily=0, keep_weekly=0, protected={1})
+    assert sorted(keep) == [1, 3, 7]
+    assert keep[7] == ["building", "newest"]
+
+
+def test_parse_booted_generation():
+    """Test reading the booted generation from the kernel command line."""
+    cmdline = "initrd=\\initramfs.img root=UUID=1234 rw rootflags=subvol=generations/12/rootfs quiet"
+    assert parse_booted_generation(cmdline) == 12
+    assert parse_booted_generation("root=/dev/sda2 rw") is None
+
+
+def test_default_generations_after_rollback(tmp_path):
+    """Test that the default and one-shot generations of systemd-boot are protected."""
+    (tmp_path / "loader").mkdir()
+    (tmp_path / "loader" / "loader.conf").write_text("\ndefault kodos-3.conf\ntimeout 10\n")
+    efivar = tmp_path / "LoaderEntryOneShot"
+    efivar.write_bytes(b"\x07\x00\x00\x00" + "kodos-5-6.9.1-0123456789ab.efi\0".encode("utf-16-le"))
+    assert get_default_generations(str(tmp_path), str(efivar)) == {3, 5}
+
+    # A rollback to generation 2 makes it the default, gc must keep it until the reboot
+    (tmp_path / "loader" / "loader.conf").write_text("\ndefault kodos-2.conf\n")
+    protected = get_default_generations(str(tmp_path), str(tmp_path / "missing"))
+    keep = select_generations_to_keep(ENTRIES, keep_last=1, keep_daily=0, keep_weekly=0, protected=protected)
+    assert sorted(keep) == [2, 3, 6]
+
+
+def test_find_orphaned_boot_files(tmp_path):
+    """Test that KodOS kernels and initramfs images without boot entry are found."""
+    entries = tmp_path / "loader" / "entries"
+    entries.mkdir(parents=True)
+    (entries / "kodos-2.conf").write_text("linux /vmlinuz-6.9.2\ninitrd /initramfs-linux-6.9.2.img\n")
+    for name in ["vmlinuz-6.9.1", "vmlinuz-6.9.2", "initramfs-linux-6.9.1.img", "initramfs-linux-6.9.2.img"]:
+        (tmp_path / name).write_text("")
+    # Kernel and images of the distribution package, not managed by KodOS
+    for name in ["vmlinuz-linux", "initramfs-linux.img", "initramfs-linux-fallback.img"]:
+        (tmp_path / name).write_text("")
+    assert find_orphaned_boot_files(str(tmp_path)) == [
+        str(tmp_path / "initramfs-linux-6.9.1.img"),
+        str(tmp_path / "vmlinuz-6.9.1"),
+    ]
+
+
+def test_delete_subvolumes_is_batched(capsys):
+    """Test that all subvolumes are deleted by one low priority command."""
+    # Debug mode only prints the commands
+    set_debug(True)
+    delete_subvolumes(["/kod/generations/1/rootfs", "/kod/generations/2/rootfs"], ["/kod/generations/1"])
+    commands = [line for line in capsys.readouterr().out.splitlines() if line.startswith(">>")]
+    assert len(commands) == 1
+    assert "setsid -f ionice -c 3 nice -n 19" in commands[0]
+    assert "btrfs subvolume delete --commit-after /kod/generations/1/rootfs /kod/generations/2/rootfs" in commands[0]
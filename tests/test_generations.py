@@ -0,0 +1,163 @@
+"""Unit tests for KodOS generation state tracking.
+
+This module contains unit tests for the configuration hashing and the rebuild
+stage planning, and for the generation index using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from kod.generations import (
+    CONFIG_SECTIONS,
+    GenerationIndex,
+    RebuildPlan,
+    count_packages,
+    format_generations,
+    get_generation_kver,
+    hash_value,
+    load_config_hashes,
+    lua_to_python,
+    new_generation_entry,
+    normalize_packages,
+    store_config_hashes,
+)
+
+
+def test_lua_to_python_converts_sequences_and_functions():
+    """Test that integer keyed tables become lists and functions become markers."""
+    value = {"packages": {1: "git", 2: "htop"}, "command": lambda: None, "enable": True}
+    assert lua_to_python(value) == {"packages": ["git", "htop"], "command": "<function>", "enable": True}
+
+
+def test_hash_value_is_stable():
+    """Test that key order does not change the hash."""
+    assert hash_value({"a": 1, "b": 2}) == hash_value({"b": 2, "a": 1})
+    assert hash_value({"a": 1}) != hash_value({"a": 2})
+
+
+def test_normalize_packages_sorts_lists():
+    """Test that package lists are compared independently of their order."""
+    first = normalize_packages({"kernel": "linux", "packages": ["htop", "git"]})
+    second = normalize_packages({"kernel": "linux", "packages": ["git", "htop"]})
+    assert first == second
+    assert normalize_packages(None) == {}
+
+
+def test_config_hashes_roundtrip(tmp_path):
+    """Test storing and loading the section hashes of a generation."""
+    hashes = {section: hash_value(section) for section in CONFIG_SECTIONS}
+    store_config_hashes(str(tmp_path), hashes)
+    assert load_config_hashes(str(tmp_path)) == hashes
+    assert load_config_hashes(str(tmp_path / "missing")) == {}
+
+
+def test_rebuild_plan_decisions():
+    """Test that only changed sections or required state run a stage."""
+    current = {section: "same" for section in CONFIG_SECTIONS}
+    changed = dict(current, packages="other")
+    plan = RebuildPlan(current, changed)
+
+    assert plan.decide("packages", "packages") is True
+    assert plan.decide("repos", "repos") is False
+    assert plan.decide("kernel", "boot", state_ok=False, state_reason="kernel updated") is True
+    assert [reason for _, _, reason in plan.decisions] == [
+        "packages configuration changed",
+        "repos unchanged",
+        "kernel updated",
+    ]
+    assert not plan.unchanged()
+
+
+def test_rebuild_plan_without_stored_hashes():
+    """Test that generations without stored hashes run every stage."""
+    plan = RebuildPlan({}, {section: "new" for section in CONFIG_SECTIONS})
+    assert plan.decide("repos", "repos") is True
+    assert not plan.unchanged()
+    assert RebuildPlan({"repos": "a"}, {"repos": "a"}).changed("locale")
+
+
+def test_get_generation_kver(tmp_path):
+    """Test reading the kernel version from a generation boot entry."""
+    entries = tmp_path / "boot" / "loader" / "entries"
+    entries.mkdir(parents=True)
+    (entries / "kodos-3.conf").write_text("title KodOS\nlinux /vmlinuz-6.6.1-lts\ninitrd /initramfs.img\n")
+    assert get_generation_kver(3, str(tmp_path)) == "6.6.1-lts"
+    assert get_generation_kver(4, str(tmp_path)) is None
+
+
+def test_rebuild_plan_is_noop():
+    """Test the detection of rebuilds that would not change anything."""
+    hashes = {section: "same" for section in CONFIG_SECTIONS}
+    packages = {"kernel": "linux", "packages": ["git", "htop"]}
+    plan = RebuildPlan(hashes, dict(hashes))
+    assert plan.is_noop(packages, {"kernel": "linux", "packages": ["htop", "git"]})
+    assert not plan.is_noop(packages, {"kernel": "linux-lts", "packages": ["git", "htop"]})
+    assert not RebuildPlan(hashes, dict(hashes, boot="other")).is_noop(packages, packages)
+
+
+def _make_generation(root, generation, kver):
+    state_path = root / "kod" / "generations" / str(generation)
+    state_path.mkdir(parents=True)
+    (state_path / "installed_packages").write_text('{"kernel": "linux", "base": ["base"], "packages": ["git"]}')
+    entries = root / "boot" / "loader" / "entries"
+    entries.mkdir(parents=True, exist_ok=True)
+    (entries / f"kodos-{generation}.conf").write_text(f"linux /vmlinuz-{kver}\n")
+
+
+def test_index_is_built_once_from_generation_directories(tmp_path):
+    """Test that a missing index is built from the existing generations."""
+    _make_generation(tmp_path, 0, "6.9.1-arch1-1")
+    _make_generation(tmp_path, 1, "6.9.2-arch1-1")
+    generations_path = str(tmp_path / "kod" / "generations")
+
+    index = GenerationIndex.load(generations_path)
+    assert [entry["parent"] for entry in index.generations()] == [None, 0]
+    assert index.get(1)["kver"] == "6.9.2-arch1-1"
+    assert index.get(1)["packages"] == 3
+    assert (tmp_path / "kod" / "generations" / "index.json").is_file()
+
+    # A new generation directory is not picked up once the index exists
+    _make_generation(tmp_path, 2, "6.9.3-arch1-1")
+    assert GenerationIndex.load(generations_path).max_generation() == 1
+
+
+def test_index_add_update_remove(tmp_path):
+    """Test that index changes are stored."""
+    index = GenerationIndex(str(tmp_path))
+    assert index.max_generation() == 0
+    index.add(new_generation_entry(3, 2, config_hash="abc", packages=10))
+    index.update(3, status="complete", kver="6.9.1-arch1-1", duration=42.0)
+
+    loaded = GenerationIndex.load(str(tmp_path))
+    assert loaded.max_generation() == 3
+    assert loaded.get(3)["status"] == "complete"
+    loaded.remove(3)
+    assert GenerationIndex.load(str(tmp_path)).generations() == []
+
+
+def test_index_allocation_sees_other_builds(tmp_path):
+    """Test that generation numbers and entries of concurrent builds are not lost."""
+    rebuild = GenerationIndex.load(str(tmp_path))
+    other = GenerationIndex.load(str(tmp_path))
+    assert rebuild.allocate(None, config_hash="abc")["id"] == 1
+    # The other index was loaded before, but allocates on the current content of the index file
+    assert other.allocate(None)["id"] == 2
+    # A directory left by a build that was never registered is skipped
+    (tmp_path / "3").mkdir()
+    assert other.allocate(2)["id"] == 4
+
+    rebuild.update(1, status="complete")
+    assert [entry["id"] for entry in GenerationIndex.load(str(tmp_path)).generations()] == [1, 2, 4]
+    assert GenerationIndex.load(str(tmp_path)).get(1)["status"] == "complete"
+
+
+def test_format_generations_marks_current():
+    """Test the generation table."""
+    entry = new_generation_entry(1, 0, kver="6.9.1-arch1-1", packages=count_packages({"kernel": "linux"}))
+    lines = format_generations([entry], current=1)
+    assert lines[0].split() == ["ID", "PARENT", "DATE", "KERNEL", "PKGS", "TIME", "STATUS"]
+    assert lines[1].startswith("*    1      0")
+    assert lines[1].split()[-1] == "building"
@@ -0,0 +1,44 @@
+"""Unit tests for KodOS disk images.
+
+This module contains unit tests for the loop device partition naming and the
+image conversion using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from kod.common import set_debug
+from kod.filesystem import partition_device, set_install_device
+from kod.image import convert_image, raw_image_path
+
+
+def test_partition_device():
+    """Test that loop, NVMe and MMC partitions are separated with a p."""
+    assert partition_device("/dev/sda", 2) == "/dev/sda2"
+    assert partition_device("/dev/nvme0n1", 1) == "/dev/nvme0n1p1"
+    assert partition_device("/dev/loop3", 1) == "/dev/loop3p1"
+
+
+def test_set_install_device():
+    """Test that the device of a single disk configuration can be replaced."""
+    conf = {"devices": {"disk0": {"device": "/dev/vda", "partitions": {}}}}
+    assert set_install_device(conf, "/dev/loop0")
+    assert conf["devices"]["disk0"]["device"] == "/dev/loop0"
+    conf["devices"]["disk1"] = {"device": "/dev/vdb"}
+    assert not set_install_device(conf, "/dev/loop0")
+
+
+def test_convert_image(capsys):
+    """Test that the raw image is converted and then removed."""
+    # Debug mode only prints the commands
+    set_debug(True)
+    assert raw_image_path("disk.img", "raw") == "disk.img"
+    convert_image("disk.qcow2.raw", "disk.qcow2", "qcow2")
+    convert_image("disk.img.zst.raw", "disk.img.zst", "zst", compression_level=9)
+    commands = [line for line in capsys.readouterr().out.splitlines() if line.startswith(">>")]
+    assert "qemu-img convert -f raw -O qcow2 disk.qcow2.raw disk.qcow2" in commands[0]
+    assert "zstd -T0 -9 -q -f disk.img.zst.raw -o disk.img.zst" in commands[2]
+    assert "rm -f disk.img.zst.raw" in commands[3]
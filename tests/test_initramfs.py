@@ -0,0 +1,119 @@
+"""Unit tests for the KodOS initramfs cache.
+
+This module contains unit tests for the keys of the initramfs images and their
+reuse on the ESP using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from helpers import Table
+
+from kod.common import set_debug
+from kod.generations import get_generation_initrd
+from kod.initramfs import (
+    DRACUT_KODOS_CONFIG,
+    build_initramfs,
+    configure_dracut,
+    get_boot_modules,
+    hardware_facts,
+    initramfs_key,
+    initramfs_name,
+    storage_modules,
+)
+
+
+def make_root(path):
+    """Create a root filesystem with a kernel and a dracut configuration."""
+    (path / "usr/lib/modules/6.9.1").mkdir(parents=True)
+    (path / "usr/lib/modules/6.9.1/modules.dep").write_text("kernel/fs/btrfs/btrfs.ko.zst:\n")
+    (path / "etc/dracut.conf.d").mkdir(parents=True)
+    (path / "etc/dracut.conf.d/kodos.conf").write_text('add_drivers+=" btrfs "\n')
+    (path / "boot").mkdir()
+    return path
+
+
+def test_initramfs_key_depends_on_inputs(tmp_path):
+    """Test that the key changes with the dracut configuration and the modules only."""
+    root = make_root(tmp_path)
+    key = initramfs_key("6.9.1", str(root), hostonly=False)
+    assert initramfs_key("6.9.1", str(root), hostonly=False) == key
+    assert initramfs_key("6.9.1", str(root), hostonly=True) != key
+
+    (root / "etc/dracut.conf.d/kodos.conf").write_text('add_drivers+=" btrfs nvme "\n')
+    changed = initramfs_key("6.9.1", str(root), hostonly=False)
+    assert changed != key
+    (root / "usr/lib/modules/6.9.1/modules.dep").write_text("kernel/fs/xfs/xfs.ko.zst:\n")
+    assert initramfs_key("6.9.1", str(root), hostonly=False) != changed
+
+
+def test_hostonly_key_depends_on_root_storage(tmp_path):
+    """Test that host-only images are keyed on the root storage drivers, not on the loaded modules."""
+    root = make_root(tmp_path / "root")
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(f"36 25 0:32 /generations/1/rootfs {root} rw,relatime - btrfs /dev/nodisk2 rw\n")
+    facts = hardware_facts(str(root), str(mountinfo))
+    assert facts["storage"] == ["btrfs"]
+    assert "modules" not in facts
+
+    key = initramfs_key("6.9.1", str(root), mountinfo=str(mountinfo))
+    assert initramfs_key("6.9.1", str(root), mountinfo=str(mountinfo)) == key
+    mountinfo.write_text(f"36 25 0:32 / {root} rw,relatime - xfs /dev/nodisk2 rw\n")
+    assert initramfs_key("6.9.1", str(root), mountinfo=str(mountinfo)) != key
+
+
+def test_build_initramfs_reuses_image(tmp_path, capsys):
+    """Test that an image with the same inputs is not generated again."""
+    set_debug(True)
+    root = make_root(tmp_path)
+    name = initramfs_name("6.9.1", initramfs_key("6.9.1", str(root), hostonly=False))
+    (root / "boot" / name).write_text("")
+    assert build_initramfs("6.9.1", str(root), hostonly=False) == name
+    assert "dracut" not in capsys.readouterr().out
+
+
+def test_storage_modules(tmp_path):
+    """Test that the drivers of a partition, its disk and its controller are found."""
+    sys_path = tmp_path / "sys"
+    controller = sys_path / "devices/pci0000:00/0000:00:04.0"
+    disk = controller / "virtio1/block/vda"
+    (disk / "vda2").mkdir(parents=True)
+    for device, driver in [(controller, "virtio-pci"), (controller / "virtio1", "virtio_blk")]:
+        (sys_path / "module" / driver.replace("-", "_")).mkdir(parents=True)
+        (sys_path / "drivers" / driver).mkdir(parents=True)
+        (sys_path / "drivers" / driver / "module").symlink_to(sys_path / "module" / driver.replace("-", "_"))
+        (device / "driver").symlink_to(sys_path / "drivers" / driver)
+    (sys_path / "class/block").mkdir(parents=True)
+    (sys_path / "class/block/vda2").symlink_to(disk / "vda2")
+
+    assert storage_modules("/dev/vda2", str(sys_path / "class/block")) == ["virtio_blk", "virtio_pci"]
+    assert storage_modules("/dev/sdz", str(sys_path / "class/block")) == []
+
+
+def test_configure_dracut(tmp_path):
+    """Test that the declared modules and the root filesystem driver are added, if the kernel has them."""
+    root = make_root(tmp_path / "root")
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(f"36 25 0:32 /generations/1/rootfs {root} rw,relatime - btrfs /dev/nodisk2 rw\n")
+    (root / "usr/lib/modules/6.9.1/modules.builtin").write_text("kernel/drivers/ata/ahci.ko\n")
+    conf = Table(boot=Table(kernel=Table(modules=Table({1: "ahci", 2: "virtio-blk"}))))
+    assert get_boot_modules(conf) == ["ahci", "virtio-blk"]
+
+    assert configure_dracut(get_boot_modules(conf), "6.9.1", str(root), mountinfo=str(mountinfo)) == ["ahci", "btrfs"]
+    config = (root / DRACUT_KODOS_CONFIG).read_text()
+    assert 'hostonly_mode="strict"' in config
+    assert 'add_drivers+=" ahci btrfs "' in config
+    assert configure_dracut([], "6.9.1", str(root), hostonly=False) == []
+    assert "add_drivers" not in (root / DRACUT_KODOS_CONFIG).read_text()
+
+
+def test_get_generation_initrd(tmp_path):
+    """Test reading the initramfs image from the boot entry of a generation."""
+    entries = tmp_path / "boot/loader/entries"
+    entries.mkdir(parents=True)
+    (entries / "kodos-3.conf").write_text("linux /vmlinuz-6.9.1\ninitrd /initramfs-6.9.1-0123456789abcdef.img\n")
+    assert get_generation_initrd(3, str(tmp_path)) == "initramfs-6.9.1-0123456789abcdef.img"
+    assert get_generation_initrd(4, str(tmp_path)) is None
@@ -0,0 +1,94 @@
+"""Unit tests for the KodOS stage journal.
+
+This module contains unit tests for the journal used to resume installations
+and rebuilds using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from kod.common import set_debug
+from kod.filesystem import FsEntry
+from kod.journal import JournalError, StageJournal
+
+
+def test_run_records_stage_outputs(tmp_path):
+    """Test that completed stages and their outputs are stored."""
+    path = str(tmp_path / "journal.json")
+    journal = StageJournal.start(path, "install", "hash")
+    assert journal.run("partitions", lambda: ("/dev/vda1", "/dev/vda2")) == ("/dev/vda1", "/dev/vda2")
+
+    loaded = StageJournal.load(path)
+    assert loaded.completed("partitions")
+    assert loaded.output("partitions") == ["/dev/vda1", "/dev/vda2"]
+
+
+def test_failed_stage_is_resumed(tmp_path):
+    """Test that a resumed run skips completed stages and retries the failed one."""
+    path = str(tmp_path / "journal.json")
+    calls = []
+
+    def failing():
+        raise RuntimeError("network down")
+
+    journal = StageJournal.start(path, "rebuild", "hash")
+    journal.run("repos", lambda: calls.append("repos"))
+    with pytest.raises(RuntimeError):
+        journal.run("packages", failing)
+
+    resumed = StageJournal.start(path, "rebuild", "hash", resume=True)
+    assert resumed.failed_stage == "packages"
+    resumed.run("repos", lambda: calls.append("repos again"))
+    resumed.run("packages", lambda: calls.append("packages"))
+    assert calls == ["repos", "packages"]
+    assert resumed.failed_stage is None
+
+
+def test_resume_requires_same_configuration(tmp_path):
+    """Test that a run cannot be resumed with a different configuration."""
+    path = str(tmp_path / "journal.json")
+    StageJournal.start(path, "install", "hash")
+    with pytest.raises(JournalError):
+        StageJournal.start(path, "install", "other-hash", resume=True)
+    with pytest.raises(JournalError):
+        StageJournal.start(path, "rebuild", "hash", resume=True)
+    with pytest.raises(JournalError):
+        StageJournal.start(str(tmp_path / "missing.json"), "install", "hash", resume=True)
+
+
+def test_fsentry_outputs_round_trip(tmp_path):
+    """Test that partition lists are restored as FsEntry objects."""
+    path = str(tmp_path / "journal.json")
+    entries = [
+        FsEntry("/dev/vda2", "/", "btrfs", "rw,subvol=generations/0/rootfs"),
+        FsEntry("/dev/vda1", "/boot", "vfat", "rw"),
+    ]
+    StageJournal.start(path, "install", "hash").run("hierarchy", lambda: entries)
+
+    restored = StageJournal.load(path).output("hierarchy")
+    assert [str(entry) for entry in restored] == [str(entry) for entry in entries]
+
+
+def test_checkpoint_only_restored_after_last_stage(tmp_path):
+    """Test that a checkpoint older than the last completed stage is not used."""
+    # Debug mode only prints the snapshot commands
+    set_debug(True)
+    path = str(tmp_path / "journal.json")
+    journal = StageJournal.start(path, "install", "hash", checkpoint_dir=str(tmp_path / "checkpoints"))
+    journal.run("essentials", lambda: None, subvolume="/mnt")
+    assert journal.last_checkpoint() == "essentials"
+    journal.run("services", lambda: None)
+    assert journal.last_checkpoint() is None
+
+
+def test_finish_removes_journal(tmp_path):
+    """Test that a successful run removes its journal."""
+    path = str(tmp_path / "journal.json")
+    journal = StageJournal.start(path, "install", "hash")
+    journal.finish()
+    assert StageJournal.load(path) is None
@@ -0,0 +1,63 @@
+"""Unit tests for the KodOS base layer cache.
+
+This module contains unit tests for the cache keys, the selection between the
+cache and a full bootstrap, and the pruning of the cache using pytest framework.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from helpers import FakeDist
+
+from kod.common import set_debug
+from kod.layers import base_layer_key, install_base_layer, layer_path, prune_base_layers
+
+BASE_PACKAGES = {"kernel": "linux", "base": ["base", "btrfs-progs"]}
+
+
+def test_base_layer_key():
+    """Test that the key depends on the package set and versions, not their order."""
+    key = base_layer_key("arch", BASE_PACKAGES, "base 3-2\nlinux 6.9.1")
+    reordered = {"kernel": "linux", "base": ["btrfs-progs", "base"]}
+    assert base_layer_key("arch", reordered, "base 3-2\nlinux 6.9.1") == key
+    assert base_layer_key("arch", BASE_PACKAGES, "base 3-2\nlinux 6.9.2") != key
+    assert base_layer_key("debian", BASE_PACKAGES, "base 3-2\nlinux 6.9.1") != key
+
+
+def test_install_base_layer_uses_cache(tmp_path, capsys):
+    """Test that a cached layer is restored instead of bootstrapping again."""
+    # Debug mode only prints the commands
+    set_debug(True)
+    dist = FakeDist(versions="linux 6.9.1")
+    assert not install_base_layer(dist, "arch", BASE_PACKAGES, "/mnt", cache_path=str(tmp_path))
+    assert dist.calls == ["bootstrap"]
+    assert "--one-file-system" in capsys.readouterr().out
+
+    key = base_layer_key("arch", BASE_PACKAGES, "linux 6.9.1")
+    Path(layer_path(key, str(tmp_path))).write_text("")
+    assert install_base_layer(dist, "arch", BASE_PACKAGES, "/mnt", cache_path=str(tmp_path))
+    assert dist.calls == ["bootstrap", "finalize"]
+
+
+def test_install_base_layer_without_versions(tmp_path):
+    """Test that the cache is not used when the versions cannot be resolved."""
+    set_debug(True)
+    dist = FakeDist(versions="")
+    assert not install_base_layer(dist, "arch", BASE_PACKAGES, "/mnt", cache_path=str(tmp_path))
+    assert dist.calls == ["bootstrap"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_prune_base_layers(tmp_path):
+    """Test that the least recently used layers are removed."""
+    for age, key in enumerate(["new", "old", "older"]):
+        layer = tmp_path / f"{key}.tar.zst"
+        layer.write_text("")
+        (tmp_path / f"{key}.json").write_text("{}")
+        os.utime(layer, (1000 - age * 100, 1000 - age * 100))
+    assert prune_base_layers(str(tmp_path), keep=1) == ["old", "older"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["new.json", "new.tar.zst"]
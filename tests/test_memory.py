@@ -0,0 +1,94 @@
+"""Unit tests for the KodOS memory settings.
+
+This module contains unit tests for the zram configuration, the swapfile fstab
+entry and the resume device of the memory section using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from helpers import Table
+
+import kod.memory as kod_memory
+from kod.common import set_debug
+from kod.core import configure_memory, load_fstab
+from kod.filesystem import FsEntry
+from kod.memory import SWAPFILE_PATH, ZRAM_CONFIG_FILE, render_zram_config, resume_params, swap_entries
+from kod.preflight import check_memory
+from kod.tuning import get_kernel_params
+
+
+def root_entries():
+    """Get the fstab entries of a root filesystem with a swap partition."""
+    return [
+        FsEntry("UUID=1234", "/", "btrfs", "rw,subvol=generations/1/rootfs"),
+        FsEntry("UUID=5678", "none", "swap", "defaults"),
+    ]
+
+
+def test_render_zram_config():
+    """Test that the zram settings are rendered for zram-generator, with defaults."""
+    config = render_zram_config({"size": "ram / 2", "compression": "zstd"})
+    assert "[zram0]\nzram-size = ram / 2\ncompression-algorithm = zstd\nswap-priority = 100\n" in config
+    assert "zram-size = min(ram / 2, 4096)" in render_zram_config({})
+    assert render_zram_config({"enable": False}) == ""
+    assert render_zram_config(None) == ""
+
+
+def test_swap_entries_keep_swap_partitions():
+    """Test that only the swapfile entry is added, updated or removed."""
+    entries = swap_entries(root_entries(), {"size": "4G", "priority": 10})
+    assert [(part.source, part.options) for part in entries[1:]] == [
+        ("UUID=5678", "defaults"),
+        (SWAPFILE_PATH, "defaults,pri=10"),
+    ]
+    entries = swap_entries(entries, {"size": "4G", "enable": False})
+    assert [part.source for part in entries] == ["UUID=1234", "UUID=5678"]
+
+
+def test_resume_params(monkeypatch):
+    """Test the resume options of a swapfile, of a device and of the single swap partition."""
+    monkeypatch.setattr(kod_memory, "exec", lambda cmd, get_output=False: "533760\n")
+    assert resume_params("swapfile", root_entries(), SWAPFILE_PATH) == ["resume=UUID=1234", "resume_offset=533760"]
+    assert resume_params("swapfile", root_entries()) == []
+    assert resume_params("UUID=abcd", root_entries()) == ["resume=UUID=abcd"]
+    assert resume_params(None, root_entries()) == ["resume=UUID=5678"]
+    assert resume_params(None, root_entries()[:1]) == []
+
+
+def test_configure_memory(tmp_path):
+    """Test that zram is configured and the swapfile is added to the fstab."""
+    set_debug(True)
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc" / "fstab").write_text("\n".join(str(part) for part in root_entries()) + "\n")
+    conf = Table(memory=Table(zram=Table(compression="lz4"), swapfile=Table(size="2G")))
+
+    # Without a resume setting, the only swap partition is the resume device
+    assert configure_memory(conf, str(tmp_path)) == ["resume=UUID=5678"]
+    assert get_kernel_params(str(tmp_path)) == ["resume=UUID=5678"]
+    assert "compression-algorithm = lz4" in (tmp_path / ZRAM_CONFIG_FILE).read_text()
+    assert [part.source for part in load_fstab(str(tmp_path))] == ["UUID=1234", "UUID=5678", SWAPFILE_PATH]
+
+    configure_memory(Table(memory=Table(resume="UUID=abcd")), str(tmp_path))
+    assert get_kernel_params(str(tmp_path)) == ["resume=UUID=abcd"]
+    assert not (tmp_path / ZRAM_CONFIG_FILE).exists()
+    assert [part.source for part in load_fstab(str(tmp_path))] == ["UUID=1234", "UUID=5678"]
+
+
+def test_check_memory():
+    """Test that invalid compression algorithms, sizes and resume devices are reported."""
+    conf = Table(
+        memory=Table(zram=Table(compression="gzip"), swapfile=Table(size="lots"), resume="sda2"),
+    )
+    assert check_memory(conf) == [
+        "memory: unknown zram compression algorithm 'gzip'",
+        "memory: invalid swapfile size 'lots'",
+        "memory: invalid resume device 'sda2'",
+    ]
+    assert check_memory(Table(memory=Table(resume="swapfile"))) == [
+        "memory: resume uses the swapfile, but there is no swapfile"
+    ]
+    assert check_memory(Table()) == []
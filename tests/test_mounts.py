@@ -0,0 +1,110 @@
+"""Unit tests for the KodOS mount manager.
+
+This module contains unit tests for the planning of mounts and unmounts against
+the mount table using pytest framework.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import kod.mounts as kod_mounts
+from kod.common import set_debug
+from kod.core import STORE_DIRS, hierarchy_mounts
+from kod.devices import read_mountinfo
+from kod.filesystem import DEFAULT_BTRFS_OPTIONS
+from kod.mounts import Mount, apply_mounts, enter_private_mount_namespace, plan_mounts, unmount_order, unmount_tree
+
+NEXT = "/kod/current/.next_current"
+
+MOUNTINFO = f"""\
+1 0 8:2 /generations/1/rootfs / rw - btrfs /dev/sda2 rw,subvol=/generations/1/rootfs
+2 1 8:2 / /kod rw - btrfs /dev/sda2 rw,subvol=/
+3 1 8:2 /store/root /root rw - btrfs /dev/sda2 rw,subvol=/
+10 1 8:2 /generations/2/rootfs {NEXT} rw - btrfs /dev/sda2 rw,subvol=/generations/2/rootfs
+11 10 8:1 / {NEXT}/boot rw - vfat /dev/sda1 rw
+12 10 8:2 / {NEXT}/kod rw - btrfs /dev/sda2 rw,subvol=/
+13 10 8:2 /store/home {NEXT}/home rw - btrfs /dev/sda2 rw,subvol=/store/home
+14 10 8:2 /store/root {NEXT}/root rw - btrfs /dev/sda2 rw,subvol=/
+"""
+
+
+def mount_table(tmp_path, content=MOUNTINFO):
+    """Write a mountinfo table and return its path."""
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(content)
+    return str(mountinfo)
+
+
+def test_plan_mounts_skips_mounts_in_place(tmp_path):
+    """Test that an interrupted rebuild only mounts what is missing."""
+    mounts = read_mountinfo(mount_table(tmp_path))
+    desired = hierarchy_mounts("/dev/sda1", "/dev/sda2", 2, NEXT, "/kod/store")
+    unmounts, to_mount = plan_mounts(desired, mounts)
+    assert unmounts == []
+    assert [mount.target for mount in to_mount] == [f"{NEXT}/{dir}" for dir in STORE_DIRS if dir != "root"]
+    assert to_mount[0].command() == f"mount --bind /kod/store/var/log {NEXT}/var/log"
+
+
+def test_plan_mounts_replaces_other_generation(tmp_path):
+    """Test that the mounts of another generation are unmounted children first and redone."""
+    mounts = read_mountinfo(mount_table(tmp_path))
+    desired = hierarchy_mounts("/dev/sda1", "/dev/sda2", 3, NEXT, "/kod/store")
+    unmounts, to_mount = plan_mounts(desired, mounts)
+    assert unmounts[-1] == NEXT
+    assert sorted(unmounts[:-1]) == [f"{NEXT}/{dir}" for dir in ["boot", "home", "kod", "root"]]
+    assert to_mount == desired
+    assert to_mount[0].command() == f"mount -o {DEFAULT_BTRFS_OPTIONS},subvol=generations/3/rootfs /dev/sda2 {NEXT}"
+
+
+def test_bind_mount_in_place():
+    """Test that a bind mount is recognized from the root of the source filesystem."""
+    mounts = [
+        {"mount_id": "1", "parent_id": "0", "device": "8:2", "root": "/", "mount_point": "/kod", "source": "/dev/sda2"},
+        {"mount_id": "2", "parent_id": "1", "device": "8:2", "root": "/store/usr", "mount_point": "/usr"},
+    ]
+    assert plan_mounts([Mount("/kod/store/usr", "/usr", bind=True)], mounts) == ([], [])
+    assert plan_mounts([Mount("/kod/store/var", "/usr", bind=True)], mounts)[0] == ["/usr"]
+
+
+def test_unmount_order_children_first(tmp_path):
+    """Test that stacked and nested mounts are unmounted in reverse topological order."""
+    mounts = read_mountinfo(mount_table(tmp_path))
+    order = unmount_order(NEXT, mounts)
+    assert order.index(f"{NEXT}/boot") < order.index(NEXT)
+    assert len(order) == 5
+    assert unmount_order("/mnt", mounts) == []
+
+
+def test_apply_mounts_is_idempotent(tmp_path, capsys):
+    """Test that applying mounts already in place runs no command."""
+    set_debug(True)
+    mountinfo = mount_table(tmp_path)
+    desired = hierarchy_mounts("/dev/sda1", "/dev/sda2", 2, NEXT, "/kod/store")[:4]
+    assert apply_mounts(desired, mountinfo) == 0
+    assert "All mounts are in place" in capsys.readouterr().out
+    assert unmount_tree("/mnt", mountinfo) == []
+
+
+def test_enter_private_mount_namespace(monkeypatch, capsys):
+    """Test that the mounts are made private once the namespace is created."""
+    set_debug(True)
+    calls = []
+    monkeypatch.setattr(kod_mounts.os, "unshare", calls.append)
+    assert enter_private_mount_namespace()
+    assert calls == [os.CLONE_NEWNS]
+    assert "mount --make-rprivate /" in capsys.readouterr().out
+
+
+def test_private_mount_namespace_not_available(monkeypatch, capsys):
+    """Test that a missing capability keeps the mounts in the host namespace."""
+
+    def unshare(flags):
+        raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr(kod_mounts.os, "unshare", unshare)
+    assert not enter_private_mount_namespace()
+    assert "mounts are shared with the host" in capsys.readouterr().out
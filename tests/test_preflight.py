@@ -0,0 +1,161 @@
+"""Unit tests for KodOS preflight validation.
+
+This module contains unit tests for the configuration checks executed before
+an installation or a rebuild using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from helpers import FakeDist
+
+from kod.preflight import (
+    PreflightError,
+    check_devices,
+    check_locale,
+    check_network,
+    check_packages,
+    check_repos,
+    check_target,
+    get_filesystem_type,
+    parse_size,
+    run_preflight,
+)
+
+
+def make_config(**overrides):
+    """Build a minimal valid configuration."""
+    conf = {
+        "locale": {"locale": {"default": "en_CA.UTF-8 UTF-8"}, "timezone": "UTC"},
+        "network": {"hostname": "testvm"},
+        "boot": {"loader": {"type": "systemd-boot"}},
+        "users": {"root": {"no_password": True}},
+        "devices": {
+            "disk0": {
+                "device": "/dev/vda",
+                "partitions": {
+                    1: {"name": "Boot", "size": "1GB", "type": "esp"},
+                    2: {"name": "Root", "size": "100%", "type": "btrfs"},
+                },
+            }
+        },
+        "repos": {"official": {"commands": {"install": "pacman -S --noconfirm", "remove": "pacman -R"}}},
+    }
+    conf.update(overrides)
+    return conf
+
+
+PACKAGES = {"kernel": "linux", "base": ["base"], "packages": ["git"]}
+
+
+def test_parse_size():
+    """Test parsing partition sizes."""
+    assert parse_size("1GB") == 1024**3
+    assert parse_size("512M") == 512 * 1024**2
+    assert parse_size("3GiB") == 3 * 1024**3
+    assert parse_size("lots") is None
+
+
+def test_missing_locale_and_hostname():
+    """Test that missing locale and hostname are reported."""
+    assert check_locale(make_config(locale={"timezone": "UTC"})) == ["locale: locale.default is missing"]
+    assert check_network(make_config(network={"ipv6": False})) == ["network: hostname is missing"]
+    assert check_network(make_config(network={"hostname": "bad_name"})) == ["network: invalid hostname 'bad_name'"]
+
+
+def test_unknown_partition_type():
+    """Test that unsupported partition types are reported before partitioning."""
+    conf = make_config()
+    conf["devices"]["disk0"]["partitions"][2]["type"] = "zfs"
+    problems = check_devices(conf, check_hardware=False)
+    assert problems == ["devices.disk0.partitions[2]: unsupported partition type 'zfs'"]
+
+
+def test_unknown_subvolume_options():
+    """Test that mount options can only be set for the subvolumes of the hierarchy."""
+    conf = make_config()
+    conf["devices"]["disk0"]["partitions"][2]["subvolumeOptions"] = {"home": "rw,noatime", "srv": "rw"}
+    problems = check_devices(conf, check_hardware=False)
+    assert problems == ["devices.disk0.partitions[2]: unknown subvolume 'srv' in subvolumeOptions"]
+
+
+def test_invalid_store_paths():
+    """Test that store paths cannot leave the root filesystem or replace the hierarchy mounts."""
+    conf = make_config()
+    conf["devices"]["disk0"]["partitions"][2]["storePaths"] = {"var/lib/postgres": {}, "../etc": {}, "home/db": {}}
+    problems = check_devices(conf, check_hardware=False)
+    assert problems == [
+        "devices.disk0.partitions[2]: invalid store path '../etc' in storePaths",
+        "devices.disk0.partitions[2]: invalid store path 'home/db' in storePaths",
+    ]
+
+
+def test_boot_and_root_partitions_required():
+    """Test that exactly one boot and one root partition are required."""
+    conf = make_config()
+    del conf["devices"]["disk0"]["partitions"][1]
+    assert check_devices(conf, check_hardware=False) == ["devices: expected one boot partition, found 0"]
+
+
+def test_repo_commands():
+    """Test the validation of repository command strings."""
+    repos = {
+        "official": {"commands": {"install": "pacman -S 'unbalanced", "remove": "pacman -R"}},
+        "aur": {"build": {"name": "yay"}, "commands": {"install": "yay -S", "run_as_root": False}},
+    }
+    problems = check_repos(make_config(repos=repos), check_commands=False)
+    assert "repos.aur: 'remove' command is missing" in problems
+    assert any(problem.startswith("repos.official: 'install' command cannot be parsed") for problem in problems)
+    assert len(problems) == 2
+
+
+def test_packages_checked_against_index():
+    """Test that unknown packages and repositories are reported."""
+    packages = {"kernel": "linux", "base": ["base"], "packages": ["git", "no-such-pkg", "aur:yay", "snap:foo"]}
+    conf = make_config(repos={"official": {}, "aur": {}})
+    problems = check_packages(conf, FakeDist(["linux", "base", "git"]), packages)
+    assert problems == [
+        "packages: 'snap:foo' uses undefined repository 'snap'",
+        "packages: 'no-such-pkg' was not found in the package index",
+    ]
+
+
+def test_run_preflight_raises_with_all_problems():
+    """Test that every problem is collected before aborting."""
+    conf = make_config(network={"ipv6": False}, locale=None)
+    with pytest.raises(PreflightError) as exc_info:
+        run_preflight(conf, FakeDist(["linux", "base", "git"]), PACKAGES, install=False)
+    assert exc_info.value.problems[:2] == ["locale: section is missing", "network: hostname is missing"]
+
+
+def test_run_preflight_passes():
+    """Test that a valid configuration passes the preflight checks."""
+    run_preflight(make_config(), FakeDist(["linux", "base", "git"]), PACKAGES, install=False)
+
+
+def test_get_filesystem_type(tmp_path):
+    """Test that the filesystem type is taken from the longest containing mount point."""
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(
+        "22 1 0:21 / / rw,relatime shared:1 - ext4 /dev/vda2 rw\n"
+        "35 22 0:30 / /srv/build\\040dir rw,relatime shared:2 - btrfs /dev/vdb rw,subvol=/\n"
+    )
+    assert get_filesystem_type("/srv/build dir/images", str(mountinfo)) == "btrfs"
+    assert get_filesystem_type("/srv/build", str(mountinfo)) == "ext4"
+
+
+def test_target_must_be_a_directory(tmp_path):
+    """Test that a missing installation target is reported."""
+    target = tmp_path / "missing"
+    assert check_target(str(target)) == [f"target: {target} is not a directory"]
+    conf = make_config(devices=None)
+    with pytest.raises(PreflightError) as exc_info:
+        run_preflight(conf, FakeDist(["linux", "base", "git"]), PACKAGES, target=str(target))
+    # The devices are not checked for a directory target
+    assert f"target: {target} is not a directory" in exc_info.value.problems
+    assert not any(problem.startswith("devices") for problem in exc_info.value.problems)
@@ -0,0 +1,82 @@
+"""Unit tests for KodOS generation export and import.
+
+This module contains unit tests for the export and import of generations using
+pytest framework. The btrfs commands are only printed in debug mode.
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import kod.core as core
+import kod.transfer as transfer
+from kod.common import set_debug
+from kod.generations import GenerationIndex, new_generation_entry
+from kod.transfer import METADATA_FILE, export_generation, find_imported_generation, import_generation
+
+
+def test_export_requires_complete_generation(tmp_path, monkeypatch):
+    """Test that unknown or unfinished generations are not exported."""
+    monkeypatch.setattr(GenerationIndex, "load", classmethod(lambda cls: GenerationIndex(str(tmp_path))))
+    assert not export_generation(4, str(tmp_path / "out"))
+
+
+def test_export_writes_incremental_stream_and_metadata(tmp_path, monkeypatch, capsys):
+    """Test that an incremental export sends relative to the parent snapshot."""
+    set_debug(True)
+    index = GenerationIndex(str(tmp_path))
+    index.entries[5] = new_generation_entry(5, 4, config_hash="abc", kver="6.9.1-arch1-1", status="complete")
+    monkeypatch.setattr(GenerationIndex, "load", classmethod(lambda cls: index))
+    monkeypatch.setattr("kod.transfer.EXPORTS_PATH", str(tmp_path / "exports"))
+    (tmp_path / "exports" / "generation-4").mkdir(parents=True)
+
+    output = tmp_path / "out"
+    assert export_generation(5, str(output), parent=4)
+    out = capsys.readouterr().out
+    assert f"btrfs send -p {tmp_path}/exports/generation-4 {tmp_path}/exports/generation-5 | zstd" in out
+    metadata = json.loads((output / METADATA_FILE).read_text())
+    assert metadata["parent"] == 4
+    assert metadata["entry"]["kver"] == "6.9.1-arch1-1"
+
+
+def test_find_imported_generation():
+    """Test that imported generations are found by their source generation."""
+    index = GenerationIndex("/nonexistent")
+    entry = new_generation_entry(2, 1)
+    entry["source"] = 17
+    index.entries[2] = entry
+    assert find_imported_generation(index, 17) == 2
+    assert find_imported_generation(index, 16) is None
+
+
+def test_failed_import_keeps_its_generation_number(tmp_path, monkeypatch):
+    """Test that the generation of an import is registered before its subvolume is created."""
+    set_debug(True)
+    generations = tmp_path / "generations"
+    generations.mkdir()
+    load = GenerationIndex.load
+    monkeypatch.setattr(GenerationIndex, "load", classmethod(lambda cls: load(str(generations))))
+    monkeypatch.setattr(transfer, "GENERATIONS_PATH", str(generations))
+    monkeypatch.setattr(transfer, "RECEIVED_PATH", str(tmp_path / "received"))
+    (tmp_path / "received" / "generation-7").mkdir(parents=True)
+    export = tmp_path / "export"
+    export.mkdir()
+    entry = new_generation_entry(7, None, config_hash="abc", status="complete")
+    metadata = {"generation": 7, "parent": None, "snapshot": "generation-7", "entry": entry}
+    (export / METADATA_FILE).write_text(json.dumps(metadata))
+
+    def create_next_generation(boot_partition, root_partition, generation):
+        raise RuntimeError("Failed to mount the generation")
+
+    monkeypatch.setattr(core, "create_next_generation", create_next_generation)
+    with pytest.raises(RuntimeError):
+        import_generation(str(export), "/dev/vda1", "/dev/vda2")
+
+    index = GenerationIndex.load()
+    assert index.get(1)["status"] == "building"
+    assert index.allocate(1)["id"] == 2
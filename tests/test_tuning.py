@@ -0,0 +1,81 @@
+"""Unit tests for the KodOS tuning settings.
+
+This module contains unit tests for the rendering of the sysctl settings, the
+I/O scheduler rules, the CPU settings and the kernel command line options of the
+tuning section using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from helpers import Table
+
+from kod.common import set_debug
+from kod.preflight import check_tuning
+from kod.tuning import (
+    CPU_TMPFILES_FILE,
+    IO_SCHEDULER_RULES_FILE,
+    SYSCTL_FILE,
+    configure_tuning,
+    get_kernel_params,
+    kernel_params,
+    render_io_scheduler_rules,
+)
+
+
+def test_render_io_scheduler_rules():
+    """Test that each device class gets its own udev rule."""
+    rules = render_io_scheduler_rules({"nvme": "none", "hdd": "bfq"})
+    assert 'KERNEL=="nvme[0-9]*n[0-9]*", ATTR{queue/scheduler}="none"' in rules
+    assert 'ATTR{queue/rotational}=="1", ATTR{queue/scheduler}="bfq"' in rules
+    assert 'rotational}=="0"' not in rules
+    assert render_io_scheduler_rules({}) == ""
+
+
+def test_kernel_params_of_mixed_table():
+    """Test that list items come first and false options are omitted."""
+    params = {"1": "nowatchdog", "2": "quiet", "mitigations": "auto", "splash": True, "debug": False}
+    assert kernel_params(params) == ["nowatchdog", "quiet", "mitigations=auto", "splash"]
+    assert kernel_params(["quiet"]) == ["quiet"]
+    assert kernel_params(None) == []
+
+
+def test_configure_tuning_writes_and_removes_files(tmp_path):
+    """Test that the settings are written to the root filesystem and removed with the section."""
+    set_debug(True)
+    conf = Table(
+        tuning=Table(
+            sysctl=Table({"vm.swappiness": 10, "kernel.nmi_watchdog": False}),
+            cpu=Table(governor="schedutil"),
+            kernel_params=Table({1: "nowatchdog"}),
+        )
+    )
+    assert configure_tuning(conf, str(tmp_path)) == ["nowatchdog"]
+    assert (tmp_path / SYSCTL_FILE).read_text().splitlines()[1:] == ["kernel.nmi_watchdog = 0", "vm.swappiness = 10"]
+    assert "scaling_governor - - - - schedutil" in (tmp_path / CPU_TMPFILES_FILE).read_text()
+    assert not (tmp_path / IO_SCHEDULER_RULES_FILE).exists()
+    assert get_kernel_params(str(tmp_path)) == ["nowatchdog"]
+
+    assert configure_tuning(Table(), str(tmp_path)) == []
+    assert not (tmp_path / SYSCTL_FILE).exists()
+    assert get_kernel_params(str(tmp_path)) == []
+
+
+def test_check_tuning():
+    """Test that unknown device classes, schedulers and CPU settings are reported."""
+    conf = Table(
+        tuning=Table(
+            io_scheduler=Table(nvme="cfq", floppy="none"),
+            cpu=Table(governor="performance", boost=True),
+            sysctl=Table({"vm.swappiness": 10}),
+        )
+    )
+    assert check_tuning(conf) == [
+        "tuning: unknown I/O scheduler 'cfq' for nvme",
+        "tuning: unknown device class 'floppy' in io_scheduler",
+        "tuning: unknown cpu setting 'boost'",
+    ]
+    assert check_tuning(Table()) == []
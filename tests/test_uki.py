@@ -0,0 +1,88 @@
+"""Unit tests for the KodOS unified kernel images.
+
+This module contains unit tests for the naming, the reuse and the pruning of the
+unified kernel images, and for the default boot entry, using pytest framework.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from helpers import Table
+
+from kod.core import set_default_boot_entry
+from kod.esp import BootArtifactStore, generation_ukis, uki_name
+from kod.generations import get_generation_kver
+from kod.preflight import check_boot
+from kod.uki import build_uki, os_release, uki_key, uki_requested
+
+
+def make_root(path):
+    """Create a root filesystem with a kernel and an initramfs image on the ESP."""
+    (path / "etc").mkdir(parents=True)
+    (path / "etc/os-release").write_text('NAME="KodOS"\nID=kodos\n')
+    (path / "boot/EFI/Linux").mkdir(parents=True)
+    (path / "boot/vmlinuz-6.9.1-arch1").write_text("kernel")
+    (path / "boot/initramfs-6.9.1-arch1-a.img").write_text("initramfs")
+    return path
+
+
+def test_uki_requested():
+    """Test that unified kernel images are only used when boot.loader.uki is true."""
+    assert uki_requested(Table(boot=Table(loader=Table(type="systemd-boot", uki=True))))
+    assert not uki_requested(Table(boot=Table(loader=Table(type="systemd-boot"))))
+    assert not uki_requested(Table())
+    assert check_boot(Table(boot=Table(loader=Table(type="grub", uki=True)))) == [
+        "boot: unified kernel images require systemd-boot"
+    ]
+
+
+def test_build_uki_reuses_image_and_removes_stale_ones(tmp_path, capsys):
+    """Test that an image with the same inputs is reused and older images of the generation are removed."""
+    root = make_root(tmp_path)
+    boot = str(root / "boot")
+    cmdline = "root=UUID=1234 rw rootflags=subvol=generations/3/rootfs"
+    release = os_release(str(root), 3, "6.9.1-arch1")
+    name = uki_name(
+        3, "6.9.1-arch1", uki_key("6.9.1-arch1", "initramfs-6.9.1-arch1-a.img", cmdline, release, str(root), boot)
+    )
+    (root / "boot" / name).write_text("uki")
+    stale = root / "boot/EFI/Linux/kodos-3-6.8.0-0123456789ab.efi"
+    stale.write_text("old uki")
+    os.utime(stale, (0, 0))
+    other = root / "boot/EFI/Linux/kodos-31-6.9.1-arch1-0123456789ab.efi"
+    other.write_text("other generation")
+
+    assert generation_ukis(boot, 3) == [name, "EFI/Linux/kodos-3-6.8.0-0123456789ab.efi"]
+    assert build_uki(3, "6.9.1-arch1", "initramfs-6.9.1-arch1-a.img", cmdline, str(root)) == name
+    assert "Reusing unified kernel image" in capsys.readouterr().out
+    assert not stale.exists()
+    assert other.exists()
+    assert get_generation_kver(3, str(root)) == "6.9.1-arch1"
+
+
+def test_released_images_are_pruned(tmp_path):
+    """Test that the image of a deleted generation is pruned with its generation."""
+    root = make_root(tmp_path)
+    name = uki_name(4, "6.9.1-arch1", "0123456789abcdef")
+    (root / "boot" / name).write_text("uki")
+    store = BootArtifactStore.load(str(root / "boot"))
+    store.reference(4, [name, "vmlinuz-6.9.1-arch1"])
+    assert store.prune() == ["initramfs-6.9.1-arch1-a.img"]
+    store.release(4)
+    assert store.prune() == [name, "vmlinuz-6.9.1-arch1"]
+
+
+def test_set_default_boot_entry_only_writes_changes(tmp_path):
+    """Test that loader.conf is not rewritten when the default entry does not change."""
+    set_default_boot_entry("kodos-3-6.9.1-0123456789ab.efi", str(tmp_path))
+    loader_conf = tmp_path / "boot/loader/loader.conf"
+    assert "default kodos-3-6.9.1-0123456789ab.efi" in loader_conf.read_text()
+    os.utime(loader_conf, (0, 0))
+    set_default_boot_entry("kodos-3-6.9.1-0123456789ab.efi", str(tmp_path))
+    assert loader_conf.stat().st_mtime == 0
+    set_default_boot_entry("kodos-4.conf", str(tmp_path))
+    assert "default kodos-4.conf" in loader_conf.read_text()
@@ -0,0 +1,89 @@
+"""Unit tests for KodOS generation disk usage accounting.
+
+This module contains unit tests for the parsing of the btrfs usage commands and
+the incremental refresh of the cached results using pytest framework.
+"""
+
+import sys
+from pathlib import Path
+
+# Add the src directory to Python path for testing
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from kod.usage import (
+    format_size,
+    generation_neighbours,
+    parse_filesystem_du,
+    parse_qgroup_show,
+    parse_subvolume_list,
+    stale_generations,
+)
+
+SUBVOLUME_LIST = """ID 256 gen 120 top level 5 path store/home
+ID 257 gen 35 top level 5 path generations/0/rootfs
+ID 301 gen 118 top level 5 path generations/1/rootfs
+"""
+
+QGROUP_SHOW = """Qgroupid    Referenced    Exclusive   Path
+--------    ----------    ---------   ----
+0/5              16384        16384   <toplevel>
+0/257       4294967296     10485760   generations/0/rootfs
+0/301       4400000000    115032704   generations/1/rootfs
+"""
+
+FILESYSTEM_DU = """     Total   Exclusive  Set shared  Filename
+4294967296    10485760  4284481536  /kod/generations/0/rootfs
+"""
+
+
+def test_parse_subvolume_list():
+    """Test that subvolume ids and transaction ids are read per path."""
+    subvolumes = parse_subvolume_list(SUBVOLUME_LIST)
+    assert subvolumes["generations/1/rootfs"] == (301, 118)
+    assert len(subvolumes) == 3
+
+
+def test_parse_qgroup_show_and_du():
+    """Test that referenced and exclusive bytes are read."""
+    assert parse_qgroup_show(QGROUP_SHOW)[257] == (4294967296, 10485760)
+    assert 5 in parse_qgroup_show(QGROUP_SHOW)
+    assert parse_filesystem_du(FILESYSTEM_DU) == {"/kod/generations/0/rootfs": (4294967296, 10485760)}
+
+
+def test_only_changed_generations_are_measured():
+    """Test that cached measurements are reused until the subvolume or its neighbours change."""
+    subvolumes = parse_subvolume_list(SUBVOLUME_LIST)
+    entries = [
+        {"id": 0, "usage": {"transid": 35, "neighbours": [None, 1]}},
+        {"id": 1, "usage": {"transid": 100, "neighbours": [0, None]}},
+        {"id": 2},
+    ]
+    # Generation 2 has no subvolume, generation 1 was written since it was measured
+    assert stale_generations(entries, subvolumes) == [1]
+
+
+def test_new_and_deleted_generations_only_refresh_neighbours():
+    """Test that adding or deleting a generation only measures its neighbours again."""
+    subvolumes = {f"generations/{gen}/rootfs": (256 + gen, 10) for gen in [1, 2, 4, 5, 6]}
+    entries = [{"id": gen} for gen in [1, 2, 4, 5, 6]]
+    neighbours = generation_neighbours(entries, subvolumes)
+    assert neighbours[1] == [None, 2] and neighbours[4] == [2, 5]
+    for entry in entries:
+        entry["usage"] = {"transid": 10, "neighbours": neighbours[entry["id"]]}
+    assert stale_generations(entries, subvolumes) == []
+
+    # Generation 7 is created, only the previous last generation is measured again with it
+    subvolumes["generations/7/rootfs"] = (263, 10)
+    assert stale_generations(entries + [{"id": 7}], subvolumes) == [6, 7]
+
+    # Generation 4 is deleted, generations 2 and 5 gain its exclusive extents
+    del subvolumes["generations/7/rootfs"], subvolumes["generations/4/rootfs"]
+    assert stale_generations([entry for entry in entries if entry["id"] != 4], subvolumes) == [2, 5]
+
+
+def test_format_size():
+    """Test the display of sizes."""
+    assert format_size(None) == "-"
+    assert format_size(512) == "512B"
+    assert format_size(10485760) == "10.0M"
+    assert format_size(4294967296) == "4.0G"